@@ -1,6 +1,8 @@
 from charm.toolbox.pairinggroup import PairingGroup,ZR,G1,G2,GT,pair
 from base64 import encodestring, decodestring
 import random
+from lagrange import LagrangeCache
+from multiexp import combine
 
 # An implementation of (unique) threshold signatures based on Gap-Diffie-Hellman 
 # Boldyreva, 2002 https://eprint.iacr.org/2002/118.pdf
@@ -47,6 +49,7 @@ class TBLSPublicKey(object):
 
     def __getstate__(self):
         d = dict(self.__dict__)
+        d.pop('_lagrangeCache', None)  # holds group elements, rebuilt on demand
         d['VK'] = serialize(self.VK)
         d['VKs'] = map(serialize,self.VKs)
         return d
@@ -57,20 +60,16 @@ class TBLSPublicKey(object):
         self.VKs = map(deserialize2,self.VKs)
         print "I'm being depickled"
 
+    def lagrange_coefficients(self, S):
+        # All the coefficients for the set of signers S, cached by set
+        if '_lagrangeCache' not in self.__dict__:
+            self._lagrangeCache = LagrangeCache(self.l, self.k, ONE)
+        return self._lagrangeCache.coefficients(S)
+
     def lagrange(self, S, j):
-        # Assert S is a subset of range(0,self.l)
-        assert len(S) == self.k
         assert type(S) is set
-        assert S.issubset(range(0,self.l))
-        S = sorted(S)
-
         assert j in S
-        assert 0 <= j < self.l
-        mul = lambda a,b: a*b
-        num = reduce(mul, [0 - jj - 1 for jj in S if jj != j], ONE)
-        den = reduce(mul, [j - jj     for jj in S if jj != j], ONE)
-        #assert num % den == 0
-        return num / den
+        return self.lagrange_coefficients(S)[j]
 
     def hash_message(self, m):
         return group.hash(m, G1)
@@ -88,12 +87,11 @@ class TBLSPublicKey(object):
     def combine_shares(self, sigs):
         # sigs: a mapping from idx -> sig
         S = set(sigs.keys())
-        assert S.issubset(range(self.l))
+        coefficients = self.lagrange_coefficients(S)
 
-        mul = lambda a,b: a*b
-        res = reduce(mul, 
-                     [sig ** self.lagrange(S, j) 
-                      for j,sig in sigs.iteritems()], 1)
+        indices = sigs.keys()
+        res = combine([sigs[j] for j in indices],
+                      [coefficients[j] for j in indices])
         return res
 
 
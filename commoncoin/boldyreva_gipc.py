@@ -1,26 +1,46 @@
 from boldyreva import dealer, serialize, deserialize1, deserialize2
 import gevent
+from gevent.lock import Semaphore
 import gipc
 import time
 import random
 
 if '_procs' in globals():
-    for p,pipe in _procs: 
+    for p,pipe,_ in _procs:
         p.terminate()
         p.join()
     del _procs
 _procs = []
 
+def _combine(PK, h, sigs):
+    sigs = dict(sigs)
+    for s in sigs:
+        sigs[s] = deserialize1(sigs[s])
+    h = deserialize1(h)
+    sig = PK.combine_shares(sigs)
+    try:
+        res = PK.verify_signature(sig, h)
+    except AssertionError:
+        res = False  # at least one of the shares is bad
+    return (res,serialize(sig))
+
+def _verify(PK, h, sigs):
+    h = deserialize1(h)
+    result = []
+    for i, sig in sigs:
+        try:
+            result.append((i, PK.verify_share(deserialize1(sig), i, h)))
+        except AssertionError:
+            result.append((i, False))
+    return result
+
 def _worker(PK,pipe):
     while True:
-        (h, sigs) = pipe.get()
-        sigs = dict(sigs)
-        for s in sigs: 
-            sigs[s] = deserialize1(sigs[s])
-        h = deserialize1(h)
-        sig = PK.combine_shares(sigs)
-        res = PK.verify_signature(sig, h)
-        pipe.put((res,serialize(sig)))
+        op, h, sigs = pipe.get()
+        if op == 'combine':
+            pipe.put(_combine(PK, h, sigs))
+        elif op == 'verify':
+            pipe.put(_verify(PK, h, sigs))
 
 myPK = None
 
@@ -31,20 +51,49 @@ def initialize(PK, size=1):
     for s in range(size):
         (r,w) = gipc.pipe(duplex=True)
         p = gipc.start_process(_worker, args=(PK, r,))
-        _procs.append((p,w))
+        _procs.append((p,w,Semaphore()))
 
-def combine_and_verify(h, sigs):
-    # return True  # we are skipping the verification
+def _request(proc, request):
+    _,pipe,lock = proc
+    with lock:  # a pipe can only serve one request at a time
+        pipe.put(request)
+        return pipe.get()
+
+def try_combine_and_verify(h, sigs):
+    # Returns the serialized signature, or None if it does not verify
     assert len(sigs) == myPK.k
     sigs = dict((s,serialize(v)) for s,v in sigs.iteritems())
     h = serialize(h)
-    # Pick a random process
-    _,pipe = _procs[random.choice(range(len(_procs)))] #random.choice(_procs)
-    pipe.put((h,sigs))
-    (r,s) = pipe.get() 
-    assert r == True
+    if not _procs:  # no pool (initialize with size=0), combine in place
+        (r,s) = _combine(myPK, h, sigs.items())
+    else:  # pick a random process
+        (r,s) = _request(random.choice(_procs), ('combine', h, sigs))
+    if r != True:
+        return None
     return s
 
+def combine_and_verify(h, sigs):
+    # return True  # we are skipping the verification
+    s = try_combine_and_verify(h, sigs)
+    assert s is not None
+    return s
+
+def verify_shares(h, sigs):
+    # sigs: a mapping from idx -> sig, returns a mapping from idx -> bool
+    # The checks are spread over all the processes
+    items = [(i, serialize(v)) for i, v in sigs.iteritems()]
+    h = serialize(h)
+    if not _procs:
+        return dict(_verify(myPK, h, items))
+    step = len(items) / len(_procs) + 1
+    jobs = [gevent.spawn(_request, proc, ('verify', h, items[k*step:(k+1)*step]))
+            for k, proc in enumerate(_procs) if items[k*step:(k+1)*step]]
+    gevent.joinall(jobs, raise_error=True)
+    result = dict()
+    for job in jobs:
+        result.update(job.value)
+    return result
+
 def pool_test():
     global PK, SKs
     PK, SKs = dealer(players=64,k=17)
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+
+# Lagrange coefficients for the threshold schemes (boldyreva and tpke).
+# Party j holds the share f(j+1), so the coefficient of j in a set S of
+# signers, evaluated at 0, is
+#     prod_{jj in S, jj != j} (0 - jj - 1) / (j - jj)
+# The signers are usually the same from one combination to the next, so the
+# coefficients of a whole set are computed at once and cached by set.
+
+CACHE_SIZE = 256
+
+def signerMask(S):
+    mask = 0
+    for j in S:
+        mask |= 1 << j
+    return mask
+
+class LagrangeCache(object):
+    '''
+    LRU cache of the Lagrange coefficients of sets of k signers out of l.
+    :param ONE: the unit of the field the coefficients live in
+    '''
+    def __init__(self, l, k, ONE, capacity=CACHE_SIZE):
+        self.l = l
+        self.k = k
+        self.ONE = ONE
+        self.capacity = capacity
+        self.cache = OrderedDict()  # signer bitmask -> {j: coefficient}
+        self.hits = 0
+        self.misses = 0
+
+    def coefficients(self, S):
+        # S: a set of k signer indices, returns a mapping from j -> coefficient
+        key = signerMask(S)
+        if key in self.cache:
+            self.hits += 1
+            coefficients = self.cache.pop(key)
+            self.cache[key] = coefficients  # most recently used goes last
+            return coefficients
+        self.misses += 1
+        coefficients = self.compute(S)
+        self.cache[key] = coefficients
+        if len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+        return coefficients
+
+    def compute(self, S):
+        # Assert S is a subset of range(0,self.l)
+        assert len(S) == self.k
+        assert all(0 <= j < self.l for j in S)
+        S = sorted(S)
+        k, ONE = self.k, self.ONE
+        # Numerators: products of all the (0 - jj - 1) but one, from prefix and suffix products
+        factors = [ONE * (0 - jj - 1) for jj in S]
+        prefix = [ONE] * (k + 1)
+        for i in range(k):
+            prefix[i + 1] = prefix[i] * factors[i]
+        suffix = [ONE] * (k + 1)
+        for i in range(k - 1, -1, -1):
+            suffix[i] = suffix[i + 1] * factors[i]
+        num = [prefix[i] * suffix[i + 1] for i in range(k)]
+        # Denominators: products of small integers, in python longs, to the field once each
+        den = []
+        for j in S:
+            d = 1
+            for jj in S:
+                if jj != j:
+                    d *= j - jj
+            den.append(ONE * d)
+        # Invert all the denominators with a single field inversion
+        running = [ONE] * (k + 1)
+        for i in range(k):
+            running[i + 1] = running[i] * den[i]
+        inv = ONE / running[k]
+        coefficients = dict()
+        for i in range(k - 1, -1, -1):
+            coefficients[S[i]] = num[i] * inv * running[i]
+            inv = inv * den[i]
+        return coefficients
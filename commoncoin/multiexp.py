@@ -0,0 +1,78 @@
+# Multi-exponentiation prod_i bases[i] ** exponents[i], for combining the
+# shares of the threshold schemes (boldyreva and tpke).
+#
+# Pippenger's bucket method: the exponents are cut into windows of c bits,
+# and for each window every base goes into the bucket of its c-bit digit.
+# The buckets are summed with running products, so a window costs about
+# n + 2**c multiplications and all the windows share the same squarings,
+# instead of one full exponentiation per base.
+#
+# Only the group multiplication is used, so it works on the charm group
+# elements as well as on anything else with a __mul__ and a __pow__. None
+# stands for the identity while the buckets are summed, since charm gives no
+# cheap way to build it for every group; the result is a real element.
+#
+# The bucket loops run in python, while charm exponentiates natively, so
+# combine() keeps one native exponentiation per share unless there are at
+# least MULTIEXP_MIN_TERMS of them. It stays off until test/multiexp_benchmark.py
+# has measured where multiexp starts to win.
+
+MULTIEXP_MIN_TERMS = None  # None: always the native exponentiations
+
+def _mul(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a * b
+
+def windowSize(n):
+    # About log2(n) bits per window, the usual choice for Pippenger
+    if n < 4:
+        return 2
+    return min(n.bit_length() - 1, 16)
+
+def multiexp(bases, exponents, c=None):
+    '''
+    :param bases: a non-empty list of group elements
+    :param exponents: a list of non-negative integers, one per base
+    :returns: prod_i bases[i] ** exponents[i], bases[0] ** 0 if it is the identity
+    '''
+    assert bases and len(bases) == len(exponents)
+    exponents = [int(e) for e in exponents]  # int() of a ZR element is its value
+    assert all(e >= 0 for e in exponents)
+    if c is None:
+        c = windowSize(len(bases))
+    bits = max(e.bit_length() for e in exponents) if exponents else 0
+    mask = (1 << c) - 1
+    res = None
+    for shift in range(((bits + c - 1) // c - 1) * c, -1, -c):
+        if res is not None:
+            for _ in range(c):
+                res = res * res
+        buckets = [None] * (mask + 1)
+        for base, e in zip(bases, exponents):
+            digit = (e >> shift) & mask
+            if digit:
+                buckets[digit] = _mul(buckets[digit], base)
+        # sum_d d * buckets[d], as the sum of the running sums from the top
+        running = window = None
+        for d in range(mask, 0, -1):
+            running = _mul(running, buckets[d])
+            window = _mul(window, running)
+        res = _mul(res, window)
+    if res is None:
+        return bases[0] ** 0
+    return res
+
+def combine(bases, exponents, minTerms=MULTIEXP_MIN_TERMS):
+    '''
+    prod_i bases[i] ** exponents[i], with multiexp if there are at least
+    _minTerms_ terms, else with one native exponentiation per base
+    '''
+    if minTerms is not None and len(bases) >= minTerms:
+        return multiexp(bases, exponents)
+    res = bases[0] ** exponents[0]
+    for base, e in zip(bases[1:], exponents[1:]):
+        res = res * base ** e
+    return res
@@ -0,0 +1,202 @@
+# coding=utf-8
+from tally import VoteTally
+from coin import CoinService
+from spans import monotonicNs
+from utils import mylog
+
+
+class BinaryAgreement(object):
+    '''
+    Binary consensus from [MMR 13] as a non-blocking state machine.
+
+    Unlike binary_consensus, it owns no greenlet: it is fed with
+    handle_message(sender, msg) by whoever routes the messages (e.g. the acs
+    listener), and it decides through the _decide_ callback. The only greenlet
+    it spawns are the short-lived ones of its CoinService.
+    The votes of a round are kept as VoteTally bitmasks, and all the state is
+    dropped as soon as the instance terminates. Malformed messages are logged
+    and dropped: they come from other parties, who may be faulty.
+
+    :param instance: the index of this instance, used to derive the coin
+    :param pid: my id number
+    :param N: the number of parties
+    :param t: the number of byzantine parties
+    :param decide: called once with the decided value
+    :param broadcast: broadcast channel
+    :param context: my NodeContext, for my coin key and the timings
+    :param epoch: the epoch this instance belongs to, which the coin depends on
+    '''
+    def __init__(self, instance, pid, N, t, decide, broadcast, context, epoch=0):
+        assert N > 3 * t
+        self.instance = instance
+        self.context = context
+        self.epoch = epoch
+        self.pid = pid
+        self.N = N
+        self.t = t
+        self.decide = decide
+        self.broadcast = broadcast
+        self.round = 0  # 0 means we have not got an input yet
+        self.est = None
+        self.decided = False
+        self.decidedNum = None
+        self.terminated = False
+        self.values = None  # values of the current round, once enough AUX are in
+        self.auxSent = False
+        # Per round state
+        self.bvVotes = dict()  # r -> (senders of BV(0), senders of BV(1))
+        self.bvSent = dict()  # r -> bitmask of the values we broadcast
+        self.binValues = dict()  # r -> values delivered by BV_broadcast, in order
+        self.auxVotes = dict()  # r -> (senders of AUX(0), senders of AUX(1), senders of either)
+        self.coins = dict()  # r -> coin value
+        self.started = monotonicNs()  # reset when the input comes
+        self.coinService = CoinService(instance, pid, N, t, self._onCoin, context, epoch)
+
+    def input(self, vi):
+        if self.round or self.terminated:
+            return  # we only take one input
+        self.started = monotonicNs()
+        self._startRound(1, vi)
+
+    def _reject(self, sender, msg, reason):
+        mylog("[%d] dropping BA message %r from %r for instance %d: %s" % (
+            self.pid, msg, sender, self.instance, reason), verboseLevel=-1)
+
+    def handle_message(self, sender, msg):
+        if self.terminated:
+            return  # stale traffic
+        try:
+            tag, (r, v) = msg
+        except (TypeError, ValueError):
+            return self._reject(sender, msg, 'malformed')
+        if not isinstance(sender, (int, long)) or not 0 <= sender < self.N:
+            return self._reject(sender, msg, 'unknown sender')
+        if not isinstance(r, (int, long)) or r < 1:
+            return self._reject(sender, msg, 'bad round')
+        if tag in ('B', 'A') and (not isinstance(v, (int, long)) or v not in (0, 1)):
+            return self._reject(sender, msg, 'not a binary value')
+        if tag == 'B':
+            self._onBV(sender, r, v)
+        elif tag == 'A':
+            if r < self.round:
+                return  # this round is over for us
+            votes = self.auxVotes.get(r)
+            if votes is None:
+                votes = self.auxVotes[r] = (VoteTally(), VoteTally(), VoteTally())
+            votes[v].add(sender)
+            votes[2].add(sender)
+            if r == self.round:
+                self._checkAux()
+        elif tag == 'C':
+            if r < self.round:
+                return
+            self.coinService.addShare(sender, r, v)  # v is the coin share
+        else:
+            self._reject(sender, msg, 'unknown tag')
+
+    def _terminate(self):
+        self.terminated = True
+        self.values = None
+        self.bvVotes = self.bvSent = self.binValues = None
+        self.auxVotes = self.coins = self.coinService = None
+        self.broadcast = self.decide = None
+
+    def _startRound(self, r, est):
+        self.round = r
+        self.est = est
+        self.values = None
+        self.auxSent = False
+        # Everything about the past rounds but BV_broadcast is no longer needed
+        for d in (self.auxVotes, self.coins):
+            for old in [x for x in d if x < r]:
+                del d[old]
+        self.coinService.forget(r - 1)
+        self._sendBV(r, est)
+        if self.binValues.get(r):
+            self._sendAux(self.binValues[r][0])
+
+    def _sendBV(self, r, v):
+        sent = self.bvSent.get(r, 0)
+        if not sent & (1 << v):
+            self.bvSent[r] = sent | (1 << v)
+            self.broadcast(('B', (r, v)))
+
+    def _onBV(self, sender, r, v):
+        binValues = self.binValues.setdefault(r, [])
+        if len(binValues) == 2:
+            return  # BV_broadcast of this round is over
+        votes = self.bvVotes.get(r)
+        if votes is None:
+            votes = self.bvVotes[r] = (VoteTally(), VoteTally())
+        if not votes[v].add(sender):
+            return  # duplicate
+        count = len(votes[v])
+        # Relay after reaching first threshold
+        if count >= self.t + 1:
+            self._sendBV(r, v)
+        # Output after reaching second threshold
+        if count >= 2 * self.t + 1 and v not in binValues:
+            binValues.append(v)
+            if len(binValues) == 2:
+                del self.bvVotes[r]  # We don't have to wait more
+            if r == self.round:
+                if not self.auxSent:
+                    self._sendAux(v)
+                else:
+                    self._checkAux()
+
+    def _sendAux(self, w):
+        self.auxSent = True
+        self.broadcast(('A', (self.round, w)))
+        self._checkAux()
+
+    def _checkAux(self):
+        if not self.auxSent or self.values is not None:
+            return
+        r = self.round
+        binValues = self.binValues[r]
+        if r not in self.auxVotes:
+            return
+        votes = self.auxVotes[r]
+        threshold = self.N - self.t
+        if len(binValues) == 1:
+            if len(votes[binValues[0]]) >= threshold:
+                self.values = list(binValues)
+        elif len(votes[2]) >= threshold:
+            self.values = list(binValues)
+        elif len(votes[0]) >= threshold:
+            self.values = [0]
+        elif len(votes[1]) >= threshold:
+            self.values = [1]
+        if self.values is not None:
+            self.broadcast(('C', (r, self.context.SK.sign(self.coinService.hash(r)))))
+            if r in self.coins:
+                self._advance(self.coins[r])
+
+    def _onCoin(self, r, coin):
+        if self.terminated or r < self.round:
+            return
+        self.coins[r] = coin
+        if r == self.round and self.values is not None:
+            self._advance(self.coins[r])
+
+    def _advance(self, s):
+        values = self.values
+        # Here corresponds to a proof that if one party decides at round r,
+        # then in all the following rounds, everybody will propose r as an estimation. (Lemma 2, Lemma 1)
+        if self.decided and self.decidedNum == s:  # infinite-message fix
+            self._terminate()
+            return
+        if len(values) == 1:
+            if values[0] == s and not self.decided:
+                # decide s
+                self.decided = True
+                self.decidedNum = s
+                self.context.phases.since('ba_decide', self.epoch, self.started)
+                self.context.phases.count('ba_rounds', self.epoch, self.round)
+                self.context.lastDecided = s
+                self.decide(s)
+            est = values[0]
+        else:
+            est = s
+        self._startRound(self.round + 1, est)
@@ -2,19 +2,20 @@ from gevent import monkey
 monkey.patch_all()
 
 from broadcasts import binary_consensus, initBeforeBinaryConsensus
+from binary_agreement import BinaryAgreement
 from utils import myRandom as random
 from gevent import Greenlet
 import gevent
 from gevent.queue import Queue
 # Run the BV_broadcast protocol with no corruptions and uniform random message delays
-from utils import MonitoredInt, ACSException, greenletPacker
+from utils import MonitoredInt, ACSException, greenletPacker, mylog
+from dispatch import Mailbox
 
-lockBA = Queue(1)
-defaultBA = []
-lockBA.put(1)
 
-
-def acs(pid, N, t, Q, broadcast, receive):
+def acs(pid, N, t, Q, broadcast, receive, context, epoch=0):
+    # context: my NodeContext, its eventDrivenBA picks the kind of binary agreement
+    if context.eventDrivenBA:
+        return eventDrivenAcs(pid, N, t, Q, broadcast, receive, context, epoch)
     assert(isinstance(Q, list))
     assert(len(Q) == N)
     decideChannel = [Queue(1) for _ in range(N)]
@@ -28,7 +29,7 @@ def acs(pid, N, t, Q, broadcast, receive):
                 receivedChannelsFlags.append(i)
                 # mylog('B[%d]binary consensus_%d_starts with 1 at %f' % (pid, i, time.time()), verboseLevel=-1)
                 greenletPacker(Greenlet(binary_consensus, i, pid,
-                    N, t, 1, decideChannel[i], make_bc(i), reliableBroadcastReceiveQueue[i].get),
+                    N, t, 1, decideChannel[i], make_bc(i), reliableBroadcastReceiveQueue[i].get, context, epoch),
                         'acs.callbackFactory.binary_consensus', (pid, N, t, Q, broadcast, receive)).start()
         return _callback
 
@@ -43,7 +44,7 @@ def acs(pid, N, t, Q, broadcast, receive):
             )
         return _bc
 
-    reliableBroadcastReceiveQueue = [Queue() for x in range(N)]
+    reliableBroadcastReceiveQueue = [Mailbox('acs.reliableBroadcastReceiveQueue[%d]' % x) for x in range(N)]
 
     def _listener():
         while True:
@@ -79,21 +80,84 @@ def acs(pid, N, t, Q, broadcast, receive):
         if not i in receivedChannelsFlags:
             receivedChannelsFlags.append(i)
             greenletPacker(Greenlet(binary_consensus, i, pid, N, t, 0,
-                     decideChannel[i], make_bc(i), reliableBroadcastReceiveQueue[i].get),
+                     decideChannel[i], make_bc(i), reliableBroadcastReceiveQueue[i].get, context, epoch),
                            'acs.binary_consensus', (pid, N, t, Q, broadcast, receive)).start()
     locker.get()  # Now we can check'''
     BA = checkBA(BA, N, t)
     return BA
 
+def eventDrivenAcs(pid, N, t, Q, broadcast, receive, context, epoch=0):
+    '''
+    Same as acs, but the N binary agreements are BinaryAgreement objects fed
+    by the listener, so the number of greenlets does not grow with N.
+    '''
+    assert(isinstance(Q, list))
+    assert(len(Q) == N)
+    BA = [0]*N
+    locker = Queue(1)
+    locker2 = Queue(1)
+    callbackCounter = [0]
+
+    def make_bc(i):
+        def _bc(m):
+            broadcast(
+                (i, m)
+            )
+        return _bc
+
+    def makeDecide(i):
+        def _decide(val):
+            BA[i] = val
+            if callbackCounter[0] >= 2*t and (not locker2.full()):
+                        locker2.put("Key")  # Now we've got 2t+1 1's
+            callbackCounter[0] += 1
+            if callbackCounter[0] == N and (not locker.full()):  # if we have all of them responded
+                        locker.put("Key")
+        return _decide
+
+    instances = [BinaryAgreement(i, pid, N, t, makeDecide(i), make_bc(i), context, epoch) for i in range(N)]
+
+    def callbackFactory(i):
+        def _callback(val): # Get notified for i
+            instances[i].input(1)
+        return _callback
+
+    for i, q in enumerate(Q):
+        assert(isinstance(q, MonitoredInt))
+        q.registerSetCallBack(callbackFactory(i))
+
+    def _listener():
+        # One listener for the N instances: what other parties send must not be able to stop it
+        while True:
+            sender, msg = receive()
+            try:
+                instance, m = msg
+            except (TypeError, ValueError):
+                mylog("[%d] dropping malformed ACS message %r from %r" % (pid, msg, sender), verboseLevel=-1)
+                continue
+            if not isinstance(instance, (int, long)) or not 0 <= instance < N:
+                mylog("[%d] dropping ACS message for instance %r from %r" % (pid, instance, sender), verboseLevel=-1)
+                continue
+            instances[instance].handle_message(sender, m)
+
+    greenletPacker(Greenlet(_listener), 'eventDrivenAcs._listener', (pid, N, t, Q, broadcast, receive)).start()
+
+    locker2.get()
+    # Now we feed 0 to all the other binary consensus protocols
+    for i in range(N):
+        instances[i].input(0)  # does nothing if it already got an input
+    locker.get()  # Now we can check
+    BA = checkBA(BA, N, t)
+    return BA
+
 def checkBA(BA, N, t):
-    global defaultBA
     if sum(BA) < N-t:  # If acs failed, we use a pre-set default common subset
         raise ACSException
     return BA
 
 
-def random_delay_acs(N, t, inputs):
-
+def random_delay_acs(N, t, inputs, contexts):
+    # contexts: the NodeContext of every party (see context.makeContexts)
     assert(isinstance(inputs, list))
 
     maxdelay = 0.01
@@ -124,7 +188,7 @@ def random_delay_acs(N, t, inputs):
             for j in range(N):
                 greenletPacker(Greenlet(modifyMonitoredInt, input_clone[j]),
                     'random_delay_acs.modifyMonitoredInt', (N, t, inputs)).start_later(maxdelay * random.random())
-            th = greenletPacker(Greenlet(acs, i, N, t, input_clone, bc, recv), 'random_delay_acs.acs', (N, t, inputs))
+            th = greenletPacker(Greenlet(acs, i, N, t, input_clone, bc, recv, contexts[i]), 'random_delay_acs.acs', (N, t, inputs))
             th.start() # start_later(random.random() * maxdelay) is not necessary here
             ts.append(th)
 
@@ -135,12 +199,51 @@ def random_delay_acs(N, t, inputs):
         except gevent.hub.LoopExit: # Manual fix for early stop
             print "End"
 
+def malformed_acs(N, t, contexts):
+    # eventDrivenAcs with the last party sending garbage along with its votes: the others still agree
+    maxdelay = 0.01
+    buffers = [Queue() for _ in range(N)]
+    garbage = [None, 'junk', (0,), (N, ('B', (1, 1))), (-1, ('B', (1, 1))), ('x', ('B', (1, 1))),
+               (0, None), (0, ('B', (1, 5))), (0, ('B', (0, 1))), (0, ('A', (1, [1]))), (0, ('Z', (1, 1))),
+               (0, ('B', 1)), (0, ('C', 'junk'))]
+
+    def makeBroadcast(i):
+        def _broadcast(v):
+            for j in range(N):
+                gevent.spawn_later(random.random() * maxdelay, buffers[j].put, (i, v))
+                if i == N - 1:
+                    for m in garbage:
+                        buffers[j].put((i, m))
+                    buffers[j].put((N + 3, v))  # and a sender that does not exist
+        return _broadcast
+
+    ts = []
+    for i in range(N):
+        inputs = [MonitoredInt() for _ in range(N)]
+        for j in range(N):
+            gevent.spawn_later(maxdelay * random.random(), setattr, inputs[j], 'data', 1)
+        ts.append(gevent.spawn(eventDrivenAcs, i, N, t, inputs, makeBroadcast(i), buffers[i].get, contexts[i]))
+    gevent.joinall(ts, timeout=60)
+    results = [th.value for th in ts[:N - 1]]
+    assert all(th.successful() for th in ts[:N - 1]), [th.exception for th in ts]
+    assert all(r == results[0] for r in results), results
+    assert all(contexts[i].lastDecided is not None for i in range(N - 1))
+    print "ACS with malformed messages agreed on", results[0]
+
+
 if __name__=='__main__':
     #initTor()
     print "[ =========== ]"
     print "Testing binary consensus..."
     print "Testing ACS with different inputs..."
+    # python -m HoneyBadgerBFT.core.bkr_acs thsig.keys thenc.keys ecdsa.keys
+    from context import loadContexts
+    from ..commoncoin.boldyreva_gipc import initialize as initializeGIPC
+    import sys
+    contexts = loadContexts(range(5), 5, 1, sys.argv[1], sys.argv[2], sys.argv[3])
+    initializeGIPC(contexts[0].PK, size=0)
     Q = [1]*(2*1+1+1)+[0]*1
     random.shuffle(Q)
-    random_delay_acs(5, 1, Q)
+    random_delay_acs(5, 1, Q, contexts)
+    malformed_acs(5, 1, contexts)
 
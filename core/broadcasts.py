@@ -2,8 +2,11 @@
 from gevent import Greenlet
 from gevent.queue import Queue
 from collections import defaultdict
-from utils import dummyCoin, greenletPacker, getKeys
-from ..commoncoin.boldyreva_gipc import serialize, deserialize1, combine_and_verify
+from utils import dummyCoin, greenletPacker
+from dispatch import Mailbox, Mailboxes
+from tally import VoteTally
+from coin import CoinService, CommonCoinFailureException
+from spans import monotonicNs
 
 
 verbose = 0
@@ -40,7 +43,7 @@ def bv_broadcast(pid, N, t, broadcast, receive, output, release=lambda: None):
                makeCallOnce(lambda: output(1)))
 
         # We'll relay each of (0,1) at most once
-        received = defaultdict(set)
+        received = (VoteTally(), VoteTally())
 
         def _bc(v):
             broadcast(v)
@@ -72,10 +75,7 @@ def bv_broadcast(pid, N, t, broadcast, receive, output, release=lambda: None):
 
     return input
 
-class CommonCoinFailureException(Exception):
-    pass
-
-def shared_coin(instance, pid, N, t, broadcast, receive):
+def shared_coin(instance, pid, N, t, broadcast, receive, context, epoch=0):
     '''
     A dummy version of the Shared Coin
     :param pid: my id number
@@ -83,35 +83,22 @@ def shared_coin(instance, pid, N, t, broadcast, receive):
     :param t: the number of byzantine parties
     :param broadcast: broadcast channel
     :param receive: receive channel
+    :param context: my NodeContext, with my share of the coin key
     :return: yield values b
     '''
-    received = defaultdict(set)
     outputQueue = defaultdict(lambda: Queue(1))
-    PK, SKs = getKeys()
+    coins = CoinService(instance, pid, N, t, lambda r, coin: outputQueue[r].put(coin), context, epoch)
     def _recv():
         while True:
-            # New shares for some round r
+            # New shares for some round r, the coin is made available
+            # locally after reaching the threshold
             (i, (r, sig)) = receive()
-            assert i in range(N)
-            assert r >= 0
-            received[r].add((i, serialize(sig)))
-
-            # After reaching the threshold, compute the output and
-            # make it available locally
-            if len(received[r]) == t + 1:
-                    h = PK.hash_message(str((r, instance)))
-                    def tmpFunc(r, t):
-                        # Verify and get the combined signature
-                        s = combine_and_verify(h, dict(tuple((t, deserialize1(sig)) for t, sig in received[r])[:t+1]))
-                        outputQueue[r].put(ord(s[0]) & 1)  # explicitly convert to int
-                    Greenlet(
-                        tmpFunc, r, t
-                    ).start()
+            coins.addShare(i, r, sig)
 
     greenletPacker(Greenlet(_recv), 'shared_coin_dummy', (pid, N, t, broadcast, receive)).start()
 
     def getCoin(round):
-        broadcast((round, SKs[pid].sign(PK.hash_message(str((round,instance))))))  # I have to do mapping to 1..l
+        broadcast((round, context.SK.sign(coins.hash(round))))  # I have to do mapping to 1..l
         return outputQueue[round].get()
 
     return getCoin
@@ -120,8 +107,6 @@ def shared_coin(instance, pid, N, t, broadcast, receive):
 def arbitary_adversary(pid, N, t, vi, broadcast, receive):
     pass  # TODO: implement our arbitrary adversaries
 
-globalState = defaultdict(str)  # Just for debugging
-
 def initBeforeBinaryConsensus(): # A dummy function now
     '''
     Initialize all the variables used by binary consensus.
@@ -131,7 +116,7 @@ def initBeforeBinaryConsensus(): # A dummy function now
     pass
 
 
-def mv84consensus(pid, N, t, vi, broadcast, receive):
+def mv84consensus(pid, N, t, vi, broadcast, receive, context):
     '''
     Implementation of the multivalue consensus of [TURPIN, COAN, 1984]
     This will achieve a consensus among all the inputs provided by honest parties,
@@ -142,6 +127,7 @@ def mv84consensus(pid, N, t, vi, broadcast, receive):
     :param vi: input value, an integer
     :param broadcast: broadcast channel
     :param receive: receive channel
+    :param context: my NodeContext
     :return: decided value or 0 (default value if failed to reach a concensus)
     '''
     # initialize v and p (same meaning as in the paper)
@@ -150,8 +136,8 @@ def mv84consensus(pid, N, t, vi, broadcast, receive):
     # Initialize the locks and local variables
     mv84WaiterLock = Queue()
     mv84WaiterLock2 = Queue()
-    mv84ReceiveDiff = set()
-    mv84GetPerplex = set()
+    mv84ReceiveDiff = VoteTally()
+    mv84GetPerplex = VoteTally()
     reliableBroadcastReceiveQueue = Queue()
 
     def _listener():  # Hard-working Router for this layer
@@ -192,7 +178,8 @@ def mv84consensus(pid, N, t, vi, broadcast, receive):
 
 
     decideChannel = Queue(1)
-    greenletPacker(Greenlet(binary_consensus, pid, N, t, alert, decideChannel, broadcast, reliableBroadcastReceiveQueue.get),
+    greenletPacker(Greenlet(binary_consensus, 0, pid, N, t, alert, decideChannel, broadcast,
+                            reliableBroadcastReceiveQueue.get, context),
         'mv84consensus.binary_consensus', (pid, N, t, vi, broadcast, receive)).start()
     agreedAlert = decideChannel.get()
 
@@ -202,21 +189,16 @@ def mv84consensus(pid, N, t, vi, broadcast, receive):
         return vi
 
 
-def checkFinishedWithGlobalState(N):
+def checkFinishedWithGlobalState(contexts):
     '''
     Check if binary consensus is finished
-    :param N: the number of parties
+    :param contexts: the NodeContexts of the parties
     :return: True if not finished, False if finished
     '''
-    if len(globalState.keys()) < N:
-        return True
-    for i in globalState:
-        if not globalState[i]:
-            return True
-    return False
+    return any(context.lastDecided is None for context in contexts)
 
 
-def binary_consensus(instance, pid, N, t, vi, decide, broadcast, receive):
+def binary_consensus(instance, pid, N, t, vi, decide, broadcast, receive, context, epoch=0):
     '''
     Binary consensus from [MMR 13]. It takes an input vi and will finally write the decided value into _decide_ channel.
     :param pid: my id number
@@ -226,12 +208,15 @@ def binary_consensus(instance, pid, N, t, vi, decide, broadcast, receive):
     :param decide: deciding channel
     :param broadcast: broadcast channel
     :param receive: receive channel
+    :param context: my NodeContext
+    :param epoch: the epoch this instance belongs to, which the coin depends on
     :return:
     '''
+    started = monotonicNs()
     # Messages received are routed to either a shared coin, the broadcast, or AUX
-    coinQ = Queue(1)
-    bcQ = defaultdict(lambda: Queue(1))
-    auxQ = defaultdict(lambda: Queue(1))
+    coinQ = Mailbox('binary_consensus[%d].coinQ' % instance)
+    bcQ = Mailboxes('binary_consensus[%d].bcQ[%%d]' % instance)
+    auxQ = Mailboxes('binary_consensus[%d].auxQ[%%d]' % instance)
 
     def _recv():
         while True:  #not finished[pid]:
@@ -239,18 +224,14 @@ def binary_consensus(instance, pid, N, t, vi, decide, broadcast, receive):
             if tag == 'B':
                 # Broadcast message
                 r, msg = m
-                greenletPacker(Greenlet(bcQ[r].put, (i, msg)),
-                    'binary_consensus.bcQ[%d].put' % r, (pid, N, t, vi, decide, broadcast, receive)).start() # In case they block the router
+                bcQ[r].put((i, msg))
             elif tag == 'C':
                 # A share of a coin
-                greenletPacker(Greenlet(coinQ.put, (i, m)),
-                    'binary_consensus.coinQ.put', (pid, N, t, vi, decide, broadcast, receive)).start()
+                coinQ.put((i, m))
             elif tag == 'A':
                 # Aux message
                 r, msg = m
-                greenletPacker(Greenlet(auxQ[r].put, (i, msg)),
-                      'binary_consensus.auxQ[%d].put' % r, (pid, N, t, vi, decide, broadcast, receive)).start()
-                pass
+                auxQ[r].put((i, msg))
 
     greenletPacker(Greenlet(_recv), 'binary_consensus._recv', (pid, N, t, vi, decide, broadcast, receive)).start()
 
@@ -260,9 +241,10 @@ def binary_consensus(instance, pid, N, t, vi, decide, broadcast, receive):
 
         return _recv
 
-    received = [defaultdict(set), defaultdict(set)]
+    received = [defaultdict(VoteTally), defaultdict(VoteTally)]
+    receivedAny = defaultdict(VoteTally)  # senders of AUX(0) or AUX(1)
 
-    coin = shared_coin(instance, pid, N, t, makeBroadcastWithTag('C', broadcast), coinQ.get)
+    coin = shared_coin(instance, pid, N, t, makeBroadcastWithTag('C', broadcast), coinQ.get, context, epoch)
 
     def getWithProcessing(r, binValues, callBackWaiter):
         def _recv(*args, **kargs):
@@ -270,6 +252,7 @@ def binary_consensus(instance, pid, N, t, vi, decide, broadcast, receive):
             assert v in (0, 1)
             assert sender in range(N)
             received[v][r].add(sender)
+            receivedAny[r].add(sender)
             # Check if conditions are satisfied
             threshold = N - t  # 2*t + 1 # N - t
             if True: #not finished[pid]:
@@ -278,7 +261,7 @@ def binary_consensus(instance, pid, N, t, vi, decide, broadcast, receive):
                         # Check passed
                         callBackWaiter[r].put(binValues)
                 elif len(binValues) == 2:
-                    if len(received[0][r].union(received[1][r])) >= threshold and not callBackWaiter[r].full():
+                    if len(receivedAny[r]) >= threshold and not callBackWaiter[r].full():
                         callBackWaiter[r].put(binValues)
                     elif len(received[0][r]) >= threshold and not callBackWaiter[r].full():
                         callBackWaiter[r].put([0])
@@ -338,7 +321,9 @@ def binary_consensus(instance, pid, N, t, vi, decide, broadcast, receive):
             if values[0] == s:
                 # decide s
                 if not decided:
-                    globalState[pid] = "%d" % s
+                    context.phases.since('ba_decide', epoch, started)
+                    context.phases.count('ba_rounds', epoch, round)
+                    context.lastDecided = s
                     decide.put(s)
                     decided = True
                     decidedNum = s
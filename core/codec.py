@@ -0,0 +1,182 @@
+import struct
+from ..commoncoin import boldyreva
+from ..threshenc.tpke import serialize, deserialize1
+
+# Wire codec for the protocol messages, same format as deepEncode/deepDecode.
+#
+# A message is a header (mc, f, t, type) and a fixed part, packed together
+# with one precompiled struct per type, followed by variable fields written
+# back to back. Encoding packs the head and joins it with the fields in a
+# single copy, instead of growing a BytesIO and reading it back. The big
+# fields (the transaction fragments of the 'i' and 'e' messages) can be kept
+# out of the copy: encodeBuffers returns them as separate buffers, to be
+# written after the ones before them.
+# Decoding unpacks straight out of the received buffer with unpack_from and
+# only slices out the fields it returns (zeroCopy leaves the fragments as
+# memoryview slices: fine for hashing, but not for pickling or joining).
+# A bundle tagged with its epoch, (epoch, bundle), is sent with the EPOCH_FLAG
+# bit set in the type and the epoch ('<I') right after the header.
+
+SHA_LENGTH = 32
+PAIRING_SERIALIZED_1 = 65
+GATHER_MIN = 1024  # fields from this size on are not copied by encodeBuffers
+
+EPOCH_FLAG = 0x80
+
+HEADER = struct.Struct('<IBBB')
+LENGTH = struct.Struct('<I')
+
+# Header (with or without the epoch) and fixed part of each message type
+_fixed = ((1, 'IB'), (2, 'BIB'), (3, 'BBB'), (4, 'BBB'), (5, 'BH'), (6, 'B'), (7, 'B'))
+_structs = dict((msgtype, struct.Struct('<IBBB' + fmt)) for msgtype, fmt in _fixed)
+_epochStructs = dict((msgtype, struct.Struct('<IBBBI' + fmt)) for msgtype, fmt in _fixed)
+
+class EncodeException(Exception):
+    pass
+
+class DecodeException(Exception):
+    pass
+
+def _layout(bundle):
+    # Returns (message type, fixed part values, variable fields)
+    if isinstance(bundle[0], int):
+        epoch, bundle = bundle
+        msgtype, values, fields = _layout(bundle)
+        return msgtype | EPOCH_FLAG, (epoch,) + values, fields
+    if bundle[0] == 'O':
+        _, shares = bundle
+        fields = []
+        for id, share in shares:
+            fields.append(chr(id))
+            fields.append(serialize(share))
+        return 7, (len(shares),), fields
+    tag, c = bundle
+    if c[0] == 'i':
+        _, (s, rh, mb), sig = c
+        return 1, (len(s), len(mb)), [s, rh] + list(mb) + [sig]
+    elif c[0] == 'e':
+        _, (p2, s, rh, mb), sig = c
+        return 2, (p2, len(s), len(mb)), [s, rh] + list(mb) + [sig]
+    elif c[0] == 'r':
+        _, p1, hm = c
+        return 6, (p1,), [hm]
+    p1, (t2, m2) = c
+    if t2 == 'B':
+        return 3, (p1,) + tuple(m2), []
+    elif t2 == 'A':
+        return 4, (p1,) + tuple(m2), []
+    elif t2 == 'C':
+        r, sig = m2
+        return 5, (p1, r), [boldyreva.serialize(sig)]
+    raise EncodeException()
+
+def _pack(mc, f, t, msgtype, values):
+    if msgtype & EPOCH_FLAG:
+        return _epochStructs[msgtype & ~EPOCH_FLAG].pack(mc, f, t, msgtype, *values)
+    return _structs[msgtype].pack(mc, f, t, msgtype, *values)
+
+def _join(mc, f, t, msgtype, values, fields, framed):
+    fields.insert(0, _pack(mc, f, t, msgtype, values))
+    if framed:
+        fields.insert(0, LENGTH.pack(sum(len(field) for field in fields)))
+    return ''.join(fields)
+
+def encodeBuffers(mc, m, framed=False, gatherMin=GATHER_MIN):
+    '''
+    Encodes (f, t, bundle) as a list of strings to be written in order.
+    :param framed: prefix the message with its length ('<I')
+    '''
+    f, t, bundle = m
+    msgtype, values, fields = _layout(bundle)
+    if gatherMin is None or not any(len(field) >= gatherMin for field in fields):
+        return [_join(mc, f, t, msgtype, values, fields, framed)]
+    # Runs of small fields, separated by the big ones
+    buffers, run = [], [_pack(mc, f, t, msgtype, values)]
+    for field in fields:
+        if len(field) >= gatherMin:
+            buffers.append(''.join(run))
+            buffers.append(field)
+            run = []
+        else:
+            run.append(field)
+    if run:
+        buffers.append(''.join(run))
+    if framed:
+        buffers[0] = LENGTH.pack(sum(len(buf) for buf in buffers)) + buffers[0]
+    return buffers
+
+def encodeMessage(mc, m, framed=False):
+    # The whole message as a single string
+    f, t, bundle = m
+    msgtype, values, fields = _layout(bundle)
+    return _join(mc, f, t, msgtype, values, fields, framed)
+
+def decodeMessage(m, msgTypeCounter=None, zeroCopy=False):
+    '''
+    Decodes a message from a str (or any buffer, which is then read through
+    a memoryview).
+    :returns: (mc, (f, t, bundle)), as deepDecode does
+    '''
+    if type(m) is str:
+        cut = m.__getslice__
+    else:
+        m = memoryview(m)
+        cut = lambda a, b: m[a:b].tobytes()
+    mc, f, t, msgtype = HEADER.unpack_from(m)
+    tagged = msgtype & EPOCH_FLAG
+    msgtype &= ~EPOCH_FLAG
+    if msgtype not in _structs:
+        raise DecodeException()
+    if msgTypeCounter is not None:
+        msgTypeCounter[msgtype][0] += 1
+        msgTypeCounter[msgtype][1] += len(m)
+    if tagged:
+        st = _epochStructs[msgtype]
+        values = st.unpack_from(m)
+        epoch, values = values[4], values[5:]
+    else:
+        st = _structs[msgtype]
+        values = st.unpack_from(m)[4:]
+    bundle = _decodeBundle(m, cut, msgtype, values, st.size, zeroCopy)
+    if tagged:
+        return mc, (f, t, (epoch, bundle))
+    return mc, (f, t, bundle)
+
+def _decodeBundle(m, cut, msgtype, values, pos, zeroCopy):
+    # values: the fixed part, pos: where the variable fields start
+    if msgtype == 1 or msgtype == 2:
+        if msgtype == 1:
+            lenS, nrBr = values
+        else:
+            p2, lenS, nrBr = values
+        if zeroCopy:
+            trSet = memoryview(m)[pos:pos + lenS]
+        else:
+            trSet = cut(pos, pos + lenS)
+        pos += lenS
+        rh = cut(pos, pos + SHA_LENGTH)
+        pos += SHA_LENGTH
+        mb = [cut(pos + k * SHA_LENGTH, pos + (k + 1) * SHA_LENGTH) for k in range(nrBr)]
+        sig = cut(pos + nrBr * SHA_LENGTH, len(m))
+        if msgtype == 1:
+            return ('B', ('i', (trSet, rh, mb), sig))
+        return ('B', ('e', (p2, trSet, rh, mb), sig))
+    elif msgtype == 3:
+        p1, p2, p3 = values
+        return ('A', (p1, ('B', (p2, p3))))
+    elif msgtype == 4:
+        p1, p2, p3 = values
+        return ('A', (p1, ('A', (p2, p3))))
+    elif msgtype == 5:
+        p1, r = values
+        return ('A', (p1, ('C', (r, boldyreva.deserialize1(cut(pos, len(m)))))))
+    elif msgtype == 6:
+        p1, = values
+        return ('B', ('r', p1, cut(pos, len(m))))
+    elif msgtype == 7:
+        count, = values
+        shares = []
+        for _ in range(count):
+            shares.append((ord(cut(pos, pos + 1)), deserialize1(cut(pos + 1, pos + 1 + PAIRING_SERIALIZED_1))))
+            pos += 1 + PAIRING_SERIALIZED_1
+        return ('O', tuple(shares))
@@ -0,0 +1,107 @@
+from gevent import Greenlet
+from collections import defaultdict
+from utils import greenletPacker, mylog
+from tally import VoteTally
+from spans import monotonicNs
+from ..commoncoin.boldyreva_gipc import try_combine_and_verify, verify_shares
+
+
+class CommonCoinFailureException(Exception):
+    pass
+
+
+def coinMessage(epoch, r, instance):
+    # What the shares of the coin sign, distinct for every epoch, round and instance
+    return str((epoch, r, instance))
+
+
+class CoinService(object):
+    '''
+    Combines the threshold signature shares of the common coin of one
+    binary agreement instance, round by round.
+
+    The first t+1 shares are combined optimistically. If the result does not
+    verify, the shares of that round are checked one by one on the worker
+    pool, and the combination is retried with t+1 shares known to be good,
+    waiting for more shares if needed. So a bad share delays the coin but
+    cannot block it.
+
+    :param instance: the index of the binary agreement instance
+    :param output: called with (round, coin value) once per round
+    :param context: my NodeContext, for the public key and the timings
+    :param epoch: the epoch the instance belongs to
+    '''
+    def __init__(self, instance, pid, N, t, output, context, epoch=0):
+        self.instance = instance
+        self.context = context
+        self.epoch = epoch
+        self.pid = pid
+        self.N = N
+        self.t = t
+        self.output = output
+        self.senders = defaultdict(VoteTally)
+        self.shares = defaultdict(dict)  # r -> {sender: share}
+        self.verified = dict()  # (instance, r, sender) -> whether the share is good
+        self.optimistic = dict()  # r -> whether the optimistic combine is still to be tried
+        self.running = set()  # rounds with a combining greenlet
+        self.done = set()  # rounds whose coin has been output
+        self.firstShare = dict()  # r -> when its first share came in
+
+    def hash(self, r):
+        return self.context.PK.hash_message(coinMessage(self.epoch, r, self.instance))
+
+    def addShare(self, sender, r, share):
+        assert 0 <= sender < self.N
+        assert r >= 0
+        if r in self.done or not self.senders[r].add(sender):
+            return  # only the first share of each party counts
+        self.shares[r][sender] = share
+        self.firstShare.setdefault(r, monotonicNs())
+        # After reaching the threshold, compute the output
+        if len(self.senders[r]) >= self.t + 1 and r not in self.running:
+            self.running.add(r)
+            greenletPacker(Greenlet(self._combine, r), 'CoinService._combine',
+                           (self.instance, self.pid, self.N, self.t)).start()
+
+    def forget(self, r):
+        # Drop everything about round r
+        self.senders.pop(r, None)
+        self.shares.pop(r, None)
+        self.optimistic.pop(r, None)
+        self.firstShare.pop(r, None)
+        for key in [key for key in self.verified if key[1] == r]:
+            del self.verified[key]
+
+    def _combine(self, r):
+        h = self.hash(r)
+        try:
+            while r in self.shares and r not in self.done:
+                shares = self.shares[r]
+                if self.optimistic.setdefault(r, True):
+                    self.optimistic[r] = False
+                    candidates = shares.keys()[:self.t + 1]
+                else:
+                    candidates = [i for i in shares if self.verified.get((self.instance, r, i))]
+                    if len(candidates) < self.t + 1:
+                        unchecked = dict((i, share) for i, share in shares.iteritems()
+                                         if (self.instance, r, i) not in self.verified)
+                        if not unchecked:
+                            return  # wait for more shares, addShare will start again
+                        for i, ok in verify_shares(h, unchecked).iteritems():
+                            self.verified[(self.instance, r, i)] = ok
+                            if not ok:
+                                mylog("[%d] bad coin share from %d for (%d, %d)" % (self.pid, i, self.instance, r),
+                                      verboseLevel=-1)
+                        continue
+                    candidates = candidates[:self.t + 1]
+                s = try_combine_and_verify(h, dict((i, shares[i]) for i in candidates))
+                if s is None:
+                    if all(self.verified.get((self.instance, r, i)) for i in candidates):
+                        raise CommonCoinFailureException()
+                    continue  # retry with a different subset
+                self.done.add(r)
+                if r in self.firstShare:
+                    self.context.phases.since('coin', self.epoch, self.firstShare.pop(r))
+                self.output(r, ord(s[0]) & 1)  # explicitly convert to int
+        finally:
+            self.running.discard(r)
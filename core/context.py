@@ -0,0 +1,72 @@
+import random
+from spans import Phases
+from utils import loadThresholdSig, loadThresholdEnc, loadECDSAKeys
+from ..ecdsa.ecdsa_ssl import KEY
+
+# What one party owns, handed down from honestParty to every protocol layer
+# instead of module globals: its own secret keys and everyone's public ones,
+# its configuration, where its timings go and its random generator. Parties
+# with their own contexts can share a process without sharing any state.
+
+EVENT_DRIVEN_BA = False  # run BinaryAgreement state machines instead of binary_consensus greenlets
+
+
+class NodeContext(object):
+    '''
+    :param PK: the public key of the threshold signature (common coin)
+    :param SK: my share of its private key
+    :param encPK: the public key of the threshold encryption
+    :param encSK: my share of its private key
+    :param ecdsaKey: my ECDSA key, to sign RBC messages
+    :param ecdsaPubKeys: everyone's ECDSA public key, indexed by pid
+    :param seed: the seed of rng, random if None
+    :param phases: where my phase timings go (spans.Phases), a registry of my own by default
+    '''
+    def __init__(self, pid, N, t, PK, SK, encPK, encSK, ecdsaKey, ecdsaPubKeys, seed=None, phases=None,
+                 eventDrivenBA=EVENT_DRIVEN_BA):
+        self.pid = pid
+        self.N = N
+        self.t = t
+        self.PK = PK
+        self.SK = SK
+        self.encPK = encPK
+        self.encSK = encSK
+        self.ecdsaKey = ecdsaKey
+        self.ecdsaPubKeys = ecdsaPubKeys
+        self.rng = random.Random(seed)
+        self.phases = Phases() if phases is None else phases
+        self.eventDrivenBA = eventDrivenBA
+        self.lastDecided = None  # the last value one of my binary consensus decided, for debugging
+
+
+def publicECDSAKeys(keys):
+    # Copies of the keys without their secret
+    result = []
+    for k in keys:
+        pub = KEY()
+        pub.set_pubkey(k.get_pubkey())
+        result.append(pub)
+    return result
+
+
+def makeContexts(pids, N, t, sigKeys, encKeys, ecdsaKeys, seed=None):
+    '''
+    One context for each of _pids_, holding only the secret keys of that party,
+    and its own phase timings.
+    :param sigKeys: (PK, SKs), as loaded by utils.loadThresholdSig
+    :param encKeys: (encPK, encSKs), as loaded by utils.loadThresholdEnc
+    :param ecdsaKeys: the ECDSA keys of all the parties, as loaded by utils.loadECDSAKeys
+    :param seed: party i gets seed + i
+    '''
+    PK, SKs = sigKeys
+    encPK, encSKs = encKeys
+    pubKeys = publicECDSAKeys(ecdsaKeys)  # shared, they are only read
+    return [NodeContext(pid, N, t, PK, SKs[pid], encPK, encSKs[pid], ecdsaKeys[pid], pubKeys,
+                        None if seed is None else seed + pid)
+            for pid in pids]
+
+
+def loadContexts(pids, N, t, sigFile, encFile, ecdsaFile, seed=None):
+    # makeContexts from the key files; the secrets of the other parties are not kept
+    return makeContexts(pids, N, t, loadThresholdSig(open(sigFile, 'r').read()),
+                        loadThresholdEnc(open(encFile, 'r').read()), loadECDSAKeys(open(ecdsaFile, 'r').read()), seed)
@@ -0,0 +1,196 @@
+from gevent.queue import Queue
+from collections import defaultdict
+import weakref
+from utils import mylog
+
+# Direct message dispatch for the protocol routers.
+# A router used to spawn one Greenlet per incoming message just to put it into
+# a Queue(1) without blocking itself. A Mailbox is unbounded instead, so put()
+# returns immediately, and it keeps track of how far its consumer lags behind.
+
+HIGH_WATER_MARK = 4096  # pending messages before a mailbox reports backpressure
+FUTURE_EPOCHS = 8  # how far past the floor messages for the epochs not open yet are kept
+FUTURE_BUFFER_SIZE = 8 << 20  # bytes of such messages kept from each sender
+
+allMailboxes = weakref.WeakSet()
+
+class Mailbox(object):
+    def __init__(self, name='mailbox', highWaterMark=HIGH_WATER_MARK):
+        self.name = name
+        self.queue = Queue()
+        self.highWaterMark = highWaterMark
+        self.delivered = 0  # messages put
+        self.consumed = 0  # messages taken out
+        self.peak = 0  # largest backlog seen
+        self.overflows = 0  # puts that happened above the high water mark
+        allMailboxes.add(self)
+
+    def put(self, item):
+        self.queue.put_nowait(item)  # never blocks: the queue is unbounded
+        self.delivered += 1
+        depth = self.delivered - self.consumed
+        if depth > self.peak:
+            self.peak = depth
+        if depth > self.highWaterMark:
+            if not self.overflows:
+                mylog("[%s] backlog of %d messages" % (self.name, depth), verboseLevel=-1)
+            self.overflows += 1
+
+    def get(self, *args, **kargs):
+        item = self.queue.get(*args, **kargs)
+        self.consumed += 1
+        return item
+
+    def pending(self):
+        return self.delivered - self.consumed
+
+    def __repr__(self):
+        return '<Mailbox %s delivered=%d pending=%d peak=%d>' % (
+            self.name, self.delivered, self.pending(), self.peak)
+
+
+class Mailboxes(dict):
+    '''
+    A dict of Mailboxes (e.g. one per round) that creates them on first use.
+    :param name: a format string for the mailbox names, filled with the key
+    '''
+    def __init__(self, name='mailbox[%s]', highWaterMark=HIGH_WATER_MARK):
+        super(Mailboxes, self).__init__()
+        self.name = name
+        self.highWaterMark = highWaterMark
+
+    def __missing__(self, key):
+        box = self[key] = Mailbox(self.name % (key,), self.highWaterMark)
+        return box
+
+
+def bundleSize(bundle):
+    # About the bytes a bundle took on the wire: its strings, and 8 for any other leaf
+    if isinstance(bundle, str):
+        return len(bundle)
+    if isinstance(bundle, (tuple, list)):
+        return sum(bundleSize(item) for item in bundle) + 4
+    return 8
+
+
+class EpochDispatcher(object):
+    '''
+    The top of the routing tree: epoch -> subprotocol -> instance -> round.
+    Each open epoch has a Mailbox of (sender, bundle), read by the router of
+    that epoch, which hands the bundles down to its subprotocols.
+
+    Messages for the epochs below the floor are stale and dropped right away,
+    and so are the ones for epochs _window_ or more past it. Messages for the
+    epochs in between that are not open yet are held until they open, up to
+    _maxBuffered_ bytes (see bundleSize) from each sender, so that a faulty
+    party can only fill its own share. When a sender is over its share, what
+    it sent for its furthest epoch goes first; a message for that epoch or a
+    nearer one is dropped itself when nothing further is left. The transport
+    has acknowledged the dropped messages, so they are lost: the first drop
+    for each epoch and sender is logged.
+    '''
+    def __init__(self, name='epoch', window=FUTURE_EPOCHS, maxBuffered=FUTURE_BUFFER_SIZE):
+        self.name = name
+        self.window = window
+        self.maxBuffered = maxBuffered
+        self.open = dict()  # epoch -> Mailbox
+        self.floor = 0  # the epochs below are over
+        self.newest = -1  # the newest epoch opened
+        self.future = defaultdict(list)  # epoch -> [(sender, bundle, size)], for the epochs not open yet
+        self.held = defaultdict(lambda: defaultdict(int))  # sender -> {epoch: bytes held}
+        self.senderBytes = defaultdict(int)  # sender -> bytes held
+        self.buffered = 0  # bytes held from all of them
+        self.stale = 0  # messages dropped for an epoch that is over
+        self.overflows = 0  # messages dropped for being too far ahead, or for lack of room
+        self.logged = set()  # (epoch, sender) of the drops logged, epochs within the window only
+
+    def mailbox(self, epoch):
+        # Opens an epoch, what was held for it is delivered first
+        if epoch not in self.open:
+            assert epoch >= self.floor
+            box = self.open[epoch] = Mailbox('%s[%d]' % (self.name, epoch))
+            for sender, bundle, size in self.future.pop(epoch, []):
+                box.put((sender, bundle))
+                self._release(sender, epoch, size)
+            self.newest = max(self.newest, epoch)
+        return self.open[epoch]
+
+    def _release(self, sender, epoch, size):
+        held = self.held[sender]
+        held[epoch] -= size
+        if not held[epoch]:
+            del held[epoch]
+        self.senderBytes[sender] -= size
+        self.buffered -= size
+
+    def _drop(self, sender, epoch, count, reason):
+        self.overflows += count
+        key = (min(epoch, self.floor + self.window), sender)  # every epoch past the window logs as one
+        if key not in self.logged:
+            self.logged.add(key)
+            mylog("[%s] dropping messages for epoch %d from %d: %s" % (self.name, epoch, sender, reason),
+                  verboseLevel=-1)
+
+    def _evict(self, sender, epoch):
+        # Drops what _sender_ sent for _epoch_
+        kept = []
+        for item in self.future[epoch]:
+            if item[0] == sender:
+                self._release(sender, epoch, item[2])
+            else:
+                kept.append(item)
+        self._drop(sender, epoch, len(self.future[epoch]) - len(kept),
+                   '%d bytes held from it, making room for nearer epochs' % self.senderBytes[sender])
+        if kept:
+            self.future[epoch] = kept
+        else:
+            del self.future[epoch]
+
+    def dispatch(self, sender, epoch, bundle):
+        # Returns whether the message was kept
+        if epoch < self.floor:
+            self.stale += 1
+            return False
+        box = self.open.get(epoch)
+        if box is not None:
+            box.put((sender, bundle))
+            return True
+        if epoch >= self.floor + self.window:
+            self._drop(sender, epoch, 1, '%d epochs past the floor %d' % (epoch - self.floor, self.floor))
+            return False
+        size = bundleSize(bundle)
+        held = self.held[sender]
+        while self.senderBytes[sender] + size > self.maxBuffered:
+            furthest = max(held) if held else None
+            if furthest is None or furthest <= epoch:
+                self._drop(sender, epoch, 1, '%d bytes held from it' % self.senderBytes[sender])
+                return False
+            self._evict(sender, furthest)
+        self.future[epoch].append((sender, bundle, size))
+        held[epoch] += size
+        self.senderBytes[sender] += size
+        self.buffered += size
+        return True
+
+    def retire(self, floor):
+        # Closes the epochs below floor: returns them, their messages from now on are stale
+        retired = [epoch for epoch in self.open if epoch < floor]
+        for epoch in retired:
+            del self.open[epoch]
+        for epoch in [epoch for epoch in self.future if epoch < floor]:
+            for sender, _, size in self.future.pop(epoch):
+                self._release(sender, epoch, size)
+        self.floor = max(self.floor, floor)
+        self.logged = set(key for key in self.logged if key[0] >= self.floor)
+        return retired
+
+    def __repr__(self):
+        return '<EpochDispatcher %s open=%s floor=%d buffered=%d stale=%d overflows=%d>' % (
+            self.name, sorted(self.open), self.floor, self.buffered, self.stale, self.overflows)
+
+
+def backpressureReport():
+    # (mailboxes alive, messages still pending, largest backlog, puts above the high water mark)
+    boxes = list(allMailboxes)
+    return (len(boxes), sum(box.pending() for box in boxes),
+            max([box.peak for box in boxes] or [0]), sum(box.overflows for box in boxes))
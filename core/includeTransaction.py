@@ -4,12 +4,21 @@ from gevent import Greenlet
 from gevent.queue import Queue, Empty
 from bkr_acs import acs
 from utils import mylog, MonitoredInt, callBackWrap, greenletFunction, \
-    greenletPacker, getEncKeys, Transaction, getECDSAKeys, sha1hash, TR_SIZE
+    greenletPacker, Transaction, sha1hash, TR_SIZE
 from collections import defaultdict
 import zfec
 import hashlib
 from ..threshenc.tpke import encrypt, decrypt
+from ..threshenc.tpke_gipc import decrypt_shares, combine_shares
 from utils import serializeEnc, deserializeEnc, ENC_SERIALIZED_LENGTH
+from ..ecdsa.ecdsa_gipc import verify_batch
+from merkle import MerkleTree, MerkleVerifier
+from zfec_gipc import reconstruct as reconstructFragments
+from dispatch import Mailbox, EpochDispatcher, FUTURE_EPOCHS
+from tally import VoteTally
+from mempool import Mempool, BATCH_MAX_WAIT
+from spans import monotonicNs
+from profiler import profiler
 import random
 import itertools
 import gevent
@@ -26,8 +35,6 @@ def calcMajority(dd):
             maxkey = key
     return maxkey
 
-Pubkeys = defaultdict(lambda : Queue(1) )
-
 class dummyPKI(object):
     @staticmethod
     def get_verifying_key():
@@ -46,101 +53,98 @@ def dummyHash(x):  # TODO: replace this guy with good ones
         return int(x.encode('hex'), 16)
     return x + 1
 
+VERIFY_BATCH_SIZE = 256  # max number of signed bundles checked in one go
+
 def coolSHA256Hash(x):
     if isinstance(x, int): x = str(x)
     return hashlib.sha256(x).digest()
 
 @greenletFunction
-def multiSigBr(pid, N, t, msg, broadcast, receive, outputs, send):
+def multiSigBr(pid, N, t, msg, broadcast, receive, outputs, send, context):
     # Since all the parties we have are symmetric, so I implement this function for N instances of A-cast as a whole
     # Here msg is a set of transactions
+    # My ECDSA key (from the context) signs the messages, everyone's public keys check them
     assert(isinstance(outputs, list))
     for i in outputs:
         assert(isinstance(i, Queue))
 
-    keys = getECDSAKeys()
+    myKey = context.ecdsaKey
     Threshold = N - 2 * t
     Threshold2 = N - t
     zfecEncoder = zfec.Encoder(Threshold, N)
-    zfecDecoder = zfec.Decoder(Threshold, N)
-
-    def merkleTree(strList, someHash = coolSHA256Hash):
-        # someHash is a mapping from a int to a int
-        treeLength = 2 ** ceil(math.log(len(strList)) / math.log(2))
-        mt = [0] * (treeLength * 2)  # find a place to put our leaves
-        for i in range(len(strList)):
-            mt[i + treeLength] = someHash(strList[i])  # TODO: need to change strList[i] from a string to an integer here.
-        for i in range(treeLength - 1, 0, -1):  # 1, 2, 3, ..., treeLength - 1
-            # mt[i] = someHash(''.join([chr(ord(a) ^ ord(b)) for a, b in zip(mt[i*2], mt[i*2+1])]))  # XOR is commutative
-            mt[i] = someHash(mt[i*2] + mt[i*2+1])  # concat is not commutative
-        return mt
-
-    def getMerkleBranch(index, mt):
-        res = []
-        t = index + (len(mt) >> 1)
-        while t > 1:
-            res.append(mt[t ^ 1])  # we are picking up the sibling
-            t /= 2
-        return res
-
-    def merkleVerify(val, rootHash, branch, someHash, index):
-        # index has information on whether we are facing a left sibling or a right sibling
-        tmp = someHash(val)
-        tindex = index
-        for br in branch:
-            tmp = someHash((tindex & 1) and br + tmp or tmp + br)
-            tindex >>= 1
-        if tmp != rootHash:
-            print "Verification failed with", someHash(val), rootHash, branch, tmp == rootHash
-        return tmp == rootHash
+
+    merkleVerifier = MerkleVerifier(N)  # shared by the N instances, caches proven nodes
+
+    def sigDigest(msgBundle):
+        if msgBundle[0] == 'i':
+            return sha1hash(''.join([msgBundle[1][0], msgBundle[1][1], ''.join(msgBundle[1][2])]))
+        return sha1hash(''.join([str(msgBundle[1][0]), msgBundle[1][1], msgBundle[1][2], ''.join(msgBundle[1][3])]))
+
+    verifiedQueue = Queue()
+
+    def Verifier():
+        # Gathers whatever 'i' and 'e' messages are pending for all the N instances,
+        # checks their signatures as one batch and only hands the valid ones to the Listener
+        while True:
+            pending = [receive()]
+            while len(pending) < VERIFY_BATCH_SIZE:
+                try:
+                    pending.append(receive(block=False))
+                except Empty:
+                    break
+            batch = [(sender, sigDigest(msgBundle), msgBundle[2]) for sender, msgBundle in pending
+                     if msgBundle[0] in ('i', 'e')]
+            results = iter(verify_batch(batch, context.ecdsaPubKeys))
+            for sender, msgBundle in pending:
+                if msgBundle[0] in ('i', 'e') and not next(results):
+                    mylog("[%d] dropping %s message from %d with a bad signature" % (pid, msgBundle[0], sender),
+                          verboseLevel=-1)
+                    continue
+                verifiedQueue.put((sender, msgBundle))
+
+    rootHashes = dict()
 
     def Listener():
         opinions = [defaultdict(lambda: 0) for _ in range(N)]
-        rootHashes = dict()
-        readyCounter = [defaultdict(lambda: 0) for _ in range(N)]
+        readyCounter = [defaultdict(VoteTally) for _ in range(N)]
         signed = [False]*N
         readySent = [False] * N
         reconstDone = [False] * N
         while True:  # main loop
-            sender, msgBundle = receive()
+            sender, msgBundle = verifiedQueue.get()
             if msgBundle[0] == 'i' and not signed[sender]:
-                if keys[sender].verify(sha1hash(''.join([msgBundle[1][0], msgBundle[1][1], ''.join(msgBundle[1][2])])), msgBundle[2]):
-                    assert isinstance(msgBundle[1], tuple)
-                    if not merkleVerify(msgBundle[1][0], msgBundle[1][1], msgBundle[1][2], coolSHA256Hash, pid):
-                        continue
-                    if sender in rootHashes:
-                        if rootHashes[sender]!= msgBundle[1][1]:
-                            print "Cheating caught, exiting"
-                            sys.exit(0)
-                    else:
-                        rootHashes[sender] = msgBundle[1][1]
-                    newBundle = (sender, msgBundle[1][0], msgBundle[1][1], msgBundle[1][2])  # assert each frag has a length of step
-                    broadcast(('e', newBundle, keys[pid].sign(
-                        sha1hash(''.join([str(newBundle[0]), newBundle[1], newBundle[2], ''.join(newBundle[3])]))
-                    )))
-                    signed[sender] = True
+                assert isinstance(msgBundle[1], tuple)
+                if not merkleVerifier.verify(msgBundle[1][0], msgBundle[1][1], msgBundle[1][2], pid):
+                    continue
+                if sender in rootHashes:
+                    if rootHashes[sender]!= msgBundle[1][1]:
+                        print "Cheating caught, exiting"
+                        sys.exit(0)
                 else:
-                    raise ECDSASignatureError()
-            elif msgBundle[0] == 'e':
-                if keys[sender].verify(sha1hash(''.join([str(msgBundle[1][0]), msgBundle[1][1], msgBundle[1][2], ''.join(msgBundle[1][3])])), msgBundle[2]):
-                    originBundle = msgBundle[1]
-                    if not merkleVerify(originBundle[1], originBundle[2], originBundle[3], coolSHA256Hash, sender):
-                        continue
-                    if originBundle[0] in rootHashes:
-                        if rootHashes[originBundle[0]]!= originBundle[2]:
-                            print "Cheating caught, exiting"
-                            sys.exit(0)
-                    else:
-                        rootHashes[originBundle[0]] = originBundle[2]
-                    opinions[originBundle[0]][sender] = originBundle[1]   # We are going to move this part to kekeketktktktk
-                    if len(opinions[originBundle[0]]) >= Threshold2 and not readySent[originBundle[0]]:
-                            readySent[originBundle[0]] = True
-                            broadcast(('r', originBundle[0], originBundle[2]))  # We are broadcasting its hash
+                    rootHashes[sender] = msgBundle[1][1]
+                newBundle = (sender, msgBundle[1][0], msgBundle[1][1], msgBundle[1][2])  # assert each frag has a length of step
+                broadcast(('e', newBundle, myKey.sign(
+                    sha1hash(''.join([str(newBundle[0]), newBundle[1], newBundle[2], ''.join(newBundle[3])]))
+                )))
+                signed[sender] = True
+            elif msgBundle[0] == 'e':  # signature already checked by the Verifier
+                originBundle = msgBundle[1]
+                if not merkleVerifier.verify(originBundle[1], originBundle[2], originBundle[3], sender):
+                    continue
+                if originBundle[0] in rootHashes:
+                    if rootHashes[originBundle[0]]!= originBundle[2]:
+                        print "Cheating caught, exiting"
+                        sys.exit(0)
                 else:
-                    raise ECDSASignatureError()
+                    rootHashes[originBundle[0]] = originBundle[2]
+                opinions[originBundle[0]][sender] = originBundle[1]   # We are going to move this part to kekeketktktktk
+                if len(opinions[originBundle[0]]) >= Threshold2 and not readySent[originBundle[0]]:
+                        readySent[originBundle[0]] = True
+                        broadcast(('r', originBundle[0], originBundle[2]))  # We are broadcasting its hash
             elif msgBundle[0] == 'r':
-                readyCounter[msgBundle[1]][msgBundle[2]] += 1
-                tmp = readyCounter[msgBundle[1]][msgBundle[2]]
+                if not readyCounter[msgBundle[1]][msgBundle[2]].add(sender):
+                    continue  # a party only counts once
+                tmp = len(readyCounter[msgBundle[1]][msgBundle[2]])
                 if tmp >= t+1 and not readySent[msgBundle[1]]:
                     readySent[msgBundle[1]] = True
                     broadcast(('r', msgBundle[1], msgBundle[2]))
@@ -153,24 +157,24 @@ def multiSigBr(pid, N, t, msg, broadcast, receive, outputs, send):
                             sys.exit(0)
                     else:
                         rootHashes[msgBundle[1]] = msgBundle[2]
-                    if opinions[msgBundle[1]].values()[0] == '':
-                        reconstruction = ['']
-                    else:
-                        reconstruction = zfecDecoder.decode(opinions[msgBundle[1]].values()[:Threshold],
-                                opinions[msgBundle[1]].keys()[:Threshold])  # We only take the first [Threshold] fragments
-                    rawbuf = ''.join(reconstruction)
-                    buf = rawbuf[:-ord(rawbuf[-1])]
-                    # Check root hash
-                    step = len(buf) / Threshold + 1 # len(buf) % Threshold == 0 and len(buf) / Threshold or (len(buf) / Threshold + 1)
-                    assert step * Threshold - len(buf) < 256  # assumption
-                    buf_ = buf.ljust(step * Threshold - 1, '\xFF') + chr(step * Threshold - len(buf))
-                    fragList = [buf_[i*step : (i+1)*step] for i in range(Threshold)]
-                    encodedFragList = zfecEncoder.encode(fragList)
-                    mt = merkleTree(encodedFragList, coolSHA256Hash)
-                    assert rootHashes[msgBundle[1]] == mt[1]  # full binary tree
-                    if outputs[msgBundle[1]].empty():
-                        outputs[msgBundle[1]].put(buf)
-
+                    greenletPacker(Greenlet(reconstruct, msgBundle[1], opinions[msgBundle[1]].items()[:Threshold]),
+                        'multiSigBr.reconstruct', (pid, N, t, msg, broadcast, receive, outputs)).start()
+
+    def reconstruct(instance, fragments):
+        # We only take the first [Threshold] fragments
+        nums, blocks = zip(*fragments)
+        held = dict(fragments)
+        primary, reencoded = reconstructFragments(Threshold, N, list(blocks), nums)
+        # Check root hash: the code is systematic, so re-encoding the fragments we hold would give them back,
+        # only the others are encoded again. All N are hashed here, the held ones included.
+        leaves = [held[i] if i in held else reencoded[i] for i in range(N)]
+        assert merkleVerifier.verifyLeaves(rootHashes[instance], leaves)
+        rawbuf = ''.join(primary)
+        buf = rawbuf[:-ord(rawbuf[-1])]
+        if outputs[instance].empty():
+            outputs[instance].put(buf)
+
+    greenletPacker(Greenlet(Verifier), 'multiSigBr.Verifier', (pid, N, t, msg, broadcast, receive, outputs)).start()
     greenletPacker(Greenlet(Listener), 'multiSigBr.Listener', (pid, N, t, msg, broadcast, receive, outputs)).start()
     buf = msg  # We already assumed the proposals are byte strings
 
@@ -179,16 +183,16 @@ def multiSigBr(pid, N, t, msg, broadcast, receive, outputs, send):
     buf = buf.ljust(step * Threshold - 1, '\xFF') + chr(step * Threshold - len(buf))
     fragList = [buf[i*step : (i+1)*step] for i in range(Threshold)]
     encodedFragList = zfecEncoder.encode(fragList)
-    mt = merkleTree(encodedFragList, coolSHA256Hash)
-    rootHash = mt[1]  # full binary tree
+    mt = MerkleTree(encodedFragList)
+    rootHash = mt.root()
     for i in range(N):
-        mb = getMerkleBranch(i, mt)  # notice that index starts from 1 and pid starts from 0
+        mb = mt.branch(i)  # notice that index starts from 1 and pid starts from 0
         newBundle = (encodedFragList[i], rootHash, mb)
-        send(i, ('i', newBundle, keys[pid].sign(sha1hash(''.join([newBundle[0], newBundle[1], ''.join(newBundle[2])])))))
+        send(i, ('i', newBundle, myKey.sign(sha1hash(''.join([newBundle[0], newBundle[1], ''.join(newBundle[2])])))))
 
 @greenletFunction
-def consensusBroadcast(pid, N, t, msg, broadcast, receive, outputs, send, method=multiSigBr):
-    return method(pid, N, t, msg, broadcast, receive, outputs, send)
+def consensusBroadcast(pid, N, t, msg, broadcast, receive, outputs, send, context, method=multiSigBr):
+    return method(pid, N, t, msg, broadcast, receive, outputs, send, context)
 
 
 def union(listOfTXSet):
@@ -199,9 +203,10 @@ def union(listOfTXSet):
 
 # tx is the transaction we are going to include
 @greenletFunction
-def includeTransaction(pid, N, t, setToInclude, broadcast, receive, send):
-    CBChannel = Queue()
-    ACSChannel = Queue()
+def includeTransaction(pid, N, t, setToInclude, broadcast, receive, send, context, epoch=0):
+    started = monotonicNs()
+    CBChannel = Mailbox('includeTransaction.CBChannel')
+    ACSChannel = Mailbox('includeTransaction.ACSChannel')
     TXSet = [{} for _ in range(N)]
 
     def make_bc_br(i):
@@ -223,17 +228,15 @@ def includeTransaction(pid, N, t, setToInclude, broadcast, receive, send):
         while True:
             sender, (tag, m) = receive()
             if tag == 'B':
-                greenletPacker(Greenlet(CBChannel.put, (sender, m)),
-                    'includeTransaction.CBChannel.put', (pid, N, t, setToInclude, broadcast, receive)).start()
+                CBChannel.put((sender, m))
             elif tag == 'A':
-                greenletPacker(Greenlet(ACSChannel.put,
-                    (sender, m)
-                ), 'includeTransaction.ACSChannel.put', (pid, N, t, setToInclude, broadcast, receive)).start()
+                ACSChannel.put((sender, m))
 
     outputChannel = [Queue(1) for _ in range(N)]
 
     def outputCallBack(i):
         TXSet[i] = outputChannel[i].get()
+        context.phases.since('rbc', epoch, started)
         monitoredIntList[i].data = 1
 
     for i in range(N):
@@ -249,123 +252,217 @@ def includeTransaction(pid, N, t, setToInclude, broadcast, receive, send):
         'includeTransaction._listener', (pid, N, t, setToInclude, broadcast, receive)).start()
 
     locker = Queue(1)
-    includeTransaction.callbackCounter = 0
     monitoredIntList = [MonitoredInt() for _ in range(N)]
 
-    greenletPacker(Greenlet(consensusBroadcast, pid, N, t, setToInclude, make_bc_br(pid), CBChannel.get, outputChannel, make_bc_send(pid)),
+    greenletPacker(Greenlet(consensusBroadcast, pid, N, t, setToInclude, make_bc_br(pid), CBChannel.get, outputChannel, make_bc_send(pid),
+                            context),
         'includeTransaction.consensusBroadcast', (pid, N, t, setToInclude, broadcast, receive)).start()
-    greenletPacker(Greenlet(callBackWrap(acs, callbackFactoryACS()), pid, N, t, monitoredIntList, make_acs_br(pid), ACSChannel.get),
+    greenletPacker(Greenlet(callBackWrap(acs, callbackFactoryACS()), pid, N, t, monitoredIntList, make_acs_br(pid), ACSChannel.get, context, epoch),
         'includeTransaction.callBackWrap(acs, callbackFactoryACS())', (pid, N, t, setToInclude, broadcast, receive)).start()
 
     commonSet = locker.get()
+    context.phases.since('acs', epoch, started)
     return commonSet, TXSet
 
 HONEST_PARTY_TIMEOUT = 1
+PIPELINE_DEPTH = 2  # epochs in progress at once
 
 import time, sys
-lock = Queue()
-finishcount = 0
-lock.put(1)
+from gevent.lock import BoundedSemaphore
+
+
+class EpochState(object):
+    '''
+    What honestParty keeps for one epoch: the channel of its includeTransaction
+    instance, and the decryption shares of the proposals.
+    '''
+    def __init__(self, epoch):
+        self.epoch = epoch
+        self.channel = Mailbox('honestParty.epoch%d' % epoch)
+        self.router = None
+        self.proposals = None  # set once ACS is over
+        self.encCounter = defaultdict(lambda : {})
+        self.locks = defaultdict(lambda : Queue(1))
+        self.doneCombination = defaultdict(lambda : False)
+
 
 @greenletFunction
-def honestParty(pid, N, t, controlChannel, broadcast, receive, send, B = -1):
+def honestParty(pid, N, t, controlChannel, broadcast, receive, send, context, B = -1, transport=None,
+                maxWait=BATCH_MAX_WAIT, pipelineDepth=PIPELINE_DEPTH, maxEpochs=None, onCommit=None):
     # RequestChannel is called by the client and it is the client's duty to broadcast the tx it wants to include
+    # With maxEpochs, the party returns once it has committed that many epochs. onCommit(epoch, txs) is
+    # called for every epoch committed.
+    # Every message is tagged with its epoch: (epoch, bundle). Up to pipelineDepth epochs run at once, so the
+    # RBC and ACS of epoch r+1 overlap with the threshold decryption of epoch r.
+    # context is my NodeContext: my keys, where my timings go, my random generator.
+    if transport is not None:  # a core.transport.Transport stands for the three channels
+        broadcast, receive, send = transport.broadcast, transport.receive, transport.send
     if B < 0:
         B = int(math.ceil(N * math.log(N)))
-    transactionCache = []
-    finishedTx = set()
-    proposals = []
-    receivedProposals = False
-    commonSet = []
-    locks = defaultdict(lambda : Queue(1))
-    doneCombination = defaultdict(lambda : False)
+    mempool = Mempool()
+    phases = context.phases
+    committedCount = [0]  # tx committed so far; the same tx committed in two epochs counts twice
     ENC_THRESHOLD = N - 2 * t
-    global finishcount
-    encPK, encSKs = getEncKeys()
-    encCounter = defaultdict(lambda : {})
-    includeTransactionChannel = Queue()
-
-    def probe(i):
-        if len(encCounter[i]) >= ENC_THRESHOLD and receivedProposals and not locks[i].full() and not doneCombination[i]:  # by == this part only executes once.
-            oriM = encPK.combine_shares(deserializeEnc(proposals[i][:ENC_SERIALIZED_LENGTH]),
-                                        dict(itertools.islice(encCounter[i].iteritems(), ENC_THRESHOLD))
-                                        )
-            doneCombination[i] = True
-            locks[i].put(oriM)
-
-    def listener():
+    encPK = context.encPK
+    # The floor is pipelineDepth epochs behind the last commit: 2 * pipelineDepth epochs can be open
+    dispatcher = EpochDispatcher('honestParty[%d]' % pid, window=2 * pipelineDepth + FUTURE_EPOCHS)
+    epochs = dict()  # epoch -> EpochState, for the open epochs
+    lastCommitted = [-1]
+    slots = BoundedSemaphore(pipelineDepth)
+
+    def openEpoch(epoch):
+        state = epochs[epoch] = EpochState(epoch)
+        profiler.enterEpoch(epoch)
+        state.router = greenletPacker(Greenlet(route, state, dispatcher.mailbox(epoch)),
+                                      'honestParty.route', (pid, N, t, B, epoch))
+        state.router.start()
+        return state
+
+    def combine(state, ready):
+        # All the proposals that got enough shares at once go to the pool as one batch
+        with phases.span('tpke_combine', state.epoch):
+            oriMs = combine_shares([(deserializeEnc(state.proposals[i][:ENC_SERIALIZED_LENGTH]),
+                                     dict(itertools.islice(state.encCounter[i].iteritems(), ENC_THRESHOLD)))
+                                    for i in ready], encPK)
+        for i, oriM in zip(ready, oriMs):
+            state.locks[i].put(oriM)
+
+    def probe(state, indices):
+        if state.proposals is None:
+            return
+        ready = [i for i in indices if len(state.encCounter[i]) >= ENC_THRESHOLD and not state.locks[i].full()
+                 and not state.doneCombination[i]]
+        for i in ready:
+            state.doneCombination[i] = True  # by == this part only executes once.
+        if ready:
+            greenletPacker(Greenlet(combine, state, ready), 'honestParty.combine', (pid, N, t, B, state.epoch)).start()
+
+    def route(state, mailbox):
+        # The messages of one epoch: decryption shares, and the rest for includeTransaction
         while True:
-            sender, msgBundle = receive()
+            sender, msgBundle = mailbox.get()
             if msgBundle[0] == 'O':
-                encCounter[msgBundle[1]][sender] = msgBundle[2]
-                probe(msgBundle[1])
+                for i, share in msgBundle[1]:
+                    if sender not in state.encCounter[i]:
+                        state.encCounter[i][sender] = share
+                probe(state, [i for i, _ in msgBundle[1]])
             else:
-                includeTransactionChannel.put((sender, msgBundle))  # redirect to includeTransaction
+                state.channel.put((sender, msgBundle))  # redirect to includeTransaction
+
+    def listener():
+        while True:
+            sender, (epoch, msgBundle) = receive()
+            dispatcher.dispatch(sender, epoch, msgBundle)  # stale ones are dropped here
 
     Greenlet(listener).start()
 
-    while True:
+    def controller():
+        while True:
             op, msg = controlChannel.get()
             if op == "IncludeTransaction":
                 if isinstance(msg, Transaction):
-                    # transactionCache.add(msg)
-                    transactionCache.append(msg)
-                elif isinstance(msg, set):
-                    for tx in msg:
-                        transactionCache.append(tx)
-                elif isinstance(msg, list):
-                    transactionCache.extend(msg)
+                    mempool.add(msg)
+                elif isinstance(msg, (set, list)):
+                    mempool.extend(msg)
             elif op == "Halt":
+                mempool.close()
                 break
             elif op == "Msg":
                 broadcast(eval(msg))  # now the msg is something we mannually send
-            mylog("timestampB (%d, %lf)" % (pid, time.time()), verboseLevel=-2)
-            if len(transactionCache) < B:  # Let's wait for many transactions. : )
-                time.sleep(0.5)
-                print "Not enough transactions", len(transactionCache)
-                continue
-
-            oldest_B = transactionCache[:B]
-            selected_B = random.sample(oldest_B, min(B/N, len(oldest_B)))
-            print "[%d] proposing %d transactions" % (pid, min(B/N, len(oldest_B)))
+
+    greenletPacker(Greenlet(controller), 'honestParty.controller', (pid, N, t, B)).start()
+
+    def epochChannels(epoch):
+        def _broadcast(m):
+            broadcast((epoch, m))
+        def _send(j, m):
+            send(j, (epoch, m))
+        return _broadcast, _send
+
+    def finishEpoch(epoch, selected_B, commonSet, started, previous):
+        # Threshold decryption of the proposals ACS picked, then commit once the previous epoch (the
+        # finisher _previous_) has: the decryption of the epochs overlaps, their commits are in order
+        state = epochs[epoch]
+        proposals = state.proposals
+        probe(state, range(N))
+        # All my decryption shares are computed in one pass and sent in a single message
+        accepted = [i for i, c in enumerate(commonSet) if c]  # stx is the same for every party
+        with phases.span('tpke_shares', epoch):
+            shares = decrypt_shares(context.encSK,
+                                    [deserializeEnc(proposals[i][:ENC_SERIALIZED_LENGTH]) for i in accepted])
+        broadcast((epoch, ('O', tuple(zip(accepted, shares)))))
+        mylog("timestampIE2 (%d, %d, %lf)" % (pid, epoch, time.time()), verboseLevel=-2)
+        recoveredSyncedTxList = []
+        def prepareTx(i):
+            rec = state.locks[i].get()
+            with phases.span('aes_decrypt', epoch):
+                encodedTxSet = decrypt(rec, proposals[i][ENC_SERIALIZED_LENGTH:])
+            assert len(encodedTxSet) % TR_SIZE == 0
+            recoveredSyncedTx = [encodedTxSet[i:i+TR_SIZE] for i in range(0, len(encodedTxSet), TR_SIZE)]
+            recoveredSyncedTxList.append(recoveredSyncedTx)
+        thList = []
+        for i in accepted:
+            s = Greenlet(prepareTx, i)
+            thList.append(s)
+            s.start()
+        gevent.joinall(thList)
+        mylog("timestampE (%d, %d, %lf)" % (pid, epoch, time.time()), verboseLevel=-2)
+        if previous is not None:
+            previous.join()
+        assert epoch == lastCommitted[0] + 1, "epoch %d committed after %d" % (epoch, lastCommitted[0])
+        lastCommitted[0] = epoch
+        # Committed transactions leave the pool, the rest of my proposal can be proposed again
+        syncedTx = set()
+        for rtx in recoveredSyncedTxList:
+            syncedTx.update(rtx)
+        committedCount[0] += len(syncedTx)
+        mempool.remove(syncedTx)
+        mempool.release(selected_B, owner=epoch)
+        phases.since('epoch', epoch, started)
+        # The states of old epochs go, late messages for them are dropped. An epoch is kept a while after
+        # it is committed, so that it still answers the parties that are behind.
+        for old in dispatcher.retire(epoch + 1 - pipelineDepth):
+            epochs.pop(old).router.kill(block=False)
+        slots.release()
+
+        mylog("[%d] epoch %d: %d tx committed so far and %d tx left in the pool." % (
+            pid, epoch, committedCount[0], len(mempool)), verboseLevel=-2)
+        if onCommit is not None:
+            onCommit(epoch, syncedTx)
+
+    finishers = []
+    finisher = None
+    epoch = 0
+    while maxEpochs is None or epoch < maxEpochs:
+            slots.acquire()  # at most pipelineDepth epochs in progress
+            # Propose as soon as B transactions are in, or a partial batch after maxWait
+            if not mempool.waitForBatch(B, maxWait):
+                break  # halted
+            mylog("timestampB (%d, %d, %lf)" % (pid, epoch, time.time()), verboseLevel=-2)
+            started = monotonicNs()
+            pending = mempool.pending()
+            if pending < B:
+                print "[%d] proposing a partial batch, %d of %d transactions" % (pid, pending, B)
+
+            # Transactions still in flight in an earlier epoch are not picked again
+            selected_B = mempool.take(B, min(B/N, pending), context.rng, owner=epoch)
+            print "[%d] proposing %d transactions in epoch %d" % (pid, len(selected_B), epoch)
             aesKey = random._urandom(32)  #
             encrypted_B = encrypt(aesKey, ''.join(selected_B))
             encryptedAESKey = encPK.encrypt(aesKey)
             proposal = serializeEnc(encryptedAESKey) + encrypted_B
-            mylog("timestampIB (%d, %lf)" % (pid, time.time()), verboseLevel=-2)
-            commonSet, proposals = includeTransaction(pid, N, t, proposal, broadcast, includeTransactionChannel.get, send)
-            mylog("timestampIE (%d, %lf)" % (pid, time.time()), verboseLevel=-2)
-            receivedProposals = True
-            for i in range(N):
-                probe(i)
-            for i, c in enumerate(commonSet):  # stx is the same for every party
-                if c:
-                    share = encSKs[pid].decrypt_share(deserializeEnc(proposals[i][:ENC_SERIALIZED_LENGTH]))
-                    broadcast(('O', i, share))
-            mylog("timestampIE2 (%d, %lf)" % (pid, time.time()), verboseLevel=-2)
-            recoveredSyncedTxList = []
-            def prepareTx(i):
-                rec = locks[i].get()
-                encodedTxSet = decrypt(rec, proposals[i][ENC_SERIALIZED_LENGTH:])
-                assert len(encodedTxSet) % TR_SIZE == 0
-                recoveredSyncedTx = [encodedTxSet[i:i+TR_SIZE] for i in range(0, len(encodedTxSet), TR_SIZE)]
-                recoveredSyncedTxList.append(recoveredSyncedTx)
-            thList = []
-            for i, c in enumerate(commonSet):  # stx is the same for every party
-                if c:
-                    s = Greenlet(prepareTx, i)
-                    thList.append(s)
-                    s.start()
-            gevent.joinall(thList)
-            mylog("timestampE (%d, %lf)" % (pid, time.time()), verboseLevel=-2)
-            for rtx in recoveredSyncedTxList:
-                finishedTx.update(set(rtx))
-
-            mylog("[%d] %d distinct tx synced and %d tx left in the pool." % (pid, len(finishedTx), len(transactionCache) - len(finishedTx)), verboseLevel=-2)
-            lock.get()
-            finishcount += 1
-            lock.put(1)
-            if finishcount >= N - t:  # convenient for local experiments
-                sys.exit()
+            mylog("timestampIB (%d, %d, %lf)" % (pid, epoch, time.time()), verboseLevel=-2)
+            state = openEpoch(epoch)
+            epochBroadcast, epochSend = epochChannels(epoch)
+            commonSet, state.proposals = includeTransaction(pid, N, t, proposal, epochBroadcast, state.channel.get,
+                                                            epochSend, context, epoch=epoch)
+            mylog("timestampIE (%d, %d, %lf)" % (pid, epoch, time.time()), verboseLevel=-2)
+            # Decryption goes on in the background while the next epoch starts
+            finisher = greenletPacker(Greenlet(finishEpoch, epoch, selected_B, commonSet, started, finisher),
+                                      'honestParty.finishEpoch', (pid, N, t, B, epoch))
+            finisher.start()
+            finishers.append(finisher)
+            finishers = [g for g in finishers if not g.ready()]
+            epoch += 1
+    gevent.joinall(finishers)
     mylog("[%d] Now halting..." % (pid))
-
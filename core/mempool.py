@@ -0,0 +1,173 @@
+import random
+import time
+from collections import OrderedDict
+from gevent.event import Event
+from itertools import islice
+from utils import mylog, TR_SIZE
+
+MEMPOOL_MAX_COUNT = 1 << 20  # transactions
+MEMPOOL_MAX_BYTES = 1 << 30
+BATCH_MAX_WAIT = 0.1  # seconds a partial batch waits for more transactions
+
+
+class Mempool(object):
+    '''
+    The pending transactions of a party, oldest first.
+
+    Membership, insertion and removal are O(1). Once the pool holds maxCount
+    transactions or maxBytes bytes, a new transaction either evicts the
+    oldest ones (evict='oldest') or is dropped (evict='newest').
+    waitForBatch lets the proposer sleep until a batch can be proposed.
+    The transactions of the proposals still in flight (taken but neither
+    committed nor released yet) are not proposed again. Each of them belongs
+    to the proposal that took it last, and only that one releases it.
+
+    :param maxCount: cap on the number of transactions, None for no cap
+    :param maxBytes: cap on their total size, None for no cap
+    '''
+    def __init__(self, maxCount=MEMPOOL_MAX_COUNT, maxBytes=MEMPOOL_MAX_BYTES, evict='oldest'):
+        assert evict in ('oldest', 'newest')
+        self.maxCount = maxCount
+        self.maxBytes = maxBytes
+        self.evict = evict
+        self.txs = OrderedDict()  # tx -> size, in arrival order
+        self.bytes = 0
+        self.evicted = 0
+        self.changed = Event()  # set whenever a transaction comes in
+        self.inflight = dict()  # tx -> the proposal that took it, until committed or released
+        self.closed = False
+
+    def __len__(self):
+        return len(self.txs)
+
+    def pending(self):
+        # The transactions that can be proposed
+        return len(self.txs) - len(self.inflight)
+
+    def __contains__(self, tx):
+        return tx in self.txs
+
+    def _full(self, size):
+        return (self.maxCount is not None and len(self.txs) + 1 > self.maxCount) or \
+               (self.maxBytes is not None and self.bytes + size > self.maxBytes)
+
+    def add(self, tx):
+        # Returns whether tx is in the pool afterwards
+        if tx in self.txs:
+            return True
+        size = len(tx) if isinstance(tx, str) else TR_SIZE
+        while self.txs and self._full(size):
+            if self.evict == 'newest':
+                self.evicted += 1
+                return False
+            oldTx, oldSize = self.txs.popitem(last=False)
+            self.bytes -= oldSize
+            self.inflight.pop(oldTx, None)  # an evicted proposal can still commit, remove() then ignores it
+            self.evicted += 1
+        self.txs[tx] = size
+        self.bytes += size
+        self.changed.set()
+        return True
+
+    def extend(self, txs):
+        for tx in txs:
+            self.add(tx)
+        if self.evicted:
+            mylog("mempool: %d tx evicted so far, %d pending" % (self.evicted, len(self.txs)), verboseLevel=-1)
+
+    def remove(self, txs):
+        # Drops the committed transactions, returns how many were pending
+        removed = 0
+        for tx in txs:
+            size = self.txs.pop(tx, None)
+            if size is not None:
+                self.bytes -= size
+                self.inflight.pop(tx, None)
+                removed += 1
+        return removed
+
+    def close(self):
+        # Wakes up waitForBatch for good
+        self.closed = True
+        self.changed.set()
+
+    def waitForBatch(self, B, maxWait=BATCH_MAX_WAIT):
+        '''
+        Blocks until B transactions are pending, or until maxWait seconds have
+        passed since this call first saw one pending, whichever comes first.
+        :returns: False if the pool was closed meanwhile
+        '''
+        deadline = None
+        while not self.closed and self.pending() < B:
+            if self.pending() and deadline is None:
+                deadline = time.time() + maxWait
+            timeout = None if deadline is None else deadline - time.time()
+            if timeout is not None and timeout <= 0:
+                break  # go with a partial batch
+            self.changed.clear()
+            self.changed.wait(timeout)
+        return not self.closed
+
+    def oldest(self, B):
+        if not self.inflight:
+            return islice(self.txs, B)
+        return islice((tx for tx in self.txs if tx not in self.inflight), B)
+
+    def sample(self, B, k, rnd=random):
+        # k transactions picked uniformly among the B oldest (reservoir sampling,
+        # so only k of them are held at any time)
+        reservoir = []
+        for i, tx in enumerate(self.oldest(B)):
+            if i < k:
+                reservoir.append(tx)
+            else:
+                j = rnd.randint(0, i)
+                if j < k:
+                    reservoir[j] = tx
+        return reservoir
+
+    def take(self, B, k, rnd=random, owner=None):
+        # Same as sample, and the transactions are in flight for owner until released
+        txs = self.sample(B, k, rnd)
+        for tx in txs:
+            self.inflight[tx] = owner
+        return txs
+
+    def release(self, txs, owner=None):
+        # The proposal of owner is over, what was not committed can be proposed again.
+        # A tx evicted, added back and taken by a later proposal is left to that one.
+        for tx in txs:
+            if tx in self.inflight and self.inflight[tx] == owner:
+                del self.inflight[tx]
+        self.changed.set()
+
+
+def test():
+    # Fill the pool past its cap while a batch is in flight
+    pool = Mempool(maxCount=8, maxBytes=None)
+    pool.extend(['tx%02d' % i for i in range(8)])
+    batch = pool.take(8, 4, random.Random(0))
+    assert pool.pending() == 4
+    pool.extend(['tx%02d' % i for i in range(8, 20)])  # evicts all the first 8, batch included
+    assert len(pool) == 8 and pool.pending() == 8
+    assert not pool.inflight
+    assert pool.remove(batch) == 0
+    pool.release(batch)
+    assert pool.pending() == 8
+    # A tx of an old proposal is evicted, comes back and is taken by a new one
+    pool = Mempool(maxCount=2, maxBytes=None)
+    pool.extend(['a', 'b'])
+    old = pool.take(2, 2, random.Random(0), owner=1)
+    pool.extend(['c', 'd'])  # evicts a and b
+    pool.extend(['a'])  # evicts c
+    new = pool.take(2, 2, random.Random(0), owner=2)
+    assert sorted(new) == ['a', 'd']
+    pool.release(old, owner=1)
+    assert pool.inflight == {'a': 2, 'd': 2} and pool.pending() == 0
+    pool.release(new, owner=2)
+    assert pool.pending() == 2
+    print 'ok'
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,157 @@
+import hashlib
+
+# Merkle trees over the erasure coded fragments of the reliable broadcast.
+#
+# The tree is kept as one flat bytearray: node i (1 is the root) occupies
+# bytes [i*HASH_LENGTH, (i+1)*HASH_LENGTH), and the leaves start at index
+# width, so the two children of a node are adjacent and can be hashed straight
+# out of the buffer. Missing leaves (when the number of fragments is not a
+# power of 2) are all-zero digests.
+
+HASH_LENGTH = hashlib.sha256().digest_size
+EMPTY_LEAF = '\x00' * HASH_LENGTH
+
+sha256 = hashlib.sha256
+
+def treeWidth(n):
+    width = 1
+    while width < n:
+        width <<= 1
+    return width
+
+def hashLeaves(leaves):
+    # Hash all the leaves in one pass
+    return [sha256(leaf).digest() for leaf in leaves]
+
+class MerkleTree(object):
+    def __init__(self, leaves):
+        self.leafCount = len(leaves)
+        self.width = treeWidth(self.leafCount)
+        self.nodes = bytearray(2 * self.width * HASH_LENGTH)
+        nodes = self.nodes
+        offset = self.width * HASH_LENGTH
+        for digest in hashLeaves(leaves):
+            nodes[offset:offset + HASH_LENGTH] = digest
+            offset += HASH_LENGTH
+        for i in range(self.width - 1, 0, -1):
+            nodes[i * HASH_LENGTH:(i + 1) * HASH_LENGTH] = \
+                sha256(buffer(nodes, 2 * i * HASH_LENGTH, 2 * HASH_LENGTH)).digest()
+
+    def node(self, pos):
+        return str(self.nodes[pos * HASH_LENGTH:(pos + 1) * HASH_LENGTH])
+
+    def root(self):
+        return self.node(1)
+
+    def branch(self, index):
+        # The siblings on the way from leaf _index_ up to the root
+        res = []
+        pos = index + self.width
+        while pos > 1:
+            res.append(self.node(pos ^ 1))
+            pos >>= 1
+        return res
+
+
+class MerkleVerifier(object):
+    '''
+    Checks Merkle branches against root hashes and remembers every node that
+    has been proven to belong to a given root, so that later branches of the
+    same tree stop hashing as soon as they reach a proven node.
+    :param leafCount: the number of leaves of every tree checked, the depth of
+        a branch follows from it and is not taken from the branch
+    '''
+    def __init__(self, leafCount):
+        self.leafCount = leafCount
+        self.width = treeWidth(leafCount)
+        self.depth = self.width.bit_length() - 1
+        self.known = dict()  # root hash -> {node position: digest}
+        self.leaves = dict()  # root hash -> {leaf index: leaf value}
+
+    def forget(self, rootHash):
+        self.known.pop(rootHash, None)
+        self.leaves.pop(rootHash, None)
+
+    def provenLeaves(self, rootHash):
+        return self.leaves.get(rootHash, {})
+
+    def _remember(self, rootHash, nodes, leaves):
+        # What was proven first stays, nothing is overwritten
+        known = self.known.setdefault(rootHash, {})
+        for pos, digest in nodes:
+            known.setdefault(pos, digest)
+        proven = self.leaves.setdefault(rootHash, {})
+        for index, val in leaves:
+            proven.setdefault(index, val)
+
+    def verify(self, val, rootHash, branch, index):
+        # index has information on whether we are facing a left sibling or a right sibling
+        if len(branch) != self.depth or not 0 <= index < self.leafCount:
+            return False
+        pos = index + self.width
+        known = self.known.get(rootHash, {})
+        if pos in known and self.leaves[rootHash].get(index) == val:
+            return True  # this very leaf was already checked
+        tmp = sha256(val).digest()
+        nodes = [(pos, tmp)]
+        for br in branch:
+            if known.get(pos) == tmp:
+                break  # reached a node that is already proven
+            nodes.append((pos ^ 1, br))
+            tmp = sha256((pos & 1) and br + tmp or tmp + br).digest()
+            pos >>= 1
+            nodes.append((pos, tmp))
+        else:
+            if tmp != rootHash:
+                return False
+        self._remember(rootHash, nodes, [(index, val)])
+        return True
+
+    def verifyLeaves(self, rootHash, leaves):
+        '''
+        Check that _leaves_ (all the fragments, in order) hash up to _rootHash_.
+        Every leaf is hashed, but no node whose children both hash to proven
+        nodes is hashed again.
+        '''
+        if len(leaves) != self.leafCount:
+            return False
+        width = self.width
+        known = self.known.get(rootHash, {})
+        d = [EMPTY_LEAF] * (2 * width)
+        d[width:width + len(leaves)] = hashLeaves(leaves)
+        for pos in range(width - 1, 0, -1):
+            left, right = d[2 * pos], d[2 * pos + 1]
+            if pos in known and known.get(2 * pos) == left and known.get(2 * pos + 1) == right:
+                d[pos] = known[pos]
+            else:
+                d[pos] = sha256(left + right).digest()
+        if d[1] != rootHash:
+            return False
+        self._remember(rootHash, enumerate(d[1:], 1), enumerate(leaves))
+        return True
+
+
+def test():
+    leaves = ['fragment %d' % i for i in range(7)]
+    mt = MerkleTree(leaves)
+    root = mt.root()
+    verifier = MerkleVerifier(len(leaves))
+    for i, leaf in enumerate(leaves):
+        assert verifier.verify(leaf, root, mt.branch(i), i)
+    assert not verifier.verify('forged', root, mt.branch(3), 3)
+    # A truncated branch from a proven inner node, with its children as the leaf
+    inner = 3  # the parent of leaves 4 to 7
+    forged = mt.node(2 * inner) + mt.node(2 * inner + 1)
+    assert not verifier.verify(forged, root, mt.branch(4)[2:], inner - 2)
+    assert not verifier.verify(forged, root, mt.branch(4)[2:] + [EMPTY_LEAF, EMPTY_LEAF], 1)
+    assert verifier.provenLeaves(root) == dict(enumerate(leaves))
+    assert verifier.verifyLeaves(root, leaves)
+    assert not verifier.verifyLeaves(root, leaves[:3] + ['forged'] + leaves[4:])
+    assert not verifier.verifyLeaves(root, leaves[:6])
+    verifier.leaves[root][3] = 'poisoned'  # whatever the cache says, the leaves themselves are hashed
+    assert not verifier.verifyLeaves(root, leaves[:3] + ['poisoned'] + leaves[4:])
+    print 'ok'
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,155 @@
+import math
+import time
+from collections import OrderedDict, deque
+from codec import HEADER, EPOCH_FLAG
+from utils import mylog
+from tracelog import TraceWriter, nanoseconds
+
+# Message accounting for the test harnesses, in constant memory.
+# Sizes and latencies go into streaming histograms, one per message type. A
+# message is only remembered from its encoding to its decoding (to get its
+# latency), and at most maxInFlight of them are: past that the oldest ones
+# are forgotten. A sampled binary trace (one message in traceEvery, see
+# tracelog) can be written to a file as the run goes.
+
+MAX_IN_FLIGHT = 1 << 16  # sent messages remembered until they are received
+RECENT_SIZE = 1024  # deliveries kept for a look at the end of a run
+TRACE_EVERY = 100
+MSG_TYPES = ['Init', 'Echo', 'Val', 'Aux', 'Coin', 'Ready', 'Share']
+
+
+def messageType(wire):
+    # The type (1-7) of an encoded message (a string or a view), 0 for a message left as a tuple
+    if isinstance(wire, tuple):
+        return 0
+    return HEADER.unpack_from(wire)[3] & ~EPOCH_FLAG
+
+
+class Histogram(object):
+    '''
+    A streaming histogram with logarithmic buckets, _perOctave_ of them for
+    every doubling between low and high: its memory does not depend on the
+    number of values, and its quantiles are within a factor 2**(1/perOctave).
+    '''
+    def __init__(self, low, high, perOctave=8):
+        self.low = float(low)
+        self.perOctave = perOctave
+        self.buckets = [0] * (int(math.ceil(math.log(high / self.low, 2) * perOctave)) + 2)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        if value < self.low:
+            k = 0
+        else:
+            k = min(int(math.log(value / self.low, 2) * self.perOctave) + 1, len(self.buckets) - 1)
+        self.buckets[k] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def quantile(self, q):
+        # The upper bound of the bucket that holds the q-quantile, None if empty
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(q * self.count)))
+        seen = 0
+        for k, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(self.low * 2 ** (float(k) / self.perOctave), self.max)
+
+
+class MessageMetrics(object):
+    '''
+    What a harness's encode and decode record about every message.
+    msgTypeCounter is the [count, bytes] per type that decodeMessage fills in.
+
+    :param keepContent: remember the messages themselves while in flight, for
+        the report of the ones never received (OUTPUT_HALF_MSG)
+    '''
+    def __init__(self, maxInFlight=MAX_IN_FLIGHT, keepContent=False):
+        self.maxInFlight = maxInFlight
+        self.keepContent = keepContent
+        self.msgCounter = 0
+        self.totalMessageSize = 0
+        self.msgTypeCounter = [[0, 0] for _ in range(8)]
+        self.inFlight = OrderedDict()  # mc -> (size, from, to, start, content)
+        self.forgotten = 0  # dropped from inFlight before being received
+        self.latency = [Histogram(1e-6, 1e3) for _ in range(8)]  # seconds
+        self.sizes = [Histogram(1, 1 << 30) for _ in range(8)]  # bytes
+        self.recent = deque(maxlen=RECENT_SIZE)  # (mc, type, size, latency)
+        self.trace = None
+        self.traceEvery = TRACE_EVERY
+
+    def openTrace(self, fileName, every=TRACE_EVERY):
+        # Messages whose counter is a multiple of _every_ go to the file
+        self.trace = TraceWriter(fileName)
+        self.traceEvery = every
+
+    def nextId(self):
+        self.msgCounter += 1
+        return self.msgCounter
+
+    def sent(self, mc, m, size):
+        # m: (to, from, bundle), size: what it counts for in the totals
+        self.inFlight[mc] = (size, m[1], m[0], time.time(), m if self.keepContent else None)
+        if len(self.inFlight) > self.maxInFlight:
+            self.inFlight.popitem(last=False)
+            self.forgotten += 1
+
+    def received(self, mc, wire, frm, to):
+        '''
+        Records the delivery of message _mc_ from frm to to.
+        :returns: (size, start, end), start being None for a message sent
+            by another process or forgotten since
+        '''
+        end = time.time()
+        msgtype = messageType(wire)
+        entry = self.inFlight.get(mc)
+        if entry is not None and entry[1] == frm and entry[2] == to:
+            del self.inFlight[mc]
+            size, start = entry[0], entry[3]
+            self.latency[msgtype].add(end - start)
+        else:  # the counter belongs to someone else
+            size, start = len(wire), None
+        self.totalMessageSize += size
+        self.sizes[msgtype].add(size)
+        self.recent.append((mc, msgtype, size, None if start is None else end - start))
+        if self.trace is not None and mc % self.traceEvery == 0:
+            self.trace.write(mc, msgtype, frm, to, size, nanoseconds(start), nanoseconds(end))
+        return size, start, end
+
+    def halfMessages(self):
+        # The messages sent and not received (yet), as (mc, size, from, to, start, content)
+        for mc, (size, frm, to, start, content) in self.inFlight.iteritems():
+            yield mc, size, frm, to, start, content
+
+    def report(self):
+        print '  type    count   size p50    p99   latency p50      p90      p99      max (ms)'
+        for msgtype in range(1, 8):
+            sizes, latency = self.sizes[msgtype], self.latency[msgtype]
+            if not sizes.count:
+                continue
+            if latency.count:
+                times = '%12.2f %8.2f %8.2f %8.2f' % tuple(1000 * x for x in (
+                    latency.quantile(0.5), latency.quantile(0.9), latency.quantile(0.99), latency.max))
+            else:
+                times = '%12s' % '-'
+            print '%6s %8d %10d %6d %s' % (MSG_TYPES[msgtype - 1], sizes.count, sizes.quantile(0.5),
+                                           sizes.quantile(0.99), times)
+        if self.forgotten:
+            mylog("%d messages were forgotten before being received" % self.forgotten, verboseLevel=-1)
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
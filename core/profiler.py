@@ -0,0 +1,187 @@
+import os
+import signal
+from collections import defaultdict
+import greenlet
+import gevent
+
+# A sampling profiler for the parties of a process, cheap enough to leave on.
+# Every _interval_ seconds of CPU time (SIGPROF) the stack of the running
+# greenlet is taken, and filed under the protocol layer that greenlet works
+# for: the layer comes from the name greenletPacker gave it, or from the
+# innermost frame of a module that belongs to one layer (e.g. the
+# BinaryAgreement objects run inside the ACS listener). Greenlet switches can
+# be counted per layer too, with a greenlet trace hook: it runs on every
+# switch, so it is off by default. The stacks of every epoch go to their own
+# file, in the collapsed format of flamegraph.pl:
+#
+#   layer;greenlet name;file:function;...;file:function count
+#
+#   profiler.start('run')       # run.<epoch>.folded
+#   ...
+#   profiler.stop()
+
+SAMPLE_INTERVAL = 0.005  # seconds of CPU time
+MAX_DEPTH = 64  # frames kept per sample, from the innermost one
+KEEP_EPOCHS = 4  # epochs kept in memory before their file is written
+
+# Greenlet names (prefixes) -> layer, first match wins
+LAYERS = [
+    ('multiSigBr.', 'rbc'),
+    ('includeTransaction.consensusBroadcast', 'rbc'),
+    ('includeTransaction.outputCallBack', 'rbc'),
+    ('includeTransaction._listener', 'router'),
+    ('honestParty.route', 'router'),
+    ('honestParty.controller', 'router'),
+    ('binary_consensus', 'ba'),
+    ('mv84consensus', 'ba'),
+    ('acs.binary_consensus', 'ba'),
+    ('acs.callbackFactory.binary_consensus', 'ba'),
+    ('CoinService.', 'coin'),
+    ('shared_coin_dummy', 'coin'),
+    ('acs.', 'acs'),
+    ('eventDrivenAcs.', 'acs'),
+    ('includeTransaction.callBackWrap', 'acs'),
+    ('random_delay_acs.', 'acs'),
+    ('honestParty.combine', 'decryption'),
+    ('honestParty.finishEpoch', 'decryption'),
+    ('PeerLink.', 'network'),
+    ('TCPTransport.', 'network'),
+]
+
+# Module file names -> layer, for code that runs in another layer's greenlet
+MODULE_LAYERS = {
+    'binary_agreement.py': 'ba',
+    'coin.py': 'coin',
+    'boldyreva.py': 'coin',
+    'boldyreva_gipc.py': 'coin',
+    'tpke.py': 'decryption',
+    'tpke_gipc.py': 'decryption',
+}
+
+
+_layers = dict()  # name -> layer, as looked up so far
+
+
+def layerOf(name):
+    layer = _layers.get(name)
+    if layer is None:
+        layer = next((layer for prefix, layer in LAYERS if name.startswith(prefix)), 'other')
+        _layers[name] = layer
+    return layer
+
+
+def describe(g):
+    # (name, layer) of a greenlet; the ones greenletPacker did not name are 'other'
+    if isinstance(g, gevent.hub.Hub):
+        return 'hub', 'hub'
+    if not hasattr(g, 'parent_args'):
+        return g.__class__.__name__, 'other'
+    return g.name, layerOf(g.name)
+
+
+class Profiler(object):
+    '''
+    Samples per epoch, as {collapsed stack: count}, plus the samples and
+    switches of every layer over the whole run. The epoch of a sample is the
+    newest one a party has entered (see enterEpoch): with pipelining, the
+    tail of the previous epoch is counted in the next one.
+    '''
+    def __init__(self, interval=SAMPLE_INTERVAL, keepEpochs=KEEP_EPOCHS):
+        self.interval = interval
+        self.keepEpochs = keepEpochs
+        self.prefix = None
+        self.running = False
+        self.epoch = 0
+        self.stacks = dict()  # epoch -> {stack: count}
+        self.samples = defaultdict(int)  # layer -> samples
+        self.switches = defaultdict(int)  # layer -> switches into it
+        self.countSwitches = False
+        self.labels = dict()  # code object -> 'file:function'
+        self.previousTrace = None
+        self.previousHandler = None
+
+    def start(self, prefix, interval=None, countSwitches=False):
+        if self.running:
+            return
+        self.prefix = prefix
+        if interval:
+            self.interval = interval
+        self.running = True
+        self.countSwitches = countSwitches
+        if countSwitches:
+            self.previousTrace = greenlet.settrace(self._trace)
+        self.previousHandler = signal.signal(signal.SIGPROF, self._sample)
+        signal.siginterrupt(signal.SIGPROF, False)  # restart the system calls it lands in
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        # Stops sampling and writes the files of the epochs left
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN if self.previousHandler is None else self.previousHandler)
+        if self.countSwitches:
+            greenlet.settrace(self.previousTrace)
+        self.running = False
+        for epoch in sorted(self.stacks):
+            self._write(epoch)
+
+    def enterEpoch(self, epoch):
+        if epoch <= self.epoch:
+            return
+        self.epoch = epoch
+        if self.running:
+            for old in sorted(self.stacks):
+                if old <= epoch - self.keepEpochs:
+                    self._write(old)
+
+    def _label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+            self.labels[code] = label
+        return label
+
+    def _sample(self, signum, frame):
+        name, layer = describe(greenlet.getcurrent())
+        labels = []
+        moduleLayer = None
+        while frame is not None and len(labels) < MAX_DEPTH:
+            code = frame.f_code
+            if moduleLayer is None:
+                moduleLayer = MODULE_LAYERS.get(os.path.basename(code.co_filename))
+            labels.append(self._label(code))
+            frame = frame.f_back
+        layer = moduleLayer or layer
+        labels.append(name)
+        labels.append(layer)
+        labels.reverse()
+        self.samples[layer] += 1
+        stacks = self.stacks.get(self.epoch)
+        if stacks is None:
+            stacks = self.stacks[self.epoch] = defaultdict(int)
+        stacks[';'.join(labels)] += 1
+
+    def _trace(self, event, args):
+        if event in ('switch', 'throw'):
+            self.switches[describe(args[1])[1]] += 1
+        if self.previousTrace is not None:
+            self.previousTrace(event, args)
+
+    def _write(self, epoch):
+        stacks = self.stacks.pop(epoch)
+        with open('%s.%d.folded' % (self.prefix, epoch), 'w') as f:
+            for stack, count in sorted(stacks.iteritems()):
+                f.write('%s %d\n' % (stack, count))
+
+    def report(self):
+        total = sum(self.samples.itervalues()) or 1
+        lines = ['layer           samples   cpu (s)      %   switches']
+        for layer in sorted(set(self.samples) | set(self.switches), key=lambda l: -self.samples[l]):
+            lines.append('%-12s %10d %9.2f %6.1f %10s' % (layer, self.samples[layer], self.samples[layer] * self.interval,
+                                                         100.0 * self.samples[layer] / total,
+                                                         self.switches[layer] if self.countSwitches else '-'))
+        return '\n'.join(lines) + '\n'
+
+
+profiler = Profiler()  # shared by the parties of the process
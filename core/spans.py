@@ -0,0 +1,169 @@
+import sys
+import time
+import warnings
+from collections import OrderedDict
+from metrics import Histogram
+
+# Timing of the protocol phases: RBC delivery per instance, BA decision (and
+# its number of rounds), common coin, ACS, threshold decryption, AES.
+# Durations come from a monotonic clock in ns and go into per-epoch
+# histograms, plus one histogram per phase over the whole run. They can be
+# written to a file, or served in the Prometheus text format.
+#
+#   startNs = monotonicNs()
+#   ...
+#   context.phases.since('rbc', epoch, startNs)
+#
+#   with context.phases.span('aes_decrypt', epoch):
+#       ...
+
+KEEP_EPOCHS = 64  # the per-epoch histograms of older epochs are dropped
+QUANTILES = (0.5, 0.9, 0.99)
+
+try:
+    from time import monotonic_ns as monotonicNs
+except ImportError:
+    import ctypes
+    import ctypes.util
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    # The value of CLOCK_MONOTONIC is only known to be 1 on linux
+    CLOCK_MONOTONIC = getattr(time, 'CLOCK_MONOTONIC', 1 if sys.platform.startswith('linux') else None)
+    _clock_gettime = None
+    if CLOCK_MONOTONIC is not None:
+        try:
+            _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'),
+                                         use_errno=True).clock_gettime
+            _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        except (OSError, AttributeError, TypeError):
+            _clock_gettime = None
+
+    if _clock_gettime is not None:
+        _now = _timespec()
+
+        def monotonicNs():
+            _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(_now))
+            return _now.tv_sec * 1000000000 + _now.tv_nsec
+    else:
+        warnings.warn('no monotonic clock on %s, phase timings use time.time()' % sys.platform)
+
+        def monotonicNs():
+            return int(time.time() * 1e9)  # not monotonic
+
+class Span(object):
+    __slots__ = ('phases', 'phase', 'epoch', 'start')
+
+    def __init__(self, phases, phase, epoch):
+        self.phases = phases
+        self.phase = phase
+        self.epoch = epoch
+        self.start = monotonicNs()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.phases.since(self.phase, self.epoch, self.start)
+
+
+class Phases(object):
+    '''
+    The histograms of the phase durations (in seconds) and of the per-phase
+    counts (e.g. BA rounds), for each of the last keepEpochs epochs and in
+    total.
+    '''
+    def __init__(self, keepEpochs=KEEP_EPOCHS):
+        self.keepEpochs = keepEpochs
+        self.epochs = OrderedDict()  # epoch -> {name: Histogram}
+        self.totals = dict()  # name -> Histogram
+        self.units = dict()  # name -> 'seconds' or 'count'
+        self.server = None
+
+    def _histograms(self, name, epoch, unit):
+        if name not in self.totals:
+            self.units[name] = unit
+            self.totals[name] = self._newHistogram(unit)
+        if epoch not in self.epochs:
+            self.epochs[epoch] = dict()
+            while len(self.epochs) > self.keepEpochs:
+                self.epochs.popitem(last=False)
+        histograms = self.epochs[epoch]
+        if name not in histograms:
+            histograms[name] = self._newHistogram(unit)
+        return histograms[name], self.totals[name]
+
+    def _newHistogram(self, unit):
+        if unit == 'seconds':
+            return Histogram(1e-6, 1e4)
+        return Histogram(1, 1 << 20)
+
+    def record(self, phase, epoch, seconds):
+        for histogram in self._histograms(phase, epoch, 'seconds'):
+            histogram.add(seconds)
+
+    def since(self, phase, epoch, startNs):
+        # Records the time since startNs (from monotonicNs)
+        self.record(phase, epoch, (monotonicNs() - startNs) / 1e9)
+
+    def count(self, name, epoch, value):
+        for histogram in self._histograms(name, epoch, 'count'):
+            histogram.add(value)
+
+    def span(self, phase, epoch):
+        return Span(self, phase, epoch)
+
+    def _line(self, name, histogram):
+        return '%-16s %8d %12.6f %12.6f %12.6f %12.6f %12.6f' % (
+            (name, histogram.count, histogram.mean()) + tuple(histogram.quantile(q) for q in QUANTILES) +
+            (histogram.max,))
+
+    def report(self):
+        lines = ['epoch %-10s %8s %12s %12s %12s %12s %12s' % ('phase', 'count', 'mean', 'p50', 'p90', 'p99', 'max')]
+        for epoch, histograms in self.epochs.iteritems():
+            for name in sorted(histograms):
+                lines.append('%5d %s' % (epoch, self._line(name, histograms[name])))
+        for name in sorted(self.totals):
+            lines.append('  all %s' % self._line(name, self.totals[name]))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, fileName):
+        with open(fileName, 'w') as f:
+            f.write(self.report())
+
+    def prometheus(self):
+        # The totals as Prometheus summaries
+        lines = []
+        for unit, metric in (('seconds', 'hbbft_phase_seconds'), ('count', 'hbbft_phase_count')):
+            names = sorted(name for name in self.totals if self.units[name] == unit)
+            if not names:
+                continue
+            lines.append('# TYPE %s summary' % metric)
+            for name in names:
+                histogram = self.totals[name]
+                for q in QUANTILES:
+                    lines.append('%s{phase="%s",quantile="%s"} %r' % (metric, name, q, histogram.quantile(q)))
+                lines.append('%s_sum{phase="%s"} %r' % (metric, name, histogram.total))
+                lines.append('%s_count{phase="%s"} %d' % (metric, name, histogram.count))
+        if self.epochs:
+            lines.append('# TYPE hbbft_last_epoch gauge')
+            lines.append('hbbft_last_epoch %d' % max(self.epochs))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port):
+        # Serves prometheus() on http://0.0.0.0:port/metrics
+        from gevent.pywsgi import WSGIServer
+
+        def application(environ, start_response):
+            if environ.get('PATH_INFO') != '/metrics':
+                start_response('404 Not Found', [('Content-Type', 'text/plain')])
+                return ['']
+            body = self.prometheus()
+            start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'),
+                                      ('Content-Length', str(len(body)))])
+            return [body]
+
+        self.server = WSGIServer(('0.0.0.0', port), application, log=None)
+        self.server.start()
+
@@ -0,0 +1,37 @@
+class VoteTally(object):
+    '''
+    The set of parties that sent a given vote, kept as a bitmask of party ids
+    with a running count, so inserting, checking for a duplicate sender and
+    comparing against a threshold are all O(1).
+    '''
+    __slots__ = ('mask', 'count')
+
+    def __init__(self):
+        self.mask = 0
+        self.count = 0
+
+    def add(self, sender):
+        # Returns False if _sender_ had already voted
+        bit = 1 << sender
+        if self.mask & bit:
+            return False
+        self.mask |= bit
+        self.count += 1
+        return True
+
+    def __contains__(self, sender):
+        return bool(self.mask >> sender & 1)
+
+    def __len__(self):
+        return self.count
+
+    def senders(self):
+        mask, i = self.mask, 0
+        while mask:
+            if mask & 1:
+                yield i
+            mask >>= 1
+            i += 1
+
+    def __repr__(self):
+        return 'VoteTally(%r)' % list(self.senders())
@@ -0,0 +1,72 @@
+import struct
+
+# Binary message trace: a file header, then one fixed-width record per
+# message (id, type, from, to, size, send ns, recv ns), little endian and
+# unpadded, so that a trace can be memory-mapped as an array of records
+# (see tools/benchmark/trace_analyzer.py). A time of -1 means unknown, e.g.
+# the sending time of a message that came from another process.
+
+MAGIC = 'HBTR'
+VERSION = 1
+FILE_HEADER = struct.Struct('<4sHH')  # magic, version, record size
+RECORD = struct.Struct('<QBHHIqq')
+RECORD_FIELDS = ('id', 'type', 'from', 'to', 'size', 'send', 'recv')
+UNKNOWN = -1
+WRITE_BUFFER_RECORDS = 4096
+
+
+class TraceFormatException(Exception):
+    pass
+
+
+def nanoseconds(t=None):
+    # A time.time() value in integer nanoseconds, None for unknown
+    if t is None:
+        return UNKNOWN
+    return int(t * 1e9)
+
+
+class TraceWriter(object):
+    '''
+    Appends records to a trace file, WRITE_BUFFER_RECORDS at a time.
+    '''
+    def __init__(self, fileName, bufferRecords=WRITE_BUFFER_RECORDS):
+        self.file = open(fileName, 'wb')
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION, RECORD.size))
+        self.bufferRecords = bufferRecords
+        self.buffer = []
+        self.records = 0
+
+    def write(self, mc, msgtype, frm, to, size, send, recv):
+        # send, recv: in ns
+        self.buffer.append(RECORD.pack(mc, msgtype, frm, to, size, send, recv))
+        self.records += 1
+        if len(self.buffer) >= self.bufferRecords:
+            self.flush()
+
+    def flush(self):
+        self.file.write(''.join(self.buffer))
+        self.buffer = []
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def readHeader(f):
+    magic, version, size = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+    if magic != MAGIC or version != VERSION or size != RECORD.size:
+        raise TraceFormatException('not a version %d trace' % VERSION)
+
+
+def readRecords(fileName):
+    # Yields the records one by one, without numpy
+    with open(fileName, 'rb') as f:
+        readHeader(f)
+        while True:
+            chunk = f.read(RECORD.size * WRITE_BUFFER_RECORDS)
+            if not chunk:
+                break
+            for k in range(0, len(chunk) - RECORD.size + 1, RECORD.size):
+                yield RECORD.unpack_from(chunk, k)
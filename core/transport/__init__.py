@@ -0,0 +1,3 @@
+from base import Transport
+from tcp import TCPTransport
+from loopback import LoopbackNetwork, LoopbackTransport
@@ -0,0 +1,49 @@
+from abc import ABCMeta, abstractmethod
+from gevent.queue import Queue
+from ..codec import encodeMessage, decodeMessage
+
+
+def defaultEncode(m):
+    # m: (to, from, bundle)
+    return encodeMessage(0, m)
+
+def defaultDecode(s):
+    # returns (to, from, bundle)
+    return decodeMessage(s)[1]
+
+
+class Transport(object):
+    '''
+    The channels of one party: what honestParty needs in place of the
+    broadcast/send closures and the receive function.
+
+    :param pid: my id number
+    :param N: the number of parties
+    :param encode: turns (to, from, bundle) into a string
+    :param decode: turns a string, or a memoryview over one, back into (to, from, bundle)
+    '''
+    __metaclass__ = ABCMeta
+
+    def __init__(self, pid, N, encode=defaultEncode, decode=defaultDecode):
+        self.pid = pid
+        self.N = N
+        self.encode = encode
+        self.decode = decode
+        self.inbox = Queue()  # (sender, bundle)
+
+    def start(self):
+        pass
+
+    @abstractmethod
+    def send(self, j, m):
+        pass
+
+    def broadcast(self, m):
+        for j in range(self.N):
+            self.send(j, m)
+
+    def receive(self, *args, **kargs):
+        return self.inbox.get(*args, **kargs)
+
+    def close(self):
+        pass
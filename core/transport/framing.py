@@ -0,0 +1,83 @@
+import struct
+
+# What goes over a TCPTransport connection, and the reader for it.
+
+HELLO = struct.Struct('<IQ')  # the pid of the sender, its session (a new one every time it starts)
+FRAME = struct.Struct('<IQ')  # batch length, sequence number
+MESSAGE = struct.Struct('<I')  # message length, before each message of a batch
+ACCEPT = struct.Struct('<QQ')  # the answer to HELLO: the receiver's session, the last sequence number delivered
+ACK = struct.Struct('<Q')     # the last sequence number delivered
+
+RECV_BUFFER_SIZE = 256 * 1024
+
+
+class ConnectionClosed(Exception):
+    pass
+
+
+class HandshakeReset(Exception):
+    # The peer broke the protocol (bad hello, a gap in its frames): the
+    # connection is dropped, and the next handshake starts from what was delivered
+    pass
+
+
+class FrameReader(object):
+    '''
+    Reads a socket with recv_into into one reusable buffer, and parses all
+    the complete frames a recv brought in before reading again.
+
+    The unparsed bytes are moved back to the front when the buffer runs out of
+    room, and the buffer is replaced by a larger one for a frame that does not
+    fit. Payloads are handed out as memoryviews into the buffer: they are only
+    valid until the next read, so they must be decoded (or copied) right away.
+    '''
+    def __init__(self, sock, size=RECV_BUFFER_SIZE):
+        self.sock = sock
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0  # first unparsed byte
+        self.end = 0  # end of the data received
+        self.recvs = 0
+
+    def _fill(self, need):
+        # Receive until at least _need_ bytes are available
+        while self.end - self.start < need:
+            if self.start == self.end:
+                self.start = self.end = 0
+            if len(self.buf) < need:
+                buf = bytearray(max(need, 2 * len(self.buf)))  # the old views stay valid
+                buf[:self.end - self.start] = self.buf[self.start:self.end]
+                self.buf, self.view = buf, memoryview(buf)
+                self.start, self.end = 0, self.end - self.start
+            elif len(self.buf) - self.start < need:
+                pending = self.end - self.start
+                self.buf[:pending] = self.buf[self.start:self.end]
+                self.start, self.end = 0, pending
+            n = self.sock.recv_into(self.view[self.end:])
+            if not n:
+                raise ConnectionClosed()
+            self.recvs += 1
+            self.end += n
+
+    def unpack(self, st):
+        # Reads one struct
+        self._fill(st.size)
+        values = st.unpack_from(self.buf, self.start)
+        self.start += st.size
+        return values
+
+    def frames(self):
+        # Yields (seq, [payload]) for every batch, raises ConnectionClosed at the end
+        while True:
+            self._fill(FRAME.size)
+            length, seq = FRAME.unpack_from(self.buf, self.start)
+            self._fill(FRAME.size + length)
+            pos = self.start + FRAME.size
+            self.start = end = pos + length
+            payloads = []
+            while pos < end:  # split the batch back into messages
+                size, = MESSAGE.unpack_from(self.buf, pos)
+                pos += MESSAGE.size
+                payloads.append(self.view[pos:pos + size])
+                pos += size
+            yield seq, payloads
@@ -0,0 +1,37 @@
+import gevent
+from base import Transport, defaultDecode
+
+
+class LoopbackNetwork(object):
+    '''
+    N parties in one process, for tests. Messages go straight to the inbox of
+    the recipient, optionally after delay(sender, to) seconds and through the
+    wire codec (encode, decode), so that the protocol sees what it would see
+    over the network.
+    '''
+    def __init__(self, N, delay=None, encode=None, decode=None):
+        self.N = N
+        self.delay = delay
+        self.encode = encode
+        self.decode = decode or defaultDecode
+        self.transports = [LoopbackTransport(self, pid, N) for pid in range(N)]
+
+    def transport(self, pid):
+        return self.transports[pid]
+
+    def deliver(self, to, sender, m):
+        if self.encode:
+            _, _, m = self.decode(self.encode((to, sender, m)))
+        if self.delay:
+            gevent.spawn_later(self.delay(sender, to), self.transports[to].inbox.put, (sender, m))
+        else:
+            self.transports[to].inbox.put((sender, m))
+
+
+class LoopbackTransport(Transport):
+    def __init__(self, network, pid, N):
+        super(LoopbackTransport, self).__init__(pid, N)
+        self.network = network
+
+    def send(self, j, m):
+        self.network.deliver(j, self.pid, m)
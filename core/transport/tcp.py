@@ -0,0 +1,271 @@
+import random
+import time
+from collections import deque, defaultdict
+import gevent
+from gevent import Greenlet, socket
+from gevent.event import Event
+from gevent.queue import Queue, Empty, Full
+from gevent.server import StreamServer
+from ..utils import mylog, greenletPacker
+from base import Transport, defaultEncode, defaultDecode
+from framing import HELLO, ACCEPT, FRAME, MESSAGE, ACK, ConnectionClosed, HandshakeReset, FrameReader
+
+# TCP transport: one persistent connection from every party to every other
+# party, each carrying the frames of its direction and the acks back.
+#
+# A connection opens with the sender's pid and session (HELLO), to which the
+# receiver answers with its own session and the last sequence number it
+# delivered from that sender (ACCEPT). The sender drops the frames
+# acknowledged so far and replays the others, so nothing is lost or delivered
+# twice when a connection breaks: frames are numbered per sender, and the
+# receiver skips the ones it has seen. A gap in the numbers resets the
+# connection, the next handshake asks for the missing frames. A new session
+# means that side restarted: a restarted sender numbers its frames from 1
+# again, and the sender to a restarted receiver numbers the frames it still
+# has from 1. What the restarted side had not delivered is lost.
+# A message that does not decode is dropped, not its frame or the connection.
+# send() never blocks: when a peer is unreachable for long enough to fill its
+# send queue, the messages for it are dropped (and counted) so that the
+# others are still served.
+# Broken connections are dialed again with exponential backoff.
+# Outbound messages are coalesced: what is queued for a peer, up to
+# BATCH_BYTES and after waiting up to batchDelay seconds for more, is written
+# in one sendall as one frame: <I batch length, Q seq> followed by the
+# messages, each prefixed with <I length>. Sequence numbers and acks count
+# batches.
+
+SEND_QUEUE_SIZE = 1 << 16  # messages waiting for a connection, send() drops beyond
+MAX_UNACKED = 1 << 12  # batches sent but not acknowledged yet
+BATCH_BYTES = 64 * 1024
+BACKOFF_MIN = 0.1
+BACKOFF_MAX = 10.0
+
+
+def backoff(attempt):
+    # Exponential, with some jitter so that the parties do not dial in lockstep
+    delay = min(BACKOFF_MAX, BACKOFF_MIN * (2 ** attempt))
+    return delay * random.uniform(0.5, 1.0)
+
+
+class PeerLink(object):
+    '''
+    The outbound half of the connection to one peer: a bounded send queue, and
+    the batches that have not been acknowledged yet.
+    '''
+    def __init__(self, transport, peer, address):
+        self.transport = transport
+        self.peer = peer
+        self.address = address
+        self.queue = Queue(SEND_QUEUE_SIZE)
+        self.unacked = deque()  # (seq, frame)
+        self.batch = []  # the messages of the batch being gathered, kept if the connection breaks meanwhile
+        self.nextSeq = 1
+        self.acked = 0
+        self.ackEvent = Event()
+        self.connects = 0
+        self.dropped = 0  # messages dropped for a full send queue
+        self.peerSession = None
+        self.greenlet = None
+
+    def start(self):
+        self.greenlet = greenletPacker(Greenlet(self._run), 'PeerLink._run', (self.transport.pid, self.peer))
+        self.greenlet.start()
+
+    def _ack(self, seq):
+        while self.unacked and self.unacked[0][0] <= seq:
+            self.unacked.popleft()
+        self.acked = max(self.acked, seq)
+        self.ackEvent.set()
+
+    def _connect(self):
+        attempt = 0
+        while True:
+            try:
+                return self.transport.connect(self.address)
+            except (socket.error, IOError), e:
+                delay = backoff(attempt)
+                mylog('[%d] retrying %s in %.1fs caused by %s...' % (self.transport.pid, repr(self.address), delay, str(e)),
+                      verboseLevel=-1)
+                gevent.sleep(delay)
+                attempt += 1
+
+    def _run(self):
+        while True:
+            sock = self._connect()
+            workers = []
+            try:
+                sock.sendall(HELLO.pack(self.transport.pid, self.transport.session))
+                reader = FrameReader(sock, ACK.size * 1024)
+                peerSession, delivered = reader.unpack(ACCEPT)
+                if self.peerSession is not None and peerSession != self.peerSession:
+                    self._renumber()
+                self.peerSession = peerSession
+                self._ack(delivered)
+                if self.unacked:  # replay what the peer may not have got
+                    sock.sendall(''.join(frame for _, frame in self.unacked))
+                self.connects += 1
+                workers = [gevent.spawn(self._readAcks, reader), gevent.spawn(self._pump, sock)]
+                gevent.joinall(workers, count=1)  # one of them stops when the connection breaks
+            except (socket.error, ConnectionClosed), e:
+                mylog('[%d] connection to %d lost: %s' % (self.transport.pid, self.peer, str(e)), verboseLevel=-1)
+            finally:
+                gevent.killall(workers)
+                sock.close()
+
+    def _renumber(self):
+        # The peer restarted and expects frames from 1: what it has not acknowledged is numbered again
+        mylog('[%d] %d restarted, %d frames to send again' % (self.transport.pid, self.peer, len(self.unacked)),
+              verboseLevel=-1)
+        frames = [frame[FRAME.size:] for _, frame in self.unacked]
+        self.unacked = deque()
+        self.nextSeq = 1
+        self.acked = 0
+        for batch in frames:
+            self.unacked.append((self.nextSeq, FRAME.pack(len(batch), self.nextSeq) + batch))
+            self.nextSeq += 1
+
+    def _readAcks(self, reader):
+        try:
+            while True:
+                self._ack(reader.unpack(ACK)[0])
+        except (socket.error, ConnectionClosed):
+            pass
+
+    def _encode(self, m):
+        payload = self.transport.encode((self.peer, self.transport.pid, m))
+        return MESSAGE.pack(len(payload)) + payload
+
+    def _pump(self, sock):
+        try:
+            while True:
+                while len(self.unacked) >= MAX_UNACKED:
+                    self.ackEvent.clear()
+                    self.ackEvent.wait()
+                messages = self.batch
+                if not messages:
+                    messages.append(self._encode(self.queue.get()))
+                size = sum(len(m) for m in messages)
+                deadline = time.time() + self.transport.batchDelay
+                while size < BATCH_BYTES:  # coalesce whatever comes in before the deadline
+                    try:
+                        m = self.queue.get(timeout=max(deadline - time.time(), 0))
+                    except Empty:
+                        break
+                    messages.append(self._encode(m))
+                    size += len(messages[-1])
+                frame = FRAME.pack(size, self.nextSeq) + ''.join(messages)
+                self.unacked.append((self.nextSeq, frame))
+                self.nextSeq += 1
+                self.batch = []
+                self.transport.batchCounter[0] += 1
+                self.transport.batchCounter[1] += len(messages)
+                sock.sendall(frame)
+        except socket.error:
+            pass  # the frames stay in unacked, and are replayed on the next connection
+
+
+class TCPTransport(Transport):
+    '''
+    :param addresses: the (host, port) of every party, mine is where I listen
+    :param connect: opens a socket to an address (e.g. through a SOCKS proxy)
+    :param batchDelay: how long a sender waits for more messages to write at once
+    '''
+    def __init__(self, pid, addresses, encode=defaultEncode, decode=defaultDecode,
+                 connect=socket.create_connection, batchDelay=0):
+        super(TCPTransport, self).__init__(pid, len(addresses), encode, decode)
+        self.addresses = addresses
+        self.connect = connect
+        self.batchDelay = batchDelay
+        self.batchCounter = [0, 0]  # batches written, messages in them
+        self.links = dict((j, PeerLink(self, j, address))
+                          for j, address in enumerate(addresses) if j != pid)
+        self.session = random.SystemRandom().getrandbits(64)
+        self.delivered = defaultdict(lambda: 0)  # sender -> last sequence number delivered
+        self.sessions = dict()  # sender -> its session
+        self.connections = dict()  # sender -> the socket it currently sends on
+        self.server = None
+
+    def start(self):
+        self.server = StreamServer(('0.0.0.0', self.addresses[self.pid][1]), self._serve)
+        self.server.start()
+        for link in self.links.values():
+            link.start()
+
+    def send(self, j, m):
+        if j == self.pid:
+            self.inbox.put((j, m))  # no need to go through the network
+        else:
+            link = self.links[j]
+            try:
+                link.queue.put_nowait(m)
+            except Full:
+                if not link.dropped:
+                    mylog('[%d] send queue to %d is full, dropping messages' % (self.pid, j), verboseLevel=-1)
+                link.dropped += 1
+
+    def _serve(self, sock, address):
+        reader = FrameReader(sock)
+        try:
+            sender, session = reader.unpack(HELLO)
+            if not 0 <= sender < self.N or sender == self.pid:
+                raise HandshakeReset('hello from unknown party %d' % sender)
+        except (socket.error, ConnectionClosed, HandshakeReset), e:
+            mylog('[%d] handshake from %s failed: %s' % (self.pid, repr(address), repr(e)), verboseLevel=-1)
+            sock.close()
+            return
+        if self.sessions.get(sender, session) != session:
+            mylog('[%d] %d restarted, %d frames delivered from its last session' % (
+                self.pid, sender, self.delivered[sender]), verboseLevel=-1)
+            self.delivered[sender] = 0
+        self.sessions[sender] = session
+        if sender in self.connections:
+            self.connections[sender].close()  # a new connection replaces the old one
+        self.connections[sender] = sock
+        ackEvent = Event()
+        acker = greenletPacker(Greenlet(self._sendAcks, sock, sender, ackEvent), 'TCPTransport._sendAcks',
+                               (self.pid, sender))
+        acker.start()
+        try:
+            sock.sendall(ACCEPT.pack(self.session, self.delivered[sender]))
+            for seq, payloads in reader.frames():  # views into the reader's buffer
+                if self.connections.get(sender) is not sock:
+                    break  # replaced by a newer connection, which delivers from here on
+                if seq <= self.delivered[sender]:
+                    continue  # replayed, we already have it
+                if seq != self.delivered[sender] + 1:
+                    raise HandshakeReset('frame %d after %d' % (seq, self.delivered[sender]))
+                messages = []  # the whole frame first, the views are only valid until the next read
+                for payload in payloads:
+                    try:
+                        messages.append(self.decode(payload)[2])
+                    except Exception, e:
+                        mylog('[%d] dropping a message of frame %d from %d that does not decode: %s' % (
+                            self.pid, seq, sender, repr(e)), verboseLevel=-1)
+                self.delivered[sender] = seq
+                for m in messages:
+                    self.inbox.put((sender, m))
+                ackEvent.set()
+        except (socket.error, ConnectionClosed, HandshakeReset), e:
+            mylog('[%d] connection from %d lost: %s' % (self.pid, sender, repr(e)), verboseLevel=-1)
+        finally:
+            acker.kill()
+            if self.connections.get(sender) is sock:
+                del self.connections[sender]
+            sock.close()
+
+    def _sendAcks(self, sock, sender, ackEvent):
+        # One ack for all the frames delivered since the last one
+        try:
+            while True:
+                ackEvent.wait()
+                ackEvent.clear()
+                sock.sendall(ACK.pack(self.delivered[sender]))
+        except socket.error:
+            pass
+
+    def close(self):
+        for link in self.links.values():
+            if link.greenlet:
+                link.greenlet.kill()
+        if self.server:
+            self.server.stop()
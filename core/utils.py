@@ -41,11 +41,6 @@ def callBackWrap(func, callback):
 
     return _callBackWrap
 
-PK, SKs = None, None
-encPK, encSKs = None, None
-
-ecdsa_key_list = []
-
 from Crypto.Hash import SHA256
 sha1hash = lambda x: SHA256.new(x).digest()
 
@@ -142,10 +137,12 @@ def deepEncode(mc, m):
     f, t, bundle = m
     buf.write(struct.pack('BB', f, t))
     if bundle[0] == 'O':
-        tag, id, share = bundle
+        tag, shares = bundle  # all my decryption shares of the epoch
         buf.write('\x07')
-        buf.write(struct.pack('B', id))
-        buf.write(serialize(share))
+        buf.write(struct.pack('B', len(shares)))
+        for id, share in shares:
+            buf.write(struct.pack('B', id))
+            buf.write(serialize(share))
     else:
         (tag, c) = bundle
         # totally we have 4 msg types
@@ -265,29 +262,31 @@ def deepDecode(m, msgTypeCounter):
         hm = buf.read()
         return mc, (f, t, ('B', ('r', p1, hm)))
     elif msgtype == 7:
-        id = struct.unpack('B', buf.read(1))[0]
-        share = deserialize1(buf.read(PAIRING_SERIALIZED_1))
-        return mc, (f, t, ('O', id, share))
+        count, = struct.unpack('B', buf.read(1))
+        shares = []
+        for _ in range(count):
+            id, = struct.unpack('B', buf.read(1))
+            shares.append((id, deserialize1(buf.read(PAIRING_SERIALIZED_1))))
+        return mc, (f, t, ('O', tuple(shares)))
     else:
         raise deepDecodeException()
 
-def initiateThresholdSig(contents):
-    global PK, SKs
-    # print contents
+def loadThresholdSig(contents):
+    # The (PK, SKs) of the common coin, SKs[i] being the share of party i
     (l, k, sVK, sVKs, SKs) = pickle.loads(contents)
-    PK, SKs = boldyreva.TBLSPublicKey(l, k, boldyreva.deserialize2(sVK), [boldyreva.deserialize2(sVKp) for sVKp in sVKs]), \
+    return boldyreva.TBLSPublicKey(l, k, boldyreva.deserialize2(sVK), [boldyreva.deserialize2(sVKp) for sVKp in sVKs]), \
            [boldyreva.TBLSPrivateKey(l, k, boldyreva.deserialize2(sVK), [boldyreva.deserialize2(sVKp) for sVKp in sVKs], \
                            boldyreva.deserialize0(SKp[1]), SKp[0]) for SKp in SKs]
 
-def initiateThresholdEnc(contents):
-    global encPK, encSKs
+def loadThresholdEnc(contents):
+    # The (encPK, encSKs) of the threshold encryption
     (l, k, sVK, sVKs, SKs) = pickle.loads(contents)
-    encPK, encSKs = TPKEPublicKey(l, k, deserialize1(sVK), [deserialize1(sVKp) for sVKp in sVKs]), \
+    return TPKEPublicKey(l, k, deserialize1(sVK), [deserialize1(sVKp) for sVKp in sVKs]), \
            [TPKEPrivateKey(l, k, deserialize1(sVK), [deserialize1(sVKp) for sVKp in sVKs], \
                            deserialize0(SKp[1]), SKp[0]) for SKp in SKs]
 
-def initiateECDSAKeys(contents):
-    global ecdsa_key_list
+def loadECDSAKeys(contents):
+    # The ECDSA keys of all the parties, secrets included
     ecdsa_key_list = []
     ecdsa_sec_list = pickle.loads(contents)
     for secret in ecdsa_sec_list:
@@ -295,9 +294,7 @@ def initiateECDSAKeys(contents):
         k.generate(secret)
         k.set_compressed(True)
         ecdsa_key_list.append(k)
-
-def getEncKeys():
-    return encPK, encSKs
+    return ecdsa_key_list
 
 def setHash(s):
     result = 0
@@ -305,12 +302,6 @@ def setHash(s):
         result ^= hash(ele)
     return result
 
-def getKeys():
-    return PK, SKs
-
-def getECDSAKeys():
-    return ecdsa_key_list
-
 class bcolors:
     HEADER = '\033[95m'
     OKBLUE = '\033[94m'
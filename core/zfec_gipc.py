@@ -0,0 +1,62 @@
+import zfec
+from gevent.lock import Semaphore
+import gipc
+import random
+
+# Reconstruction of reliable broadcast payloads on worker processes, so that
+# decoding one instance does not stall the event loop for the other N-1.
+
+if '_procs' in globals():
+    for p,pipe,_ in _procs:
+        p.terminate()
+        p.join()
+    del _procs
+_procs = []
+
+_coders = dict()
+
+def _getCoders(k, N):
+    if (k, N) not in _coders:
+        _coders[(k, N)] = (zfec.Encoder(k, N), zfec.Decoder(k, N))
+    return _coders[(k, N)]
+
+def _reconstruct(k, N, blocks, nums):
+    '''
+    Decode the primary blocks from _blocks_ (fragments with indices _nums_) and
+    re-encode only the fragments that are not among them.
+    :return: (primary blocks, {index: re-encoded fragment})
+    '''
+    encoder, decoder = _getCoders(k, N)
+    primary = decoder.decode(blocks, nums)
+    missing = [i for i in range(N) if i not in nums]
+    if not missing:
+        return primary, {}
+    # The code is systematic, so the primary blocks never need to be re-encoded
+    parity = [i for i in missing if i >= k]
+    reencoded = dict((i, primary[i]) for i in missing if i < k)
+    if parity:
+        reencoded.update(zip(parity, encoder.encode(primary, parity)))
+    return primary, reencoded
+
+def _worker(pipe):
+    while True:
+        k, N, blocks, nums = pipe.get()
+        pipe.put(_reconstruct(k, N, blocks, nums))
+
+def initialize(size=1):
+    global _procs
+    _procs = []
+    for s in range(size):
+        (r,w) = gipc.pipe(duplex=True)
+        p = gipc.start_process(_worker, args=(r,))
+        _procs.append((p,w,Semaphore()))
+
+def reconstruct(k, N, blocks, nums):
+    nums = list(nums)
+    if not _procs:
+        return _reconstruct(k, N, blocks, nums)
+    # Pick a random process
+    _,pipe,lock = random.choice(_procs)
+    with lock:  # a pipe can only serve one request at a time
+        pipe.put((k, N, blocks, nums))
+        return pipe.get()
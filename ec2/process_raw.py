@@ -4,7 +4,23 @@ import math
 import numpy
 from collections import defaultdict
 
-def process(s, txpp, N=-1, t=-1):
+def timestamp(line, tag):
+    # '... timestampB (pid, epoch, time)', or (pid, time) in the logs before epochs: returns (pid, epoch, time)
+    fields = line.split(tag)[1].strip().strip('()').split(',')
+    epoch = int(fields[1]) if len(fields) == 3 else 0
+    return int(fields[0]), epoch, float(fields[-1])
+
+def record(times, line, tag, onlyEpoch, pick):
+    # Keeps the time of each party in onlyEpoch, or with onlyEpoch None the one pick (min or max)
+    # chooses across all the epochs, so that a run is timed from its first start to its last end
+    pid, epoch, ts = timestamp(line, tag)
+    if onlyEpoch is None:
+        times[pid] = pick(times[pid], ts) if pid in times else ts
+    elif epoch == onlyEpoch:
+        times[pid] = ts
+
+def process(s, txpp, N=-1, t=-1, epoch=None):
+    # epoch: only time that epoch, by default all of them
     endtime = dict()
     starttime = dict()
     tList = []
@@ -12,11 +28,9 @@ def process(s, txpp, N=-1, t=-1):
     scheduleTime = defaultdict(lambda: 0)
     for line in lines:
         if 'timestampE ' in line:
-            info = eval(line.split('timestampE')[1])
-            endtime[info[0]] = info[1]
+            record(endtime, line, 'timestampE', epoch, max)
         if 'timestampB ' in line:
-            info = eval(line.split('timestampB')[1])
-            starttime[info[0]] = info[1]
+            record(starttime, line, 'timestampB', epoch, min)
         if 'waits for' in line:
             if 'now is' in line:
                 tl = scanf.sscanf(line, '%s out: %d waits for %f now is %f')
@@ -55,7 +69,8 @@ def process(s, txpp, N=-1, t=-1):
     print 'range', max(endtime.values()) - min(starttime.values())
     return sorted(endtime.values())[N-t-1] - min(starttime.values())
 
-def processIncTx(s, txpp, N=-1, t=-1):
+def processIncTx(s, txpp, N=-1, t=-1, epoch=None):
+    # epoch: only time that epoch, by default all of them
     endtime = dict()
     starttime = dict()
     tList = []
@@ -63,11 +78,9 @@ def processIncTx(s, txpp, N=-1, t=-1):
     scheduleTime = dict()
     for line in lines:
         if 'timestampIE ' in line:
-            info = eval(line.split('timestampIE')[1])
-            endtime[info[0]] = info[1]
+            record(endtime, line, 'timestampIE', epoch, max)
         if 'timestampIB ' in line:
-            info = eval(line.split('timestampIB')[1])
-            starttime[info[0]] = info[1]
+            record(starttime, line, 'timestampIB', epoch, min)
         if 'waits for' in line:
             if 'now is' in line:
                 tl = scanf.sscanf(line, '%s out: %d waits for %f now is %f')
@@ -107,25 +120,25 @@ def processIncTx(s, txpp, N=-1, t=-1):
     print 'range', max(endtime.values()) - min(starttime.values())
     return sorted(endtime.values())[N-t-1] - min(starttime.values())
 
-def p(N, t, b):
+def p(N, t, b, epoch=None):
     fileName = "logs/%d_%d_%d.txt" % (N, t, b)
     contents = open(fileName).read().strip().split('\n\n')
     re = []
     for c in contents:
         if c:
-            ttt = process(c, b, N, t)
+            ttt = process(c, b, N, t, epoch)
             if ttt:
                 re.append(ttt)
     print tuple(re)
     print sum(re) / len(re), numpy.std(re), 'num', len(re)
 
-def pIncTx(N, t, b):
+def pIncTx(N, t, b, epoch=None):
     fileName = "logs/%d_%d_%d.txt" % (N, t, b)
     contents = open(fileName).read().strip().split('\n\n')
     re = []
     for c in contents:
         if c:
-            ttt = processIncTx(c, b, N, t)
+            ttt = processIncTx(c, b, N, t, epoch)
             if ttt:
                 re.append(ttt)
     print sum(re) / len(re), numpy.std(re)
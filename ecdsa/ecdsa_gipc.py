@@ -0,0 +1,60 @@
+from ecdsa_ssl import KEY
+import gevent
+from gevent.lock import Semaphore
+import gipc
+
+# Batched ECDSA verification on a pool of worker processes.
+# Each worker rebuilds the public keys once and then checks whole batches of
+# (sender, digest, signature) triples, so the protocol greenlets only pay one
+# pipe round trip per batch instead of one ctypes call per signature.
+# Only public keys are handed to it: it verifies, the parties sign.
+
+if '_procs' in globals():
+    for p,pipe,_ in _procs:
+        p.terminate()
+        p.join()
+    del _procs
+_procs = []
+
+def _worker(pubkeys, pipe):
+    keys = []
+    for pk in pubkeys:
+        k = KEY()
+        k.set_pubkey(pk)
+        keys.append(k)
+    while True:
+        batch = pipe.get()
+        pipe.put([keys[i].verify(h, sig) == 1 for i, h, sig in batch])
+
+def initialize(keys, size=1):
+    # keys: the public keys of the parties (see core.context.publicECDSAKeys)
+    global _procs
+    _procs = []
+    pubkeys = [k.get_pubkey() for k in keys]
+    for s in range(size):
+        (r,w) = gipc.pipe(duplex=True)
+        p = gipc.start_process(_worker, args=(pubkeys, r,))
+        _procs.append((p,w,Semaphore()))
+
+def _verify_on(proc, batch):
+    _,pipe,lock = proc
+    with lock:  # a pipe can only serve one request at a time
+        pipe.put(batch)
+        return pipe.get()
+
+def verify_batch(batch, keys):
+    # batch: a list of (sender, digest, sig), keys: the public keys, returns a list of booleans
+    if not batch:
+        return []
+    if not _procs:
+        # No pool, verify in place
+        return [keys[i].verify(h, sig) == 1 for i, h, sig in batch]
+    # Spread the batch evenly over the workers
+    step = len(batch) / len(_procs) + 1
+    jobs = [gevent.spawn(_verify_on, proc, batch[k*step:(k+1)*step])
+            for k, proc in enumerate(_procs) if batch[k*step:(k+1)*step]]
+    gevent.joinall(jobs, raise_error=True)
+    result = []
+    for job in jobs:
+        result.extend(job.value)
+    return result
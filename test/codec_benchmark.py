@@ -0,0 +1,60 @@
+import os
+import sys
+import time
+
+from ..core.utils import deepEncode, deepDecode
+from ..core.codec import encodeMessage, encodeBuffers, decodeMessage
+from ..commoncoin import boldyreva
+from ..threshenc import tpke
+
+# Encode/decode time of deepEncode/deepDecode against the codec, for one
+# message of every type (1-7). The 'i' and 'e' fragments are sized as for a
+# batch of B transactions of 250 bytes split into N - 2t parts.
+
+def sampleMessages(N, B):
+    t = (N - 1) / 3
+    fragment = os.urandom(B * 250 / (N - 2 * t) + 1)
+    rh = os.urandom(32)
+    branch = [os.urandom(32) for _ in range((N - 1).bit_length())]
+    sig = os.urandom(71)
+    coinShare = boldyreva.group.hash('coin', boldyreva.G1)
+    decShares = tuple((i, tpke.group.hash(str(i), tpke.G1)) for i in range(N - t))
+    return [
+        (1, (0, 1, ('B', ('i', (fragment, rh, branch), sig)))),
+        (2, (0, 1, ('B', ('e', (2, fragment, rh, branch), sig)))),
+        (3, (0, 1, ('A', (3, ('B', (1, 1)))))),
+        (4, (0, 1, ('A', (3, ('A', (1, 0)))))),
+        (5, (0, 1, ('A', (3, ('C', (1, coinShare)))))),
+        (6, (0, 1, ('B', ('r', 2, rh)))),
+        (7, (0, 1, ('O', decShares))),
+    ]
+
+def timeit(func, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) / repeat * 1e6
+
+def main(N, B, repeat):
+    counter = [[0, 0] for _ in range(8)]
+    print 'type     bytes   deepEncode  encodeMessage  encodeBuffers   deepDecode  decodeMessage   zeroCopy  (us)'
+    for msgtype, m in sampleMessages(N, B):
+        wire = deepEncode(1, m)
+        assert encodeMessage(1, m) == wire
+        assert decodeMessage(wire) == deepDecode(wire, counter)
+        f, t, bundle = m  # the same with an epoch tag, which deepEncode knows nothing about
+        assert decodeMessage(encodeMessage(1, (f, t, (7, bundle)))) == (1, (f, t, (7, bundle)))
+        print '%4d %9d %12.2f %14.2f %14.2f %12.2f %14.2f %10.2f' % (
+            msgtype, len(wire),
+            timeit(lambda: deepEncode(1, m), repeat),
+            timeit(lambda: encodeMessage(1, m), repeat),
+            timeit(lambda: encodeBuffers(1, m, framed=True), repeat),
+            timeit(lambda: deepDecode(wire, counter), repeat),
+            timeit(lambda: decodeMessage(wire, counter), repeat),
+            timeit(lambda: decodeMessage(wire, counter, zeroCopy=True), repeat))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        main(int(sys.argv[1]), int(sys.argv[2]), 1000)
+    else:
+        main(64, 4096, 1000)
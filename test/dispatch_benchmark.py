@@ -0,0 +1,100 @@
+from gevent import monkey
+monkey.patch_all()
+
+import gevent
+from gevent import Greenlet
+from gevent.queue import Queue
+from gevent.event import Event
+from collections import defaultdict
+import time
+import sys
+
+from ..core.dispatch import Mailbox, backpressureReport
+from ..core.includeTransaction import honestParty
+from ..core.transport import LoopbackNetwork
+from ..core.context import loadContexts
+from ..core.utils import encodeTransaction, randomTransaction
+from ..commoncoin.boldyreva_gipc import initialize as initializeGIPC
+from ..ecdsa.ecdsa_gipc import initialize as initializeECDSAGIPC
+from ..threshenc.tpke_gipc import initialize as initializeTPKEGIPC
+
+# Greenlets started by the N parties of one process during one epoch of the
+# real protocol (honestParty over a LoopbackNetwork), by greenletPacker name.
+# 'mailbox' runs the routers as they are; 'spawn' makes every Mailbox.put
+# start a Greenlet for the put, the way the routers did before they
+# dispatched into mailboxes, so the difference is what the mailboxes save.
+# Both binary agreements are run: binary_consensus greenlets, and the
+# BinaryAgreement state machines (eventDrivenBA).
+#
+#   python -m HoneyBadgerBFT.test.dispatch_benchmark thsig.keys thenc.keys ecdsa.keys N t [B]
+
+started = defaultdict(int)  # name -> greenlets started
+_start = Greenlet.start
+_put = Mailbox.put
+
+def _countingStart(self):
+    if hasattr(self, 'parent_args'):
+        name = self.name
+    else:
+        name = getattr(self._run, '__name__', repr(self._run))
+    started[name] += 1
+    return _start(self)
+
+def _spawningPut(self, item):
+    Greenlet(_put, self, item).start()  # In case they block the router
+
+def runEpoch(N, t, B, contexts, mode, eventDrivenBA):
+    network = LoopbackNetwork(N)
+    transactions = set(encodeTransaction(randomTransaction()) for _ in range(B))
+    committed = [0]
+    done = Event()
+
+    def onCommit(epoch, txs):
+        committed[0] += 1
+        if committed[0] == N:
+            done.set()
+
+    for context in contexts:
+        context.eventDrivenBA = eventDrivenBA
+    started.clear()
+    Mailbox.put = _spawningPut if mode == 'spawn' else _put
+    Greenlet.start = _countingStart
+    start = time.time()
+    try:
+        parties = []
+        for i in range(N):
+            control = Queue()
+            control.put(('IncludeTransaction', transactions))
+            parties.append(gevent.spawn(honestParty, i, N, t, control, None, None, None, contexts[i], B,
+                                        transport=network.transport(i), maxEpochs=1, onCommit=onCommit))
+        done.wait()
+        elapsed = time.time() - start
+    finally:
+        Greenlet.start = _start
+        Mailbox.put = _put
+    gevent.killall(parties)
+    return dict(started), elapsed
+
+def main(N, t, B, contexts):
+    initializeGIPC(contexts[0].PK, size=0)
+    initializeECDSAGIPC(contexts[0].ecdsaPubKeys, size=0)
+    initializeTPKEGIPC(contexts[0].encPK, size=0)
+    results = []
+    for eventDrivenBA in (False, True):
+        for mode in ('spawn', 'mailbox'):
+            counts, elapsed = runEpoch(N, t, B, contexts, mode, eventDrivenBA)
+            results.append(('%s/%s' % (eventDrivenBA and 'machine' or 'greenlet', mode), counts, elapsed))
+    names = sorted(set(name for _, counts, _ in results for name in counts),
+                   key=lambda name: -max(counts.get(name, 0) for _, counts, _ in results))
+    print '%-60s' % ('N=%d t=%d B=%d, greenlets started in one epoch' % (N, t, B)) + \
+        ''.join('%18s' % label for label, _, _ in results)
+    for name in names:
+        print '%-60s' % name[:60] + ''.join('%18d' % counts.get(name, 0) for _, counts, _ in results)
+    print '%-60s' % 'total' + ''.join('%18d' % sum(counts.values()) for _, counts, _ in results)
+    print '%-60s' % 'seconds' + ''.join('%18.2f' % elapsed for _, _, elapsed in results)
+    print 'mailboxes alive %d, pending %d, peak backlog %d, overflows %d' % backpressureReport()
+
+if __name__ == '__main__':
+    N, t = int(sys.argv[4]), int(sys.argv[5])
+    B = int(sys.argv[6]) if len(sys.argv) > 6 else N
+    main(N, t, B, loadContexts(range(N), N, t, sys.argv[1], sys.argv[2], sys.argv[3]))
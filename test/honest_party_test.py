@@ -5,18 +5,28 @@ monkey.patch_all()
 
 from gevent.queue import *
 from gevent import Greenlet
-from ..core.utils import bcolors, mylog, initiateThresholdSig
+from ..core.utils import bcolors, mylog
 from ..core.includeTransaction import honestParty
 from ..core.bkr_acs import initBeforeBinaryConsensus
 import gevent
 import os
 from ..core.utils import myRandom as random
-from ..core.utils import ACSException, checkExceptionPerGreenlet, getSignatureCost, encodeTransaction, getKeys,  \
-    deepEncode, deepDecode, randomTransaction, initiateECDSAKeys, initiateThresholdEnc, finishTransactionLeap
+from ..core.utils import ACSException, checkExceptionPerGreenlet, getSignatureCost, encodeTransaction,  \
+    deepEncode, deepDecode, randomTransaction, finishTransactionLeap
 
+import sys
 import time
 import math
 from ..commoncoin.boldyreva_gipc import initialize as initializeGIPC
+from ..ecdsa.ecdsa_gipc import initialize as initializeECDSAGIPC
+from ..core.zfec_gipc import initialize as initializeZfecGIPC
+from ..core.codec import encodeMessage, decodeMessage
+from ..core.metrics import MessageMetrics
+from ..core.profiler import profiler
+from ..threshenc.tpke_gipc import initialize as initializeTPKEGIPC
+from ..core.context import loadContexts
+import multiprocessing
+from netmodel import FairLink, UniformLatency
 
 USE_DEEP_ENCODE = True
 QUIET_MODE = True
@@ -25,16 +35,8 @@ def exception(msg):
     mylog(bcolors.WARNING + "Exception: %s\n" % msg + bcolors.ENDC)
     os.exit(1)
 
-msgCounter = 0
-totalMessageSize = 0
-starting_time = dict()
-ending_time = dict()
-msgSize = dict()
-msgFrom = dict()
-msgTo = dict()
-msgContent = dict()
+metrics = MessageMetrics()
 logChannel = Queue()
-msgTypeCounter = [[0, 0] for _ in range(8)]
 logGreenlet = None
 
 def logWriter(fileHandler):
@@ -44,36 +46,28 @@ def logWriter(fileHandler):
         fileHandler.flush()
 
 def encode(m):  # TODO
-    global msgCounter
-    msgCounter += 1
-    starting_time[msgCounter] = str(time.time())
+    msgCounter = metrics.nextId()
     if USE_DEEP_ENCODE:
-        result = deepEncode(msgCounter, m)
+        result = encodeMessage(msgCounter, m)
     else:
         result = (msgCounter, m)
-    if m[0] == m[1] and m[2][0]!='O' and m[2][1][0] == 'e':
+    epoch, bundle = m[2]
+    if m[0] == m[1] and bundle[0]!='O' and bundle[1][0] == 'e':
         ### this is a self to self echo message
-        msgSize[msgCounter] = 0
+        metrics.sent(msgCounter, m, 0)
     else:
-        msgSize[msgCounter] = len(result)
-    msgFrom[msgCounter] = m[1]
-    msgTo[msgCounter] = m[0]
-    msgContent[msgCounter] = m
+        metrics.sent(msgCounter, m, len(result))
     return result
 
 def decode(s):  # TODO
     if USE_DEEP_ENCODE:
-        result = deepDecode(s, msgTypeCounter)
+        result = decodeMessage(s, metrics.msgTypeCounter)
     else:
         result = s
     assert(isinstance(result, tuple))
-    ending_time[result[0]] = str(time.time())
-    msgContent[result[0]] = None
-    global totalMessageSize
-    totalMessageSize += msgSize[result[0]]
+    size, st, et = metrics.received(result[0], s, result[1][1], result[1][0])
     if not QUIET_MODE:
-        logChannel.put((result[0], msgSize[result[0]], msgFrom[result[0]], msgTo[result[0]],
-                    starting_time[result[0]], ending_time[result[0]], repr(result[1])))
+        logChannel.put((result[0], size, result[1][1], result[1][0], st, et, repr(result[1])))
     return result[1]
 
 def client_test_freenet(N, t, options):
@@ -91,11 +85,33 @@ def client_test_freenet(N, t, options):
     :return None:
     '''
     maxdelay = 0.01
-    initiateThresholdSig(open(options.threshold_keys, 'r').read())
-    initiateECDSAKeys(open(options.ecdsa, 'r').read())
-    initiateThresholdEnc(open(options.threshold_encs, 'r').read())
-    initializeGIPC(getKeys()[0])
-    buffers = map(lambda _: Queue(1), range(N))
+    # Each party only holds its own secrets, the worker pools only public keys
+    contexts = loadContexts(range(N), N, t, options.threshold_keys, options.threshold_encs, options.ecdsa)
+    initializeGIPC(contexts[0].PK)
+    initializeECDSAGIPC(contexts[0].ecdsaPubKeys)
+    initializeZfecGIPC()
+    initializeTPKEGIPC(contexts[0].encPK, size=multiprocessing.cpu_count())
+    phases = contexts[options.phases_party].phases  # the timings that are reported and served
+    if options.phases:
+        atexit.register(phases.dump, options.phases)
+    if options.metrics_port:
+        phases.serve(options.metrics_port)
+    buffers = map(lambda _: Queue(), range(N))
+    links = dict()  # (i, j) -> FairLink, with --bandwidth
+
+    def transmit(i, j, v):
+        # Self messages do not go through the network. With a bandwidth, the
+        # encoded size sets how long a message takes on its link, plus a
+        # random delay; without, messages are delivered right away.
+        s = encode((j, i, v))
+        if i == j:
+            buffers[j].put(s)
+        elif options.bandwidth:
+            if (i, j) not in links:
+                links[i, j] = FairLink(options.bandwidth, UniformLatency(0, maxdelay), buffers[j].put, i, j, random)
+            links[i, j].put(s, len(s))
+        else:
+            Greenlet(buffers[j].put, s).start()
     global logGreenlet
     logGreenlet = Greenlet(logWriter, open('msglog.TorMultiple', 'w'))
     logGreenlet.parent_args = (N, t)
@@ -105,10 +121,8 @@ def client_test_freenet(N, t, options):
     # Instantiate the "broadcast" instruction
     def makeBroadcast(i):
         def _broadcast(v):
-            def _deliver(j):
-                buffers[j].put(encode((j, i, v)))
             for j in range(N):
-                Greenlet(_deliver, j).start()
+                transmit(i, j, v)
         return _broadcast
 
     def recvWithDecode(buf):
@@ -119,9 +133,17 @@ def client_test_freenet(N, t, options):
 
     def makeSend(i):  # point to point message delivery
         def _send(j, v):
-            buffers[j].put(encode((j, i, v)))
+            transmit(i, j, v)
         return _send
 
+    finished = [0]
+
+    def onCommit(epoch, txs):
+        # The run stops once N - t epochs are committed, by any of the parties (convenient for local experiments)
+        finished[0] += 1
+        if finished[0] >= N - t:
+            sys.exit()
+
     while True:
     #if True:
         initBeforeBinaryConsensus()
@@ -131,7 +153,8 @@ def client_test_freenet(N, t, options):
         for i in range(N):
             bc = makeBroadcast(i)
             recv = recvWithDecode(buffers[i])
-            th = Greenlet(honestParty, i, N, t, controlChannels[i], bc, recv, makeSend(i), options.B)
+            th = Greenlet(honestParty, i, N, t, controlChannels[i], bc, recv, makeSend(i), contexts[i], options.B,
+                          onCommit=onCommit)
             controlChannels[i].put(('IncludeTransaction', transactionSet))
             th.start_later(random.random() * maxdelay)
             ts.append(th)
@@ -141,8 +164,8 @@ def client_test_freenet(N, t, options):
         except ACSException:
             gevent.killall(ts)
         except finishTransactionLeap:  ### Manually jump to this level
-            print 'msgCounter', msgCounter
-            print 'msgTypeCounter', msgTypeCounter
+            print 'msgCounter', metrics.msgCounter
+            print 'msgTypeCounter', metrics.msgTypeCounter
             # message id 0 (duplicated) for signatureCost
             logChannel.put(StopIteration)
             mylog("=====", verboseLevel=-1)
@@ -163,26 +186,30 @@ import atexit
 USE_PROFILE = False
 GEVENT_DEBUG = False
 OUTPUT_HALF_MSG = False
+metrics.keepContent = OUTPUT_HALF_MSG  # the messages in flight are kept for the report
 
 if USE_PROFILE:
     import GreenletProfiler
 
 def exit():
     print "Entering atexit()"
-    print 'msgCounter', msgCounter
-    print 'msgTypeCounter', msgTypeCounter
-    nums,lens = zip(*msgTypeCounter)
+    print 'msgCounter', metrics.msgCounter
+    print 'msgTypeCounter', metrics.msgTypeCounter
+    nums,lens = zip(*metrics.msgTypeCounter)
     print '    Init      Echo      Val       Aux      Coin     Ready    Share'
     print '%8d %8d %9d %9d %9d %9d %9d' % nums[1:]
     print '%8d %8d %9d %9d %9d %9d %9d' % lens[1:]
-    mylog("Total Message size %d" % totalMessageSize, verboseLevel=-2)
+    mylog("Total Message size %d" % metrics.totalMessageSize, verboseLevel=-2)
+    metrics.report()
+    metrics.close()
+    if profiler.running:
+        profiler.stop()
+        print profiler.report()
     if OUTPUT_HALF_MSG:
         halfmsgCounter = 0
-        for msgindex in starting_time.keys():
-            if msgindex not in ending_time.keys():
-                logChannel.put((msgindex, msgSize[msgindex], msgFrom[msgindex],
-                    msgTo[msgindex], starting_time[msgindex], time.time(), '[UNRECEIVED]' + repr(msgContent[msgindex])))
-                halfmsgCounter += 1
+        for msgindex, size, frm, to, st, content in metrics.halfMessages():
+            logChannel.put((msgindex, size, frm, to, st, time.time(), '[UNRECEIVED]' + repr(content)))
+            halfmsgCounter += 1
         mylog('%d extra log exported.' % halfmsgCounter, verboseLevel=-1)
 
     if GEVENT_DEBUG:
@@ -217,12 +244,33 @@ if __name__ == '__main__':
                       help="Tolerance of adversaries", metavar="T", type="int")
     parser.add_option("-x", "--transactions", dest="tx",
                       help="Number of transactions proposed by each party", metavar="TX", type="int", default=-1)
+    parser.add_option("-w", "--bandwidth", dest="bandwidth", type="float", default=None,
+                      help="Bandwidth of every link in bytes per second, shared fairly by its messages")
+    parser.add_option("--trace", dest="trace", metavar="FILE",
+                      help="Write one message in TRACE_EVERY to FILE")
+    parser.add_option("--trace-every", dest="trace_every", type="int", default=100, metavar="TRACE_EVERY")
+    parser.add_option("--phases", dest="phases", metavar="FILE",
+                      help="Write the timings of the protocol phases to FILE at exit")
+    parser.add_option("--metrics-port", dest="metrics_port", type="int", metavar="PORT",
+                      help="Serve the phase timings for Prometheus on PORT")
+    parser.add_option("--phases-party", dest="phases_party", type="int", default=0, metavar="PID",
+                      help="The party whose phase timings --phases and --metrics-port show")
+    parser.add_option("--profile", dest="profile", metavar="PREFIX",
+                      help="Sample the CPU time of every protocol layer, stacks of each epoch to PREFIX.<epoch>.folded")
+    parser.add_option("--profile-interval", dest="profile_interval", type="float", default=0.005, metavar="SECONDS",
+                      help="CPU time between two samples")
+    parser.add_option("--profile-switches", dest="profile_switches", action="store_true", default=False,
+                      help="Count the greenlet switches of every layer too (slows down every switch)")
     (options, args) = parser.parse_args()
     if (options.ecdsa and options.threshold_keys and options.threshold_encs and options.n and options.t):
         if not options.B:
             options.B = int(math.ceil(options.n * math.log(options.n)))
         if options.tx < 0:
             options.tx = options.B
+        if options.trace:
+            metrics.openTrace(options.trace, options.trace_every)
+        if options.profile:
+            profiler.start(options.profile, options.profile_interval, options.profile_switches)
         client_test_freenet(options.n , options.t, options)
     else:
         parser.error('Please specify the arguments')
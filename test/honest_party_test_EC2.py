@@ -5,18 +5,17 @@ monkey.patch_all()
 
 from gevent.queue import *
 from gevent import Greenlet
-from ..core.utils import bcolors, mylog, initiateThresholdSig
+from ..core.utils import bcolors, mylog
 from ..core.includeTransaction import honestParty
 from collections import defaultdict
 from ..core.bkr_acs import initBeforeBinaryConsensus
 import gevent
 import os
-from ..core.utils import ACSException, checkExceptionPerGreenlet, encodeTransaction, getKeys, \
-    deepEncode, deepDecode, randomTransaction, initiateECDSAKeys, initiateThresholdEnc, finishTransactionLeap, initiateRND
-from gevent.server import StreamServer
+from ..core.utils import ACSException, checkExceptionPerGreenlet, encodeTransaction, \
+    deepEncode, deepDecode, randomTransaction, finishTransactionLeap, initiateRND
+import sys
 import time
 
-import socks
 import struct
 import math
 
@@ -24,63 +23,21 @@ from subprocess import check_output
 from os.path import expanduser
 from random import Random
 import sched
-from socket import error as SocketError
 from ..commoncoin.boldyreva_gipc import initialize as initializeGIPC
+from ..ecdsa.ecdsa_gipc import initialize as initializeECDSAGIPC
+from ..core.zfec_gipc import initialize as initializeZfecGIPC
+from ..core.codec import encodeMessage, decodeMessage
+from ..core.metrics import MessageMetrics
+from ..core.profiler import profiler
+from ..core.transport import TCPTransport
+from ..threshenc.tpke_gipc import initialize as initializeTPKEGIPC
+from ..core.context import loadContexts
+import multiprocessing
 
 TOR_SOCKSPORT = range(9050, 9150)
 WAITING_SETUP_TIME_IN_SEC = 3
 
-def goodread(f, length):
-    ltmp = length
-    buf = []
-    while ltmp > 0:
-        buf.append(f.read(ltmp))
-        ltmp -= len(buf[-1])
-    return ''.join(buf)
-
-def listen_to_channel(port):
-    mylog('Preparing server on %d...' % port)
-    q = Queue()
-    def _handle(socket, address):
-        f = socket.makefile()
-        while True:
-            msglength, = struct.unpack('<I', goodread(f, 4))
-            line = goodread(f, msglength)
-            obj = decode(line)
-            q.put(obj[1:])
-    server = StreamServer(('0.0.0.0', port), _handle)
-    server.start()
-    return q
-
-def connect_to_channel(hostname, port, party):
-    mylog('Trying to connect to %s for party %d' % (repr((hostname, port)), party), verboseLevel=-1)
-    retry = True
-    s = socks.socksocket()
-    while retry:
-      try:
-        s = socks.socksocket()
-        s.connect((hostname, port))
-        retry = False
-      except Exception, e:  # socks.SOCKS5Error:
-        retry = True
-        gevent.sleep(1)
-        s.close()
-        mylog('retrying (%s, %d) caused by %s...' % (hostname, port, str(e)) , verboseLevel=-1)
-    q = Queue()
-    def _handle():
-        while True:
-            obj = q.get()
-            content = encode(obj)
-            try:
-                s.sendall(struct.pack('<I', len(content)) + content)
-            except SocketError:
-                print '!! [to %d] sending %d bytes' % (party, len(content))
-
-    gtemp = Greenlet(_handle)
-    gtemp.parent_args = (hostname, port, party)
-    gtemp.name = 'connect_to_channel._handle'
-    gtemp.start()
-    return q
+BATCH_DELAY = 0.0005  # how long a connection waits for more messages to write at once
 
 BASE_PORT = 49500
 
@@ -110,17 +67,8 @@ def exception(msg):
     mylog(bcolors.WARNING + "Exception: %s\n" % msg + bcolors.ENDC)
     os.exit(1)
 
-msgCounter = 0
-totalMessageSize = 0
-starting_time = defaultdict(lambda: 0.0)
-ending_time = defaultdict(lambda: 0.0)
-msgSize = defaultdict(lambda: 0)
-msgFrom = defaultdict(lambda: 0)
-msgTo = defaultdict(lambda: 0)
-msgContent = defaultdict(lambda: '')
-msgTypeCounter = [[0, 0]] * 7
+metrics = MessageMetrics()
 logChannel = Queue()
-msgTypeCounter = [[0, 0] for _ in range(8)]
 logGreenlet = None
 
 def logWriter(fileHandler):
@@ -129,30 +77,20 @@ def logWriter(fileHandler):
         fileHandler.write("%d:%d(%d->%d)[%s]-[%s]%s\n" % (msgCounter, msgSize, msgFrom, msgTo, st, et, content))
         fileHandler.flush()
 
-def encode(m):  # TODO
-    global msgCounter
-    msgCounter += 1
-    starting_time[msgCounter] = str(time.time())
-    result = deepEncode(msgCounter, m)
-    msgSize[msgCounter] = len(result)
-    msgFrom[msgCounter] = m[1]
-    msgTo[msgCounter] = m[0]
-    msgContent[msgCounter] = m
-    if m[2][0] == 'A' and m[2][1][0] == 0:
-        logChannel.put((msgCounter, len(result), m[1], m[0], starting_time[msgCounter], -1, 'i'+repr(m)))
+def encode(m):
+    msgCounter = metrics.nextId()
+    result = encodeMessage(msgCounter, m)
+    metrics.sent(msgCounter, m, len(result))
+    if m[2][1][0] == 'A' and m[2][1][1][0] == 0:  # m[2] is (epoch, bundle)
+        logChannel.put((msgCounter, len(result), m[1], m[0], time.time(), -1, 'i'+repr(m)))
     return result
 
-def decode(s):  # TODO
-    result = deepDecode(s, msgTypeCounter)
+def decode(s):
+    result = decodeMessage(s, metrics.msgTypeCounter)
     assert(isinstance(result, tuple))
-    ending_time[result[0]] = str(time.time())
-    msgContent[result[0]] = None
-    msgFrom[result[0]] = result[1][1]
-    msgTo[result[0]] = result[1][0]
-    global totalMessageSize
-    totalMessageSize += msgSize[result[0]]
-    if result[1][2][0] == 'A' and result[1][2][1][0] == 0:
-        logChannel.put((result[0], msgSize[result[0]], msgFrom[result[0]], msgTo[result[0]], -1, ending_time[result[0]], 'o'+repr(result[1])))
+    size, _, et = metrics.received(result[0], s, result[1][1], result[1][0])
+    if result[1][2][1][0] == 'A' and result[1][2][1][1][0] == 0:
+        logChannel.put((result[0], size, result[1][1], result[1][0], -1, et, 'o'+repr(result[1])))
     return result[1]
 
 def client_test_freenet(N, t, options):
@@ -169,10 +107,7 @@ def client_test_freenet(N, t, options):
     :param t: the number of malicious parties
     :return None:
     '''
-    initiateThresholdSig(open(options.threshold_keys, 'r').read())
-    initiateECDSAKeys(open(options.ecdsa, 'r').read())
-    initiateThresholdEnc(open(options.threshold_encs, 'r').read())
-    initializeGIPC(PK=getKeys()[0])
+    initializeZfecGIPC()
 
     global logGreenlet
     logGreenlet = Greenlet(logWriter, open('msglog.TorMultiple', 'w'))
@@ -185,48 +120,36 @@ def client_test_freenet(N, t, options):
     myID = IP_LIST.index(localIP)
     N = len(IP_LIST)
     initiateRND(options.tx)
-    def makeBroadcast(i):
-        chans = []
-        # First establish N connections (including a self connection)
-        for j in range(N):
-            host, port = IP_MAPPINGS[j] # TOR_MAPPINGS[j]
-            chans.append(connect_to_channel(host, port, i))
-        def _broadcast(v):
-            for j in range(N):
-                chans[j].put((j, i, v))  # from i to j
-        def _send(j, v):
-            chans[j].put((j, i, v))
-        return _broadcast, _send
-
     iterList = [myID]
-    servers = []
-    for i in iterList:
-        _, port = IP_MAPPINGS[i]
-        servers.append(listen_to_channel(port))
+    # Only my own secrets are kept, the worker pools only get public keys
+    contexts = dict(zip(iterList, loadContexts(iterList, N, t, options.threshold_keys, options.threshold_encs,
+                                               options.ecdsa)))
+    initializeGIPC(PK=contexts[myID].PK)
+    initializeECDSAGIPC(contexts[myID].ecdsaPubKeys)
+    initializeTPKEGIPC(contexts[myID].encPK, size=multiprocessing.cpu_count())
+    phases = contexts[myID].phases
+    if options.phases:
+        atexit.register(phases.dump, options.phases)
+    if options.metrics_port:
+        phases.serve(options.metrics_port)
+    transport = TCPTransport(myID, IP_MAPPINGS, encode=encode, decode=decode, batchDelay=BATCH_DELAY)
+    transport.start()
     print 'servers started'
 
     gevent.sleep(WAITING_SETUP_TIME_IN_SEC) # wait for set-up to be ready
     print 'sleep over'
+    finished = [0]
+
+    def onCommit(epoch, txs):
+        # The run stops once N - t epochs are committed (what honestParty used to do)
+        finished[0] += 1
+        if finished[0] >= N - t:
+            sys.exit()
+
     if True:  # We only test for once
         initBeforeBinaryConsensus()
         ts = []
         controlChannels = [Queue() for _ in range(N)]
-        bcList = dict()
-        sdList = dict()
-        tList = []
-
-        def _makeBroadcast(x):
-            bc, sd = makeBroadcast(x)
-            bcList[x] = bc
-            sdList[x] = sd
-
-        for i in iterList:
-            tmp_t = Greenlet(_makeBroadcast, i)
-            tmp_t.parent_args = (N, t)
-            tmp_t.name = 'client_test_freenet._makeBroadcast(%d)' % i
-            tmp_t.start()
-            tList.append(tmp_t)
-        gevent.joinall(tList)
 
         rnd = Random()
         rnd.seed(123123)
@@ -235,10 +158,8 @@ def client_test_freenet(N, t, options):
 
         def toBeScheduled():
             for i in iterList:
-                bc = bcList[i]  # makeBroadcast(i)
-                sd = sdList[i]
-                recv = servers[0].get
-                th = Greenlet(honestParty, i, N, t, controlChannels[i], bc, recv, sd, options.B)
+                th = Greenlet(honestParty, i, N, t, controlChannels[i], None, None, None, contexts[i], options.B,
+                              transport, onCommit=onCommit)
                 th.parent_args = (N, t)
                 th.name = 'client_test_freenet.honestParty(%d)' % i
                 controlChannels[i].put(('IncludeTransaction',
@@ -252,8 +173,9 @@ def client_test_freenet(N, t, options):
             except ACSException:
                 gevent.killall(ts)
             except finishTransactionLeap:  ### Manually jump to this level
-                print 'msgCounter', msgCounter
-                print 'msgTypeCounter', msgTypeCounter
+                print 'msgCounter', metrics.msgCounter
+                print 'msgTypeCounter', metrics.msgTypeCounter
+                print 'batches', transport.batchCounter
                 # message id 0 (duplicated) for signatureCost
                 logChannel.put(StopIteration)
                 mylog("=====", verboseLevel=-1)
@@ -281,26 +203,30 @@ import atexit
 USE_PROFILE = False
 GEVENT_DEBUG = False
 OUTPUT_HALF_MSG = False
+metrics.keepContent = OUTPUT_HALF_MSG  # the messages in flight are kept for the report
 
 if USE_PROFILE:
     import GreenletProfiler
 
 def exit():
     print "Entering atexit()"
-    print 'msgCounter', msgCounter
-    print 'msgTypeCounter', msgTypeCounter
-    nums,lens = zip(*msgTypeCounter)
+    print 'msgCounter', metrics.msgCounter
+    print 'msgTypeCounter', metrics.msgTypeCounter
+    nums,lens = zip(*metrics.msgTypeCounter)
     print '    Init      Echo      Val       Aux      Coin     Ready    Share'
     print '%8d %8d %9d %9d %9d %9d %9d' % nums[1:]
     print '%8d %8d %9d %9d %9d %9d %9d' % lens[1:]
-    mylog("Total Message size %d" % totalMessageSize, verboseLevel=-2)
+    mylog("Total Message size %d" % metrics.totalMessageSize, verboseLevel=-2)
+    metrics.report()
+    metrics.close()
+    if profiler.running:
+        profiler.stop()
+        print profiler.report()
     if OUTPUT_HALF_MSG:
         halfmsgCounter = 0
-        for msgindex in starting_time.keys():
-            if msgindex not in ending_time.keys():
-                logChannel.put((msgindex, msgSize[msgindex], msgFrom[msgindex],
-                    msgTo[msgindex], starting_time[msgindex], time.time(), '[UNRECEIVED]' + repr(msgContent[msgindex])))
-                halfmsgCounter += 1
+        for msgindex, size, frm, to, st, content in metrics.halfMessages():
+            logChannel.put((msgindex, size, frm, to, st, time.time(), '[UNRECEIVED]' + repr(content)))
+            halfmsgCounter += 1
         mylog('%d extra log exported.' % halfmsgCounter, verboseLevel=-1)
 
     if GEVENT_DEBUG:
@@ -341,6 +267,19 @@ if __name__ == '__main__':
                       help="Tolerance of adversaries", metavar="T", type="int")
     parser.add_option("-x", "--transactions", dest="tx",
                       help="Number of transactions proposed by each party", metavar="TX", type="int", default=-1)
+    parser.add_option("--trace", dest="trace", metavar="FILE",
+                      help="Write one message in TRACE_EVERY to FILE")
+    parser.add_option("--trace-every", dest="trace_every", type="int", default=100, metavar="TRACE_EVERY")
+    parser.add_option("--phases", dest="phases", metavar="FILE",
+                      help="Write the timings of the protocol phases to FILE at exit")
+    parser.add_option("--metrics-port", dest="metrics_port", type="int", metavar="PORT",
+                      help="Serve the phase timings for Prometheus on PORT")
+    parser.add_option("--profile", dest="profile", metavar="PREFIX",
+                      help="Sample the CPU time of every protocol layer, stacks of each epoch to PREFIX.<epoch>.folded")
+    parser.add_option("--profile-interval", dest="profile_interval", type="float", default=0.005, metavar="SECONDS",
+                      help="CPU time between two samples")
+    parser.add_option("--profile-switches", dest="profile_switches", action="store_true", default=False,
+                      help="Count the greenlet switches of every layer too (slows down every switch)")
     (options, args) = parser.parse_args()
     prepareIPList(open(expanduser(options.hosts), 'r').read())
     if (options.ecdsa and options.threshold_keys and options.threshold_encs and options.n and options.t):
@@ -348,6 +287,10 @@ if __name__ == '__main__':
             options.B = int(math.ceil(options.n * math.log(options.n)))
         if options.tx < 0:
             options.tx = options.B
+        if options.trace:
+            metrics.openTrace(options.trace, options.trace_every)
+        if options.profile:
+            profiler.start(options.profile, options.profile_interval, options.profile_switches)
         client_test_freenet(options.n , options.t, options)
     else:
         parser.error('Please specify the arguments')
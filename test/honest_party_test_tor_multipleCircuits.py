@@ -5,76 +5,46 @@ monkey.patch_all()
 
 from gevent.queue import *
 from gevent import Greenlet
-from ..core.utils import bcolors, mylog, initiateThresholdSig
+from ..core.utils import bcolors, mylog
 from ..core.includeTransaction import honestParty, Transaction
 from collections import defaultdict
 from ..core.bkr_acs import initBeforeBinaryConsensus
 import gevent
 import os
-from gevent.server import StreamServer
-from ..core.utils import ACSException, checkExceptionPerGreenlet, getSignatureCost, encodeTransaction, getKeys, \
-    deepEncode, deepDecode, randomTransaction, initiateECDSAKeys, initiateThresholdEnc, finishTransactionLeap
+from ..core.utils import ACSException, checkExceptionPerGreenlet, getSignatureCost, encodeTransaction, \
+    deepEncode, deepDecode, randomTransaction, finishTransactionLeap
+import sys
 import time
 import socks
 import struct
 from os.path import expanduser
 from ..commoncoin.boldyreva_gipc import initialize as initializeGIPC
+from ..ecdsa.ecdsa_gipc import initialize as initializeECDSAGIPC
+from ..core.zfec_gipc import initialize as initializeZfecGIPC
+from ..core.codec import encodeMessage, decodeMessage
+from ..core.metrics import MessageMetrics
+from ..core.transport import TCPTransport
+from ..threshenc.tpke_gipc import initialize as initializeTPKEGIPC
+from ..core.context import loadContexts
+import multiprocessing
 
 # USE_DEEP_ENCODE = True # It must be encoded
 QUIET_MODE = False  # we are logging the messages
 
 TOR_SOCKSPORT = range(9050, 9150)
 
-def goodread(f, length):
-    ltmp = length
-    buf = []
-    while ltmp > 0:
-        buf.append(f.read(ltmp))
-        ltmp -= len(buf[-1])
-    return ''.join(buf)
-
-def listen_to_channel(port):
-    mylog('Preparing server on %d...' % port)
-    q = Queue()
-    def _handle(socket, address):
-        f = socket.makefile()
-        while True:
-            msglength, = struct.unpack('<I', goodread(f, 4))
-            line = goodread(f, msglength)
-            obj = decode(line)
-            q.put(obj[1:])
-
-    server = StreamServer(('0.0.0.0', port), _handle)
-    server.start()
-    return q
-
-def connect_to_channel(hostname, port, party):
-    mylog('Trying to connect to %s for party %d' % (repr((hostname, port)), party), verboseLevel=-2)
-    retry = True
-    s = socks.socksocket()
-    while retry:
-      try:
+def torConnector(party):
+    # Each party goes through its own Tor circuit
+    def _connect(address):
         s = socks.socksocket()
         s.setproxy(socks.PROXY_TYPE_SOCKS5, "127.0.0.1", TOR_SOCKSPORT[party], True)
-        s.connect((hostname, port))
-        retry = False
-      except Exception, e:  # socks.SOCKS5Error:  # still no idea why socks over tor would always generate this error
-        retry = True
-        gevent.sleep(1)
-        s.close()
-        mylog('retrying (%s, %d) caused by %s...' % (hostname, port, str(e)) , verboseLevel=-2)
-    q = Queue()
-    def _handle():
-        while True:
-            obj = q.get()
-            content = encode(obj)
-            s.sendall(struct.pack('<I', len(content)) + content)
-                
-    gtemp = Greenlet(_handle)
-    gtemp.parent_args = (hostname, port, party)
-    gtemp.name = 'connect_to_channel._handle'
-    gtemp.start()
-    return q
+        try:
+            s.connect(address)
+        except Exception, e:  # socks.SOCKS5Error:  # still no idea why socks over tor would always generate this error
+            s.close()
+            raise IOError(str(e))
+        return s
+    return _connect
 
 BASE_PORT = 49500
 
@@ -92,15 +62,7 @@ def exception(msg):
     mylog(bcolors.WARNING + "Exception: %s\n" % msg + bcolors.ENDC)
     os.exit(1)
 
-msgCounter = 0
-totalMessageSize = 0
-starting_time = defaultdict(lambda: 0.0)
-ending_time = defaultdict(lambda: 0.0)
-msgSize = defaultdict(lambda: 0)
-msgFrom = defaultdict(lambda: 0)
-msgTo = defaultdict(lambda: 0)
-msgContent = defaultdict(lambda: '')
-msgTypeCounter = [[0, 0] for _ in range(8)]
+metrics = MessageMetrics()
 logChannel = Queue()
 
 def logWriter(fileHandler):
@@ -109,30 +71,21 @@ def logWriter(fileHandler):
         fileHandler.write("%d:%d(%d->%d)[%s]-[%s]%s\n" % (msgCounter, msgSize, msgFrom, msgTo, st, et, content))
         fileHandler.flush()
 
-def encode(m):  # TODO
-    global msgCounter
-    msgCounter += 1
-    starting_time[msgCounter] = str(time.time())
-    result = deepEncode(msgCounter, m)
+def encode(m):
+    msgCounter = metrics.nextId()
+    result = encodeMessage(msgCounter, m)
     if m[0] == m[1]:
-        msgSize[msgCounter] = 0
+        metrics.sent(msgCounter, m, 0)
     else:
-        msgSize[msgCounter] = len(result)
-    msgFrom[msgCounter] = m[1]
-    msgTo[msgCounter] = m[0]
-    msgContent[msgCounter] = m
+        metrics.sent(msgCounter, m, len(result))
     return result
 
-def decode(s):  # TODO
-    result = deepDecode(s, msgTypeCounter)
+def decode(s):
+    result = decodeMessage(s, metrics.msgTypeCounter)
     assert(isinstance(result, tuple))
-    ending_time[result[0]] = str(time.time())
-    msgContent[result[0]] = None
-    global totalMessageSize
-    totalMessageSize += msgSize[result[0]]
+    size, st, et = metrics.received(result[0], s, result[1][1], result[1][0])
     if not QUIET_MODE:
-        logChannel.put((result[0], msgSize[result[0]], msgFrom[result[0]], msgTo[result[0]],
-                    starting_time[result[0]], ending_time[result[0]], repr(result[1])))
+        logChannel.put((result[0], size, result[1][1], result[1][0], st, et, repr(result[1])))
     return result[1]
 
 def client_test_freenet(N, t, options):
@@ -150,63 +103,43 @@ def client_test_freenet(N, t, options):
     :return None:
     '''
     initTorConfiguration(options.hosts)
-    initiateThresholdSig(open(options.threshold_keys, 'r').read())
-    initiateECDSAKeys(open(options.ecdsa, 'r').read())
-    initiateThresholdEnc(open(options.threshold_encs, 'r').read())
-    initializeGIPC(getKeys()[0])
+    # Each party only holds its own secrets, the worker pools only public keys
+    contexts = loadContexts(range(N), N, t, options.threshold_keys, options.threshold_encs, options.ecdsa)
+    initializeGIPC(contexts[0].PK)
+    initializeECDSAGIPC(contexts[0].ecdsaPubKeys)
+    initializeZfecGIPC()
+    initializeTPKEGIPC(contexts[0].encPK, size=multiprocessing.cpu_count())
     global logGreenlet
     logGreenlet = Greenlet(logWriter, open('msglog.TorMultiple', 'w'))
     logGreenlet.parent_args = (N, t)
     logGreenlet.name = 'client_test_freenet.logWriter'
     logGreenlet.start()
 
-    servers = []
-    for i in range(N):
-        _, port = TOR_MAPPINGS[i]
-        servers.append(listen_to_channel(port))
-
-    # Instantiate the "broadcast" instruction
-    def makeBroadcast(i):
-        chans = []
-        # First establish N connections (including a self connection)
-        for j in range(N):
-            host, port = TOR_MAPPINGS[j]
-            chans.append(connect_to_channel(host, port, i))
-        def _broadcast(v):
-            for j in range(N):
-                if j != i:
-                    chans[j].put((j, i, v))  # from i to j
-            servers[i].put((i, v))  # this is what the reader see. We are doing a shortcut.
-        def _delivery(j, v):
-            chans[j].put((j, i, v))
-        return _broadcast, _delivery
+    transports = [TCPTransport(i, TOR_MAPPINGS, encode=encode, decode=decode, connect=torConnector(i))
+                  for i in range(N)]
+    for transport in transports:
+        transport.start()
 
     gevent.sleep(2)
     print 'servers started'
 
+    finished = [0]
+
+    def onCommit(epoch, txs):
+        # The run stops once N - t epochs are committed, by any of the parties (convenient for local experiments)
+        finished[0] += 1
+        if finished[0] >= N - t:
+            sys.exit()
+
     # while True:
     if True:  # We only test for once
         initBeforeBinaryConsensus()
         ts = []
         controlChannels = [Queue() for _ in range(N)]
-        bcList = dict()
-        sdList = dict()
-        tList = []
         transactionSet = set([encodeTransaction(randomTransaction()) for trC in range(int(options.tx))])  # we are using the same one
-        def _makeBroadcast(x):
-            bc, sd = makeBroadcast(x)
-            bcList[x] = bc
-            sdList[x] = sd
-        for i in range(N):
-            tmp_t = Greenlet(_makeBroadcast, i)
-            tmp_t.parent_args = (N, t)
-            tmp_t.name = 'client_test_freenet._makeBroadcast(%d)' % i
-            tmp_t.start()
-            tList.append(tmp_t)
-        gevent.joinall(tList)
         for i in range(N):
-            recv = servers[i].get
-            th = Greenlet(honestParty, i, N, t, controlChannels[i], bcList[i], recv, sdList[i], options.B)
+            th = Greenlet(honestParty, i, N, t, controlChannels[i], None, None, None, contexts[i], options.B,
+                          transports[i], onCommit=onCommit)
             th.parent_args = (N, t)
             th.name = 'client_test_freenet.honestParty(%d)' % i
             th.start()
@@ -220,8 +153,8 @@ def client_test_freenet(N, t, options):
         except ACSException:
             gevent.killall(ts)
         except finishTransactionLeap:  ### Manually jump to this level
-            print 'msgCounter', msgCounter
-            print 'msgTypeCounter', msgTypeCounter
+            print 'msgCounter', metrics.msgCounter
+            print 'msgTypeCounter', metrics.msgTypeCounter
             # message id 0 (duplicated) for signatureCost
             logChannel.put(StopIteration)
             mylog("=====", verboseLevel=-1)
@@ -243,26 +176,27 @@ import atexit
 USE_PROFILE = False
 GEVENT_DEBUG = False
 OUTPUT_HALF_MSG = False
+metrics.keepContent = OUTPUT_HALF_MSG  # the messages in flight are kept for the report
 
 if USE_PROFILE:
     import GreenletProfiler
 
 def exit():
     print "Entering atexit()"
-    print 'msgCounter', msgCounter
-    print 'msgTypeCounter', msgTypeCounter
-    nums,lens = zip(*msgTypeCounter)
+    print 'msgCounter', metrics.msgCounter
+    print 'msgTypeCounter', metrics.msgTypeCounter
+    nums,lens = zip(*metrics.msgTypeCounter)
     print '    Init      Echo      Val       Aux      Coin     Ready    Share'
     print '%8d %8d %9d %9d %9d %9d %9d' % nums[1:]
     print '%8d %8d %9d %9d %9d %9d %9d' % lens[1:]
-    mylog("Total Message size %d" % totalMessageSize, verboseLevel=-2)
+    mylog("Total Message size %d" % metrics.totalMessageSize, verboseLevel=-2)
+    metrics.report()
+    metrics.close()
     if OUTPUT_HALF_MSG:
         halfmsgCounter = 0
-        for msgindex in starting_time.keys():
-            if msgindex not in ending_time.keys():
-                logChannel.put((msgindex, msgSize[msgindex], msgFrom[msgindex],
-                    msgTo[msgindex], starting_time[msgindex], time.time(), '[UNRECEIVED]' + repr(msgContent[msgindex])))
-                halfmsgCounter += 1
+        for msgindex, size, frm, to, st, content in metrics.halfMessages():
+            logChannel.put((msgindex, size, frm, to, st, time.time(), '[UNRECEIVED]' + repr(content)))
+            halfmsgCounter += 1
         mylog('%d extra log exported.' % halfmsgCounter, verboseLevel=-1)
 
     if GEVENT_DEBUG:
@@ -300,12 +234,17 @@ if __name__ == '__main__':
                       help="Tolerance of adversaries", metavar="T", type="int")
     parser.add_option("-x", "--transactions", dest="tx",
                       help="Number of transactions proposed by each party", metavar="TX", type="int", default=-1)
+    parser.add_option("--trace", dest="trace", metavar="FILE",
+                      help="Write one message in TRACE_EVERY to FILE")
+    parser.add_option("--trace-every", dest="trace_every", type="int", default=100, metavar="TRACE_EVERY")
     (options, args) = parser.parse_args()
     if (options.ecdsa and options.threshold_keys and options.threshold_encs and options.n and options.t):
         if not options.B:
             options.B = int(math.ceil(options.n * math.log(options.n)))
         if options.tx < 0:
             options.tx = options.B  # right B transactions
+        if options.trace:
+            metrics.openTrace(options.trace, options.trace_every)
         client_test_freenet(options.n , options.t, options)
     else:
         parser.error('Please specify the arguments')
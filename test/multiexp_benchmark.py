@@ -0,0 +1,49 @@
+import sys
+import time
+
+from ..commoncoin import boldyreva
+from ..commoncoin.multiexp import multiexp
+from ..threshenc import tpke
+
+# Combining k shares in G1: multiexp against the product of one
+# exponentiation per share, as combine_shares did before, for the groups of
+# the common coin (MNT224) and of the threshold encryption (SS512). The
+# exponents are random field elements, like the Lagrange coefficients.
+# combine_shares uses multiexp from commoncoin.multiexp.MULTIEXP_MIN_TERMS
+# terms on: the smallest k printed at the end, if any, is what to set it to.
+
+def naive(bases, exponents):
+    return reduce(lambda a, b: a * b, [base ** e for base, e in zip(bases, exponents)], bases[0] ** 0)
+
+def timeit(func, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) / repeat * 1e3
+
+def main(sizes, repeat):
+    print 'group       k     naive   multiexp  speedup  (ms)'
+    wins = dict()  # group -> the smallest k where multiexp is faster
+    for name, group in (('MNT224', boldyreva.group), ('SS512', tpke.group)):
+        identity = group.random(boldyreva.G1) ** 0
+        g = group.random(boldyreva.G1)
+        assert multiexp([g, g], [0, 0]) == identity
+        for k in sizes:
+            bases = [group.random(boldyreva.G1) for _ in range(k)]
+            exponents = [group.random(boldyreva.ZR) for _ in range(k)]
+            assert multiexp(bases, exponents) == naive(bases, exponents)
+            tNaive = timeit(lambda: naive(bases, exponents), repeat)
+            tMulti = timeit(lambda: multiexp(bases, exponents), repeat)
+            print '%-8s %4d %9.2f %10.2f %8.2f' % (name, k, tNaive, tMulti, tNaive / tMulti)
+            if tMulti < tNaive:
+                wins.setdefault(name, k)
+    if len(wins) == 2:
+        print 'MULTIEXP_MIN_TERMS = %d' % max(wins.values())
+    else:
+        print 'MULTIEXP_MIN_TERMS = None  # multiexp does not win in every group'
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main([int(k) for k in sys.argv[1:]], 20)
+    else:
+        main([4, 11, 22, 43, 86], 20)
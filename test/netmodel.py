@@ -0,0 +1,183 @@
+import math
+import random
+import time
+import gevent
+from gevent.event import Event
+
+# Link models for the discrete-event simulator (test/simulator.py) and the
+# local harness (test/honest_party_test.py).
+# A latency model gives the propagation delay of one message, a Link adds the
+# time its bytes take to go out at the link's bandwidth. In the simulator all
+# times are in virtual seconds, and all the randomness comes from its seeded
+# random.Random. A FairLink shares the bandwidth of a real-time link fairly
+# between the messages going out at once.
+
+
+class ConstantLatency(object):
+    def __init__(self, delay):
+        self.delay = delay
+
+    def sample(self, rnd, i, j):
+        return self.delay
+
+
+class UniformLatency(object):
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def sample(self, rnd, i, j):
+        return rnd.uniform(self.low, self.high)
+
+
+class LogNormalLatency(object):
+    '''
+    Long-tailed delays, as seen on wide-area links.
+    :param median: the median delay
+    :param sigma: the spread of log(delay)
+    '''
+    def __init__(self, median, sigma=0.5):
+        self.mu = math.log(median)
+        self.sigma = sigma
+
+    def sample(self, rnd, i, j):
+        return rnd.lognormvariate(self.mu, self.sigma)
+
+
+class MatrixLatency(object):
+    '''
+    A fixed delay for every pair of parties (e.g. measured between regions),
+    plus some uniform jitter.
+    :param delays: delays[i][j] is the delay from i to j
+    '''
+    def __init__(self, delays, jitter=0.0):
+        self.delays = delays
+        self.jitter = jitter
+
+    def sample(self, rnd, i, j):
+        return self.delays[i][j] + (rnd.uniform(0, self.jitter) if self.jitter else 0.0)
+
+
+class Link(object):
+    '''
+    The link from one party to another: messages go out one after the other
+    (FIFO) at _bandwidth_ bytes per second, then take the latency to arrive.
+    A bandwidth of None means messages take no time to send.
+    '''
+    def __init__(self, latency, bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.busyUntil = 0.0  # when the last message queued is out
+        self.messages = 0
+        self.bytes = 0
+
+    def transmit(self, now, size, rnd, i, j):
+        # Returns the arrival time of a message of _size_ bytes sent at _now_
+        self.messages += 1
+        self.bytes += size
+        if self.bandwidth is not None:
+            self.busyUntil = max(now, self.busyUntil) + float(size) / self.bandwidth
+            now = self.busyUntil
+        return now + self.latency.sample(rnd, i, j)
+
+
+class FairQueue(object):
+    '''
+    Fair queuing of the messages on a link, in its fluid limit (processor
+    sharing): the messages being sent share the bandwidth equally, so a small
+    message is not stuck behind a large one, and each takes time in
+    proportion to its size.
+    '''
+    def __init__(self, bandwidth):
+        self.bandwidth = float(bandwidth)
+        self.active = []  # [bytes left, item]
+        self.clock = 0.0  # up to when the bytes left are accounted for
+
+    def add(self, now, item, size):
+        # Returns what finished before _now_, as advance does
+        done = self.advance(now)
+        self.active.append([float(size), item])
+        return done
+
+    def advance(self, now):
+        # Returns the messages sent by _now_ as (finish time, item), in order
+        done = []
+        while self.active:
+            rate = self.bandwidth / len(self.active)
+            smallest = min(left for left, _ in self.active)
+            finish = self.clock + smallest / rate
+            if finish > now:
+                sent = (now - self.clock) * rate
+                for entry in self.active:
+                    entry[0] -= sent
+                break
+            self.clock = finish
+            remaining = []
+            for entry in self.active:
+                entry[0] -= smallest
+                if entry[0] <= 0:
+                    done.append((finish, entry[1]))
+                else:
+                    remaining.append(entry)
+            self.active = remaining
+        self.clock = max(self.clock, now)
+        return done
+
+    def nextFinish(self):
+        # When the next message is out if nothing else comes in, None if idle
+        if not self.active:
+            return None
+        return self.clock + min(left for left, _ in self.active) * len(self.active) / self.bandwidth
+
+
+class FairLink(object):
+    '''
+    A link of the local harness in real time, from party i to party j: the
+    messages are serialized at _bandwidth_ bytes per second with fair queuing,
+    then _deliver_(item) is called after the latency.
+    '''
+    def __init__(self, bandwidth, latency, deliver, i=None, j=None, rnd=random):
+        self.i = i
+        self.j = j
+        self.queue = FairQueue(bandwidth)
+        self.latency = latency
+        self.deliver = deliver
+        self.rnd = rnd
+        self.wakeup = Event()
+        self.messages = 0
+        self.bytes = 0
+        self.greenlet = gevent.spawn(self._run)
+
+    def put(self, item, size):
+        self.messages += 1
+        self.bytes += size
+        self._arrive(self.queue.add(time.time(), item, size))
+        self.wakeup.set()
+
+    def _arrive(self, done):
+        now = time.time()
+        for finish, item in done:
+            gevent.spawn_later(max(finish - now, 0) + self.latency.sample(self.rnd, self.i, self.j), self.deliver, item)
+
+    def _run(self):
+        while True:
+            now = time.time()
+            self._arrive(self.queue.advance(now))
+            finish = self.queue.nextFinish()
+            self.wakeup.clear()
+            self.wakeup.wait(None if finish is None else max(finish - now, 0))
+
+
+def parseLatency(spec):
+    '''
+    Reads a latency model from the command line:
+        0.05           constant
+        0.01:0.1       uniform
+        lognormal:0.05:0.5
+    '''
+    fields = spec.split(':')
+    if fields[0] == 'lognormal':
+        return LogNormalLatency(*map(float, fields[1:]))
+    if len(fields) == 2:
+        return UniformLatency(*map(float, fields))
+    return ConstantLatency(float(spec))
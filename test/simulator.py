@@ -0,0 +1,222 @@
+#!/usr/bin/python
+import gevent
+from gevent import Greenlet
+from gevent.queue import Queue
+from collections import defaultdict
+import heapq
+import math
+import random
+import time
+
+from ..core.utils import mylog, encodeTransaction, randomTransaction
+from ..core.context import loadContexts
+from ..core.includeTransaction import honestParty, PIPELINE_DEPTH
+from ..core.codec import encodeMessage, HEADER, EPOCH_FLAG
+from ..commoncoin.boldyreva_gipc import initialize as initializeGIPC
+from ..ecdsa.ecdsa_gipc import initialize as initializeECDSAGIPC
+from ..core.zfec_gipc import initialize as initializeZfecGIPC
+from ..threshenc.tpke_gipc import initialize as initializeTPKEGIPC
+from netmodel import Link, parseLatency
+
+# Discrete-event simulation of honestParty on a virtual clock.
+#
+# Sent messages go into a priority queue keyed by their arrival time, given by
+# the latency and bandwidth model of their link. The scheduler waits until
+# every party greenlet is blocked (the event loop is idle), then moves the
+# clock to the next arrival and delivers it: nothing ever sleeps. Computation
+# takes no virtual time, and the crypto pools are set up without worker
+# processes so that it all runs in place.
+# The message counts, bytes and times of a run only depend on the seed, not the
+# contents of the messages (the ECDSA signatures and AES keys are random): an
+# ECDSA signature, whose DER encoding varies in length, is always counted as
+# ECDSA_SIG_BYTES. Counts and bytes are reported per epoch.
+#
+# python -m HoneyBadgerBFT.test.simulator -e ecdsa.keys -k thsig.keys -c thenc.keys -n 64 -t 16 --epochs 3
+
+MSG_TYPES = ['Init', 'Echo', 'Val', 'Aux', 'Coin', 'Ready', 'Share']
+ECDSA_SIG_BYTES = 72  # the longest DER encoding of a secp256k1 signature
+
+
+def sizeOf(wire, bundle):
+    # The length of wire with the ECDSA signature of an 'i' or 'e' message padded to ECDSA_SIG_BYTES
+    if isinstance(bundle[0], int):
+        bundle = bundle[1]
+    if bundle[0] == 'B' and bundle[1][0] in ('i', 'e'):
+        return len(wire) + ECDSA_SIG_BYTES - len(bundle[1][2])
+    return len(wire)
+
+
+def waitIdle():
+    # Returns once all the other greenlets are blocked
+    if hasattr(gevent, 'idle'):
+        gevent.idle()
+    else:
+        hub = gevent.get_hub()
+        hub.wait(hub.loop.idle())
+
+
+class Simulator(object):
+    '''
+    The network of N simulated parties, handing out their broadcast, send and
+    receive closures.
+    :param latency: a latency model from netmodel
+    :param bandwidth: bytes per second of every link, None for unlimited
+    '''
+    def __init__(self, N, latency, bandwidth=None, seed=0):
+        self.N = N
+        self.rnd = random.Random(seed)
+        self.now = 0.0
+        self.events = []  # (arrival time, seq, to, from, bundle)
+        self.seq = 0
+        self.inboxes = [Queue() for _ in range(N)]
+        self.links = dict(((i, j), Link(latency, bandwidth)) for i in range(N) for j in range(N) if i != j)
+        self.msgTypeCounter = [[0, 0] for _ in range(8)]
+        self.epochCounter = defaultdict(lambda: [0, 0])  # epoch -> [messages, bytes]
+        self.epochStart = dict()  # epoch -> when its first message was sent
+        self.commits = defaultdict(dict)  # epoch -> {pid: when it committed}
+        self.lastCommit = [-1] * N  # the last epoch each party committed
+        self.committedTx = dict()  # epoch -> number of transactions
+        self.delivered = 0
+
+    def transmit(self, i, j, bundle):
+        wire = encodeMessage(0, (j, i, bundle))
+        size = sizeOf(wire, bundle)
+        msgtype = HEADER.unpack_from(wire)[3] & ~EPOCH_FLAG
+        self.msgTypeCounter[msgtype][0] += 1
+        self.msgTypeCounter[msgtype][1] += size
+        epoch = bundle[0] if isinstance(bundle[0], int) else None
+        self.epochCounter[epoch][0] += 1
+        self.epochCounter[epoch][1] += size
+        if epoch is not None:
+            self.epochStart.setdefault(epoch, self.now)
+        if i == j:
+            arrival = self.now  # does not go through the network
+        else:
+            arrival = self.links[i, j].transmit(self.now, size, self.rnd, i, j)
+        heapq.heappush(self.events, (arrival, self.seq, j, i, bundle))
+        self.seq += 1
+
+    def makeBroadcast(self, i):
+        def _broadcast(m):
+            for j in range(self.N):
+                self.transmit(i, j, m)
+        return _broadcast
+
+    def makeSend(self, i):
+        def _send(j, m):
+            self.transmit(i, j, m)
+        return _send
+
+    def makeReceive(self, i):
+        return self.inboxes[i].get
+
+    def makeOnCommit(self, i):
+        def _onCommit(epoch, txs):
+            # Every party must deliver the epochs in order, with none skipped
+            if epoch != self.lastCommit[i] + 1:
+                raise AssertionError("party %d committed epoch %d after %d" % (i, epoch, self.lastCommit[i]))
+            self.lastCommit[i] = epoch
+            self.commits[epoch][i] = self.now
+            self.committedTx[epoch] = max(self.committedTx.get(epoch, 0), len(txs))
+        return _onCommit
+
+    def run(self, parties):
+        # Returns when all the parties are done, or when nothing can happen anymore
+        while not all(party.ready() for party in parties):
+            waitIdle()
+            if not self.events:
+                if not all(party.ready() for party in parties):
+                    mylog("simulation stalled at %.3fs, %d parties still running" % (
+                        self.now, len([p for p in parties if not p.ready()])), verboseLevel=-2)
+                break
+            # Everything that arrives at the same time goes in at once
+            self.now = self.events[0][0]
+            while self.events and self.events[0][0] == self.now:
+                _, _, j, i, bundle = heapq.heappop(self.events)
+                self.inboxes[j].put((i, bundle))
+                self.delivered += 1
+        for party in parties:
+            if party.ready() and not party.successful():
+                raise party.exception
+
+    def report(self):
+        print 'epoch    start(s)  first commit  median commit  last commit      tx   messages        bytes'
+        for epoch in sorted(self.commits):
+            times = sorted(self.commits[epoch].values())
+            start = self.epochStart.get(epoch, 0.0)
+            print '%5d %11.3f %13.3f %14.3f %12.3f %7d %10d %12d' % (
+                epoch, start, times[0] - start, times[len(times) / 2] - start, times[-1] - start,
+                self.committedTx[epoch], self.epochCounter[epoch][0], self.epochCounter[epoch][1])
+        if None in self.epochCounter:
+            print 'untagged %d messages, %d bytes' % tuple(self.epochCounter[None])
+        nums, lens = zip(*self.msgTypeCounter)
+        print ' '.join('%9s' % name for name in MSG_TYPES) + '  (all epochs)'
+        print ' '.join('%9d' % n for n in nums[1:])
+        print ' '.join('%9d' % n for n in lens[1:])
+        print 'messages %d, bytes %d, virtual time %.3fs' % (sum(nums), sum(lens), self.now)
+
+
+def simulate(N, t, options):
+    # Party i samples its mempool with seed + i
+    contexts = loadContexts(range(N), N, t, options.threshold_keys, options.threshold_encs, options.ecdsa,
+                            seed=options.seed)
+    # No worker processes: the crypto runs in place, in a deterministic order
+    initializeGIPC(contexts[0].PK, size=0)
+    initializeECDSAGIPC(contexts[0].ecdsaPubKeys, size=0)
+    initializeZfecGIPC(size=0)
+    initializeTPKEGIPC(contexts[0].encPK, size=0)
+    rnd = random.Random(options.seed)
+
+    sim = Simulator(N, parseLatency(options.latency), options.bandwidth, options.seed)
+    transactionSet = [encodeTransaction(randomTransaction(rnd), rnd) for _ in range(options.tx)]
+    parties = []
+    for i in range(N):
+        controlChannel = Queue()
+        controlChannel.put(('IncludeTransaction', transactionSet))
+        party = Greenlet(honestParty, i, N, t, controlChannel, sim.makeBroadcast(i), sim.makeReceive(i),
+                         sim.makeSend(i), contexts[i], options.B, maxWait=0, pipelineDepth=options.pipeline,
+                         maxEpochs=options.epochs, onCommit=sim.makeOnCommit(i))
+        party.name = 'simulate.honestParty(%d)' % i
+        party.start()
+        parties.append(party)
+    start = time.time()
+    sim.run(parties)
+    sim.report()
+    print 'simulated in %.1fs' % (time.time() - start)
+    return sim
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("-e", "--ecdsa-keys", dest="ecdsa",
+                      help="Location of ECDSA keys", metavar="KEYS")
+    parser.add_option("-k", "--threshold-keys", dest="threshold_keys",
+                      help="Location of threshold signature keys", metavar="KEYS")
+    parser.add_option("-c", "--threshold-enc", dest="threshold_encs",
+                      help="Location of threshold encryption keys", metavar="KEYS")
+    parser.add_option("-n", "--number", dest="n",
+                      help="Number of parties", metavar="N", type="int")
+    parser.add_option("-b", "--propose-size", dest="B",
+                      help="Number of transactions to propose", metavar="B", type="int")
+    parser.add_option("-t", "--tolerance", dest="t",
+                      help="Tolerance of adversaries", metavar="T", type="int")
+    parser.add_option("-x", "--transactions", dest="tx",
+                      help="Number of transactions in every mempool", metavar="TX", type="int", default=-1)
+    parser.add_option("--epochs", dest="epochs", help="Epochs to run", type="int", default=1)
+    parser.add_option("--pipeline", dest="pipeline", help="Epochs in progress at once", type="int",
+                      default=PIPELINE_DEPTH)
+    parser.add_option("--seed", dest="seed", help="Random seed", type="int", default=0)
+    parser.add_option("--latency", dest="latency", default="0.05",
+                      help="Link latency in seconds: D, LOW:HIGH or lognormal:MEDIAN:SIGMA")
+    parser.add_option("--bandwidth", dest="bandwidth", type="float", default=None,
+                      help="Link bandwidth in bytes per second")
+    (options, args) = parser.parse_args()
+    if (options.ecdsa and options.threshold_keys and options.threshold_encs and options.n and options.t):
+        if not options.B:
+            options.B = int(math.ceil(options.n * math.log(options.n)))
+        if options.tx < 0:
+            options.tx = options.B * options.epochs
+        simulate(options.n, options.t, options)
+    else:
+        parser.error('Please specify the arguments')
@@ -4,6 +4,8 @@ import random
 from Crypto.Hash import SHA256
 from Crypto import Random
 from Crypto.Cipher import AES
+from ..commoncoin.lagrange import LagrangeCache
+from ..commoncoin.multiexp import combine
 
 # Threshold encryption based on Gap-Diffie-Hellman
 # - Only encrypts messages that are 32-byte strings
@@ -63,19 +65,16 @@ class TPKEPublicKey(object):
         self.VK = VK
         self.VKs = VKs
 
+    def lagrange_coefficients(self, S):
+        # All the coefficients for the set of signers S, cached by set
+        if '_lagrangeCache' not in self.__dict__:
+            self._lagrangeCache = LagrangeCache(self.l, self.k, ONE)
+        return self._lagrangeCache.coefficients(S)
+
     def lagrange(self, S, j):
-        # Assert S is a subset of range(0,self.l)
-        assert len(S) == self.k
         assert type(S) is set
-        assert S.issubset(range(0,self.l))
-        S = sorted(S)
-
         assert j in S
-        assert 0 <= j < self.l
-        mul = lambda a,b: a*b
-        num = reduce(mul, [0 - jj - 1 for jj in S if jj != j], ONE)
-        den = reduce(mul, [j - jj     for jj in S if jj != j], ONE)
-        return num / den
+        return self.lagrange_coefficients(S)[j]
 
     def encrypt(self, m):
         # Only encrypt 32 byte strings
@@ -109,15 +108,14 @@ class TPKEPublicKey(object):
     def combine_shares(self, (U,V,W), shares):
         # sigs: a mapping from idx -> sig
         S = set(shares.keys())
-        assert S.issubset(range(self.l))
+        coefficients = self.lagrange_coefficients(S)
 
         # ASSUMPTION
         # assert self.verify_ciphertext((U,V,W))
 
-        mul = lambda a,b: a*b
-        res = reduce(mul, 
-                     [share ** self.lagrange(S, j)
-                      for j,share in shares.iteritems()], ONE)
+        indices = shares.keys()
+        res = combine([shares[j] for j in indices],
+                      [coefficients[j] for j in indices])
         return xor(hashG(res), V)
 
 
@@ -0,0 +1,88 @@
+from tpke import TPKEPublicKey, serialize, deserialize0, deserialize1
+import gevent
+from gevent.lock import Semaphore
+import gipc
+
+# Batched threshold decryption on a pool of worker processes.
+# All the ciphertexts of an epoch go through the pool at once: the
+# decryption shares are computed in one pass, and so are the combinations,
+# each request being split evenly over the workers.
+# Group elements cross the pipes serialized, and the private key share is
+# sent with each request since one process may run several parties.
+
+if '_procs' in globals():
+    for p,pipe,_ in _procs:
+        p.terminate()
+        p.join()
+    del _procs
+_procs = []
+
+myPK = None
+
+def _decrypt(PK, SK, Us):
+    SK = deserialize0(SK)
+    return [serialize(deserialize1(U) ** SK) for U in Us]
+
+def _combine(PK, items):
+    result = []
+    for U, V, shares in items:
+        shares = dict((j, deserialize1(share)) for j, share in shares.iteritems())
+        result.append(PK.combine_shares((deserialize1(U), V, None), shares))
+    return result
+
+def _worker(l, k, VK, VKs, pipe):
+    PK = TPKEPublicKey(l, k, deserialize1(VK), map(deserialize1, VKs))
+    while True:
+        op, arg1, arg2 = pipe.get()
+        if op == 'decrypt':
+            pipe.put(_decrypt(PK, arg1, arg2))
+        elif op == 'combine':
+            pipe.put(_combine(PK, arg1))
+
+def initialize(PK, size=1):
+    global _procs, myPK
+    myPK = PK
+    _procs = []
+    for s in range(size):
+        (r,w) = gipc.pipe(duplex=True)
+        p = gipc.start_process(_worker, args=(PK.l, PK.k, serialize(PK.VK), map(serialize, PK.VKs), r,))
+        _procs.append((p,w,Semaphore()))
+
+def _request(proc, request):
+    _,pipe,lock = proc
+    with lock:  # a pipe can only serve one request at a time
+        pipe.put(request)
+        return pipe.get()
+
+def _spread(items, makeRequest):
+    # Splits _items_ evenly over the workers and concatenates the answers
+    step = len(items) / len(_procs) + 1
+    jobs = [gevent.spawn(_request, proc, makeRequest(items[k*step:(k+1)*step]))
+            for k, proc in enumerate(_procs) if items[k*step:(k+1)*step]]
+    gevent.joinall(jobs, raise_error=True)
+    result = []
+    for job in jobs:
+        result.extend(job.value)
+    return result
+
+def decrypt_shares(SK, ciphertexts):
+    # ciphertexts: a list of (U, V, W), returns the list of my decryption shares
+    if not ciphertexts:
+        return []
+    if not _procs:
+        return [SK.decrypt_share(C) for C in ciphertexts]
+    sk = serialize(SK.SK)
+    shares = _spread([serialize(U) for U, _, _ in ciphertexts],
+                     lambda Us: ('decrypt', sk, Us))
+    return map(deserialize1, shares)
+
+def combine_shares(items, PK=None):
+    # items: a list of ((U, V, W), {idx: share}), returns the list of plaintexts
+    if not items:
+        return []
+    if not _procs:
+        PK = PK or myPK
+        return [PK.combine_shares(C, shares) for C, shares in items]
+    return _spread([(serialize(U), V, dict((j, serialize(share)) for j, share in shares.iteritems()))
+                    for (U, V, _), shares in items],
+                   lambda chunk: ('combine', chunk, None))
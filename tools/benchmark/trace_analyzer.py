@@ -0,0 +1,169 @@
+################################
+# Statistics of a binary message trace (core/tracelog.py), computed chunk by
+# chunk over a memory-mapped file, and an importer for the old text logs of
+# logWriter ("%d:%d(%d->%d)[%s]-[%s]%s" lines).
+#
+#   python -m HoneyBadgerBFT.tools.benchmark.trace_analyzer analyze run.trace
+#   python -m HoneyBadgerBFT.tools.benchmark.trace_analyzer import msglog.TorMultiple run.trace
+
+import os
+import re
+import sys
+import numpy
+from ...core.tracelog import MAGIC, VERSION, FILE_HEADER, RECORD, RECORD_FIELDS, UNKNOWN, \
+    TraceFormatException, TraceWriter
+
+# The struct codes of RECORD are numpy's too, little endian like the file
+RECORD_DTYPE = numpy.dtype([(name, '<' + code) for name, code in zip(RECORD_FIELDS, RECORD.format.lstrip('<'))])
+assert RECORD_DTYPE.itemsize == RECORD.size
+
+MSG_TYPES = ['?', 'Init', 'Echo', 'Val', 'Aux', 'Coin', 'Ready', 'Share']
+CHUNK_RECORDS = 1 << 22  # about 140MB of records per step
+LATENCY_BINS = numpy.logspace(-6, 3, 9 * 16 + 1)  # seconds, 16 bins per decade
+
+
+def load(fileName):
+    with open(fileName, 'rb') as f:
+        magic, version, size = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+    if magic != MAGIC or version != VERSION or size != RECORD.size:
+        raise TraceFormatException('%s is not a version %d trace' % (fileName, VERSION))
+    count = (os.path.getsize(fileName) - FILE_HEADER.size) / RECORD.size
+    if not count:
+        return numpy.zeros(0, dtype=RECORD_DTYPE)
+    return numpy.memmap(fileName, dtype=RECORD_DTYPE, mode='r', offset=FILE_HEADER.size, shape=(count,))
+
+
+class Summary(object):
+    '''
+    Counts, bytes and latencies of a trace, per message type, in a fixed
+    amount of memory: the latencies go into one histogram per type.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.typeCount = numpy.zeros(len(MSG_TYPES), dtype=numpy.int64)
+        self.typeBytes = numpy.zeros(len(MSG_TYPES), dtype=numpy.int64)
+        self.firstSend = None
+        self.lastRecv = None
+        self.timed = 0  # records with both times
+        self.latencySum = 0.0
+        self.latencySquares = 0.0
+        self.latencyMax = 0.0
+        self.histograms = numpy.zeros((len(MSG_TYPES), len(LATENCY_BINS) + 1), dtype=numpy.int64)
+
+    def add(self, chunk):
+        types = numpy.minimum(chunk['type'], len(MSG_TYPES) - 1).astype(numpy.int64)
+        sizes = chunk['size'].astype(numpy.int64)
+        self.count += len(chunk)
+        self.bytes += int(sizes.sum())
+        self.typeCount += numpy.bincount(types, minlength=len(MSG_TYPES))
+        self.typeBytes += numpy.bincount(types, weights=sizes, minlength=len(MSG_TYPES)).astype(numpy.int64)
+        send, recv = chunk['send'], chunk['recv']
+        sent = send[send >= 0]
+        if len(sent):
+            first = int(sent.min())
+            self.firstSend = first if self.firstSend is None else min(self.firstSend, first)
+        received = recv[recv >= 0]
+        if len(received):
+            last = int(received.max())
+            self.lastRecv = last if self.lastRecv is None else max(self.lastRecv, last)
+        timed = (send >= 0) & (recv >= 0)
+        latency = (recv[timed] - send[timed]) / 1e9
+        if len(latency):
+            self.timed += len(latency)
+            self.latencySum += float(latency.sum())
+            self.latencySquares += float((latency * latency).sum())
+            self.latencyMax = max(self.latencyMax, float(latency.max()))
+            bins = numpy.searchsorted(LATENCY_BINS, latency, side='right')
+            flat = types[timed] * (len(LATENCY_BINS) + 1) + bins
+            self.histograms += numpy.bincount(flat, minlength=self.histograms.size).reshape(self.histograms.shape)
+
+    def quantile(self, histogram, q):
+        # The upper edge of the bin that holds the q-quantile
+        total = histogram.sum()
+        if not total:
+            return None
+        k = int(numpy.searchsorted(numpy.cumsum(histogram), max(1, int(numpy.ceil(q * total)))))
+        return min(LATENCY_BINS[min(k, len(LATENCY_BINS) - 1)], self.latencyMax)
+
+    def report(self):
+        # The figures of process.py first: span, messages, bytes, latency mean, variance and max
+        span = (self.lastRecv - self.firstSend) / 1e9 if self.firstSend is not None and self.lastRecv is not None \
+            else 0.0
+        print span
+        print self.count
+        print self.bytes
+        if self.timed:
+            mean = self.latencySum / self.timed
+            print mean
+            print self.latencySquares / self.timed - mean * mean
+            print self.latencyMax
+        if span > 0:
+            print 'throughput %.1f messages/s, %.1f bytes/s' % (self.count / span, self.bytes / span)
+        print '  type      count        bytes   latency p50      p90      p99 (ms)'
+        for msgtype, name in enumerate(MSG_TYPES):
+            if not self.typeCount[msgtype]:
+                continue
+            histogram = self.histograms[msgtype]
+            if histogram.sum():
+                times = '%12.2f %8.2f %8.2f' % tuple(1000 * self.quantile(histogram, q) for q in (0.5, 0.9, 0.99))
+            else:
+                times = '%12s' % '-'
+            print '%6s %10d %12d %s' % (name, self.typeCount[msgtype], self.typeBytes[msgtype], times)
+
+
+def analyze(fileName):
+    records = load(fileName)
+    summary = Summary()
+    for start in xrange(0, len(records), CHUNK_RECORDS):
+        summary.add(records[start:start + CHUNK_RECORDS])
+    summary.report()
+    return summary
+
+
+# The old text logs
+LINE = re.compile(r'(\d+):(\d+)\((\d+)->(\d+)\)\[([^\]]*)\]-\[([^\]]*)\](.*)')
+_TAG_O = re.compile(r"\('O',")
+_TAG_B = re.compile(r"\('B', \('([ier])'")
+_TAG_A = re.compile(r"\('A', \(\d+, \('([BAC])'")
+TAG_TYPES = {'i': 1, 'e': 2, 'r': 6, 'B': 3, 'A': 4, 'C': 5}
+TAG_PREFIX = 200  # the tags are all near the start of the repr
+
+
+def typeOf(content):
+    # The message type, from the repr of (to, from, bundle)
+    head = content[:TAG_PREFIX]
+    if _TAG_O.search(head):
+        return 7
+    match = _TAG_B.search(head) or _TAG_A.search(head)
+    return TAG_TYPES[match.group(1)] if match else 0
+
+
+def toNanoseconds(s):
+    try:
+        t = float(s)
+    except ValueError:
+        return UNKNOWN  # None
+    return int(t * 1e9) if t >= 0 else UNKNOWN
+
+
+def importLog(textFile, traceFile):
+    # Reads the text log line by line, writes a trace, returns the number of records
+    out = TraceWriter(traceFile)
+    for line in open(textFile, 'r'):
+        match = LINE.match(line)
+        if not match:
+            continue
+        mc, size, frm, to, start, end, content = match.groups()
+        out.write(int(mc), typeOf(content), int(frm), int(to), int(size), toNanoseconds(start), toNanoseconds(end))
+    out.close()
+    return out.records
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'analyze':
+        analyze(sys.argv[2])
+    elif len(sys.argv) == 4 and sys.argv[1] == 'import':
+        print '%d records' % importLog(sys.argv[2], sys.argv[3])
+    else:
+        print 'usage: %s analyze TRACE | import LOG TRACE' % sys.argv[0]